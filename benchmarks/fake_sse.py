@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Servidor SSE falso para benchmarks: sustituye a claude.ai y a chatgpt.com en local
+
+Endpoints (los mismos que usan ClaudeAPIClient y chatgpt_wrapper.py):
+  GET    /api/organizations                                  → [{"uuid": ORG}]
+  POST   /api/organizations/{org}/chat_conversations         → {"uuid": ...}
+  POST   /api/organizations/{org}/chat_conversations/{id}/completion   → SSE estilo Claude
+  DELETE /api/organizations/{org}/chat_conversations/{id}    → 204
+  POST   /backend-api/conversation                           → SSE estilo ChatGPT
+
+La respuesta tiene `--tokens` tokens que se emiten a `--rate` tokens/s (0 = sin
+pausa) tras esperar `--ttft-ms`. Claude manda cada token como delta; ChatGPT
+manda en cada evento el texto acumulado, como el servicio real.
+
+  python benchmarks/fake_sse.py --port 8790 --tokens 400 --rate 200 --ttft-ms 150
+"""
+
+import argparse
+import json
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+ORG_ID = "bench-org"
+
+
+def make_tokens(count, size):
+    """Tokens de `size` caracteres (con un no-ASCII para ejercitar el UTF-8 partido)"""
+    base = ("ñ" + "abcdefghijklmnopqrstuvwxyz" * (size // 26 + 1))[:max(1, size - 1)]
+    return [base + " " for _ in range(count)]
+
+
+class FakeSSEHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(data or b"{}")
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/api/organizations":
+            return self.send_json(200, [{"uuid": ORG_ID}])
+        self.send_json(404, {"error": "not found"})
+
+    def do_DELETE(self):
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        payload = self.read_body()
+        if self.path.endswith("/chat_conversations"):
+            return self.send_json(201, {"uuid": str(uuid.uuid4())})
+        if self.path.endswith("/completion"):
+            return self.stream(self.claude_events())
+        if self.path.rstrip("/").endswith("/backend-api/conversation"):
+            return self.stream(self.chatgpt_events(payload))
+        self.send_json(404, {"error": "not found"})
+
+    def claude_events(self):
+        for token in make_tokens(self.config.tokens, self.config.token_size):
+            yield {"type": "completion", "completion": token, "stop_reason": None}
+        yield {"type": "completion", "completion": "", "stop_reason": "stop_sequence"}
+
+    def chatgpt_events(self, payload):
+        conversation_id = payload.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        text = ""
+        for token in make_tokens(self.config.tokens, self.config.token_size):
+            text += token
+            yield {
+                "message": {"id": message_id, "author": {"role": "assistant"}, "content": {"parts": [text]}},
+                "conversation_id": conversation_id,
+            }
+
+    def stream(self, events):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def write(data):
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        interval = 1.0 / self.config.rate if self.config.rate > 0 else 0
+        time.sleep(self.config.ttft_ms / 1000.0)
+        start = time.perf_counter()
+        try:
+            for i, event in enumerate(events):
+                if interval:
+                    # Ritmo fijo respecto al inicio: las pausas no acumulan deriva
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                write(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+            write(b"data: [DONE]\n\n")
+            write(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor SSE falso (claude.ai / chatgpt.com) para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--tokens", type=int, default=200, help="tokens por respuesta")
+    parser.add_argument("--token-size", type=int, default=4, help="caracteres por token")
+    parser.add_argument("--rate", type=float, default=0, help="tokens por segundo (0 = sin pausa)")
+    parser.add_argument("--ttft-ms", type=float, default=0, help="espera antes del primer token")
+    config = parser.parse_args()
+
+    FakeSSEHandler.config = config
+    server = ThreadingHTTPServer((config.host, config.port), FakeSSEHandler)
+    server.daemon_threads = True
+    print(f"[OK] SSE falso en http://{config.host}:{config.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+#!/usr/bin/env python3
+"""
+Benchmarks reproducibles sin red: servidor MCP NEON, ClaudeAPIClient y chatgpt_wrapper
+
+  python benchmarks/run_benchmarks.py
+  python benchmarks/run_benchmarks.py --only mcp --requests 2000 --concurrency 16
+  python benchmarks/run_benchmarks.py --output hoy.json --baseline ayer.json --tolerance 0.2
+
+Escenarios:
+- mcp: arranca mcp-server-neon.py en un puerto libre. Con --database-url (p.ej. un
+  Postgres local) usa el almacen NEON; sin ella, MCP_NEON_STORE=local (SQLite
+  embebido) y nada sale de la maquina. Mide get/set/get_many, run_code, run_command
+  y un lote en paralelo. Con --workers N el servidor corre en modo prefork
+  (MCP_NEON_WORKERS) y el RSS es la suma del supervisor y sus workers.
+- claude / chatgpt: arranca benchmarks/fake_sse.py con el tamaño de respuesta y el
+  ritmo de tokens pedidos y apunta ClaudeAPIClient (base_url) y chatgpt_wrapper
+  (CHATGPT_API_URL) a el. Cada uno corre en su propio proceso para medir su RSS.
+
+Por escenario se informa peticiones/s, latencia p50/p99, TTFT p50/p99 (streaming)
+y pico de RSS del proceso medido. Con --baseline se compara con una ejecucion
+anterior (--output) y se sale con codigo 1 si algo empeora mas de --tolerance.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MCP_SERVER = os.path.join(ROOT, "mcp-server-neon.py")
+FAKE_SSE = os.path.join(ROOT, "benchmarks", "fake_sse.py")
+CLAUDE_DIR = os.path.join(ROOT, "renderer", "tools", "claude_local")
+CHATGPT_DIR = os.path.join(ROOT, "renderer", "tools", "chatgpt_local")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, proc, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"el proceso termino al arrancar (exit {proc.returncode})")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"el puerto {port} no abrio en {timeout}s")
+
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def peak_rss_kb(pid=None):
+    """Pico de RSS en KB: de otro proceso por /proc (Linux) o del propio por getrusage"""
+    if pid is not None:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1])
+        except OSError:
+            return None
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS lo da en bytes, Linux en KB
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def tree_peak_rss_kb(pid):
+    """Pico de RSS de un proceso mas el de sus hijos directos (Linux)"""
+    total = peak_rss_kb(pid)
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = [int(child) for child in f.read().split()]
+    except OSError:
+        return total
+    for child in children:
+        total = (total or 0) + (peak_rss_kb(child) or 0)
+    return total
+
+
+def run_load(fn, requests, concurrency):
+    """
+    Ejecutar fn(i) `requests` veces con `concurrency` hilos. fn devuelve el TTFT en
+    segundos (o None) y lanza excepcion si la peticion falla.
+    """
+    latencies, ttfts, errors = [], [], []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            try:
+                ttft = fn(i)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if ttft is not None:
+                    ttfts.append(ttft)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+    wall = time.perf_counter() - start
+    return latencies, ttfts, errors, wall
+
+
+def summarize(name, load, rss_kb, **extra):
+    latencies, ttfts, errors, wall = load
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    result = {
+        "name": name,
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall > 0 else None,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(max(latencies) if latencies else None),
+        "ttft_p50_ms": ms(percentile(ttfts, 50)),
+        "ttft_p99_ms": ms(percentile(ttfts, 99)),
+        "peak_rss_mb": round(rss_kb / 1024, 1) if rss_kb else None,
+    }
+    if errors:
+        result["first_error"] = errors[0][:200]
+    result.update(extra)
+    return result
+
+
+# --- MCP -------------------------------------------------------------------
+
+def mcp_call(port, calls, parallel=False):
+    """POST /mcp; lanza excepcion si la peticion o alguna llamada devuelve error"""
+    body = json.dumps({"mcp": True, "parallel": parallel, "calls": calls})
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request("POST", "/mcp", body, {"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = json.loads(response.read())
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"HTTP {response.status}: {data}")
+    for item in data["results"]:
+        if isinstance(item["result"], dict) and "error" in item["result"]:
+            raise RuntimeError(f"{item['server']}/{item['tool']}: {item['result']['error']}")
+
+
+def bench_mcp(args):
+    tmpdir = tempfile.mkdtemp(prefix="mcp-bench-")
+    port = free_port()
+    env = dict(os.environ, MCP_NEON_PORT=str(port), PYTHONUNBUFFERED="1", MCP_NEON_WORKERS=str(args.workers))
+    if args.database_url:
+        env["DATABASE_URL"] = args.database_url
+        env["MCP_NEON_STORE"] = "neon"
+        store = "neon"
+    else:
+        # Vacia (y no ausente) para que dotenv no la rellene desde un .env
+        env["DATABASE_URL"] = ""
+        env["MCP_NEON_STORE"] = "local"
+        env["MCP_NEON_LOCAL_PATH"] = os.path.join(tmpdir, "reina_memory.sqlite3")
+        store = "local"
+    log = open(os.path.join(tmpdir, "server.log"), "w")
+    proc = subprocess.Popen([sys.executable, MCP_SERVER], cwd=tmpdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    session = f"bench-{os.getpid()}"
+    reina = lambda tool, **arguments: {"server": "reina", "tool": tool,
+                                       "arguments": dict(arguments, session_id=session)}
+    results = []
+    try:
+        wait_port(port, proc)
+        mcp_call(port, [reina("set_many", values={f"k{i}": {"i": i, "text": "x" * 200} for i in range(100)})])
+
+        scenarios = [
+            ("mcp.get_memory", lambda i: mcp_call(port, [reina("get_memory", key=f"k{i % 100}")])),
+            ("mcp.set_memory", lambda i: mcp_call(port, [reina("set_memory", key=f"k{i % 100}", value={"i": i})])),
+            ("mcp.get_many_20", lambda i: mcp_call(port, [reina("get_many", keys=[f"k{(i + j) % 100}" for j in range(20)])])),
+            ("mcp.run_code", lambda i: mcp_call(port, [{"server": "python", "tool": "run_code",
+                                                        "arguments": {"code": "print(sum(range(1000)))"}}])),
+            ("mcp.run_command", lambda i: mcp_call(port, [{"server": "shell", "tool": "run_command",
+                                                           "arguments": {"command": "echo bench"}}])),
+            ("mcp.batch_parallel_8", lambda i: mcp_call(port, [reina("get_memory", key=f"k{(i + j) % 100}")
+                                                               for j in range(8)], parallel=True)),
+        ]
+        for name, fn in scenarios:
+            if args.filter and args.filter not in name:
+                continue
+            # Calentamiento: conexiones del pool, workers python, caches
+            run_load(fn, min(20, args.requests), args.concurrency)
+            load = run_load(fn, args.requests, args.concurrency)
+            rss = tree_peak_rss_kb(proc.pid) if args.workers > 1 else peak_rss_kb(proc.pid)
+            results.append(summarize(name, load, rss, store=store, concurrency=args.concurrency,
+                                     workers=max(1, args.workers)))
+    finally:
+        stop(proc)
+        log.close()
+    return results
+
+
+# --- Claude / ChatGPT (procesos worker) ----------------------------------
+
+def start_fake_sse(args):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, FAKE_SSE, "--port", str(port), "--tokens", str(args.tokens),
+         "--token-size", str(args.token_size), "--rate", str(args.rate), "--ttft-ms", str(args.ttft_ms)],
+        stdout=subprocess.DEVNULL,
+    )
+    wait_port(port, proc)
+    return proc, f"http://127.0.0.1:{port}"
+
+
+def worker_claude(args):
+    sys.path.insert(0, CLAUDE_DIR)
+    from claude_api import ClaudeAPIClient, SessionData
+
+    client = ClaudeAPIClient(
+        SessionData("sessionKey=bench", "bench", "bench-org"),
+        pool_size=args.concurrency,
+        metadata_cache_path=None,
+        base_url=args.url,
+    )
+    client.timezone = "UTC"
+    chat_id = client.create_chat()
+
+    def once(i):
+        with client.stream_message(chat_id, f"bench {i}") as stream:
+            size = sum(len(delta) for delta in stream)
+        if stream.status_code != 200 or not size:
+            raise RuntimeError(f"HTTP {stream.status_code}")
+        return stream.ttft
+
+    run_load(once, min(10, args.requests), args.concurrency)
+    load = run_load(once, args.requests, args.concurrency)
+    client.close()
+    return summarize("claude.stream_message", load, peak_rss_kb(), concurrency=args.concurrency)
+
+
+def worker_chatgpt(args):
+    state_dir = tempfile.mkdtemp(prefix="chatgpt-bench-")
+    os.environ["CHATGPT_API_URL"] = args.url + "/backend-api/conversation"
+    os.environ["CHATGPT_STATE_PATH"] = os.path.join(state_dir, "state.json")
+    os.environ["CHATGPT_WRAPPER_WORKERS"] = str(args.concurrency)
+    sys.path.insert(0, CHATGPT_DIR)
+    import chatgpt_wrapper
+
+    # Sin cookie real: el servidor falso no comprueba el token
+    chatgpt_wrapper.get_secrets = lambda: {"session_token": "bench"}
+
+    def once(i):
+        start = time.perf_counter()
+        first = []
+        result = chatgpt_wrapper.send_to_chatgpt(
+            f"bench {i}", cache=False,
+            on_delta=lambda text: first or first.append(time.perf_counter() - start),
+        )
+        if not result.get("success"):
+            raise RuntimeError(result.get("error"))
+        return first[0] if first else None
+
+    run_load(once, min(10, args.requests), args.concurrency)
+    load = run_load(once, args.requests, args.concurrency)
+    return summarize("chatgpt.send_message", load, peak_rss_kb(), concurrency=args.concurrency)
+
+
+def bench_worker(kind, args, url):
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", kind, "--url", url,
+           "--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    out = subprocess.run(cmd, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f"worker {kind} fallo:\n{out.stderr[-2000:]}")
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    result.update(tokens=args.tokens, rate=args.rate, ttft_ms=args.ttft_ms)
+    return [result]
+
+
+# --- Informe y comparacion -------------------------------------------------
+
+COLUMNS = [("name", 24), ("requests", 8), ("errors", 6), ("throughput_rps", 10), ("p50_ms", 9),
+           ("p99_ms", 9), ("max_ms", 9), ("ttft_p50_ms", 11), ("ttft_p99_ms", 11), ("peak_rss_mb", 11)]
+
+
+def print_table(results):
+    print(" ".join(name.rjust(width) if i else name.ljust(width) for i, (name, width) in enumerate(COLUMNS)))
+    for r in results:
+        cells = []
+        for i, (name, width) in enumerate(COLUMNS):
+            value = r.get(name)
+            text = "-" if value is None else str(value)
+            cells.append(text.rjust(width) if i else text.ljust(width))
+        print(" ".join(cells))
+
+
+def compare(results, baseline, tolerance):
+    """Regresiones frente a baseline: menos throughput o mas latencia que la tolerancia"""
+    previous = {r["name"]: r for r in baseline.get("results", [])}
+    regressions = []
+    for r in results:
+        old = previous.get(r["name"])
+        if not old:
+            continue
+        if old.get("throughput_rps") and r.get("throughput_rps") is not None:
+            if r["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+                regressions.append(f"{r['name']}: throughput {old['throughput_rps']} -> {r['throughput_rps']} rps")
+        for metric in ("p50_ms", "p99_ms", "ttft_p50_ms", "peak_rss_mb"):
+            if old.get(metric) and r.get(metric) is not None and r[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{r['name']}: {metric} {old[metric]} -> {r[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks sin red del servidor MCP y los wrappers Claude/ChatGPT")
+    parser.add_argument("--only", choices=["mcp", "claude", "chatgpt"], action="append",
+                        help="escenarios a ejecutar (repetible; por defecto todos)")
+    parser.add_argument("--filter", default="", help="solo escenarios mcp cuyo nombre contenga este texto")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0, help="procesos worker del servidor MCP (prefork)")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="Postgres para el almacen NEON (por defecto SQLite embebido)")
+    parser.add_argument("--tokens", type=int, default=200, help="tokens por respuesta del SSE falso")
+    parser.add_argument("--token-size", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0, help="tokens/s del SSE falso (0 = sin pausa)")
+    parser.add_argument("--ttft-ms", type=float, default=50)
+    parser.add_argument("--output", help="guardar resultados en JSON")
+    parser.add_argument("--baseline", help="JSON de una ejecucion anterior con el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        result = worker_claude(args) if args.worker == "claude" else worker_chatgpt(args)
+        print(json.dumps(result))
+        return 0
+
+    selected = args.only or ["mcp", "claude", "chatgpt"]
+    results = []
+    if "mcp" in selected:
+        results += bench_mcp(args)
+    if "claude" in selected or "chatgpt" in selected:
+        fake, url = start_fake_sse(args)
+        try:
+            for kind in ("claude", "chatgpt"):
+                if kind in selected:
+                    results += bench_worker(kind, args, url)
+        finally:
+            stop(fake)
+
+    print_table(results)
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print("[REGRESION] " + line)
+        if regressions:
+            return 1
+    return 1 if any(r["errors"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
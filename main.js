@@ -177,6 +177,94 @@ const DEFAULT_MODEL = 'qwen3-omni-flash';
 
 // ============ MCP SERVER NEON - Memoria Persistente ============
 let neonMCPServer = null;
+const NEON_MCP_PORT = parseInt(process.env.MCP_NEON_PORT || '8765', 10);
+// Estado de /ready: el servidor abre el puerto al momento y prepara NEON en segundo plano
+let neonMCPStatus = { ready: false, pending: false };
+let neonMCPReady = Promise.resolve(false);
+
+// Consultar GET /ready del MCP Server NEON; resuelve { ready, ... } o null si no responde
+function fetchNeonReady(timeoutMs = 1000) {
+  return new Promise((resolve) => {
+    const http = require('http');
+    const req = http.get({ host: '127.0.0.1', port: NEON_MCP_PORT, path: '/ready', timeout: timeoutMs }, (res) => {
+      let body = '';
+      res.setEncoding('utf8');
+      res.on('data', (chunk) => { body += chunk; });
+      res.on('end', () => {
+        try {
+          resolve(JSON.parse(body));
+        } catch (e) {
+          resolve(null);
+        }
+      });
+    });
+    req.on('timeout', () => req.destroy());
+    req.on('error', () => resolve(null));
+  });
+}
+
+// Sondear /ready cada 100 ms hasta que el servidor pueda atender llamadas (o timeout)
+async function waitForNeonReady(proc, timeoutMs = 60000) {
+  const started = Date.now();
+  let lastError = null;
+  while (Date.now() - started < timeoutMs) {
+    if (neonMCPServer !== proc || proc.exitCode !== null) return false;
+    const status = await fetchNeonReady();
+    if (status && status.ready) {
+      neonMCPStatus = { ...status, pending: false };
+      console.log(`[Main] ✅ MCP Server NEON listo en ${Date.now() - started} ms (puerto ${NEON_MCP_PORT}, almacén ${status.store})`);
+      return true;
+    }
+    if (status && status.error && status.error !== lastError) {
+      lastError = status.error;
+      console.warn(`[Main] ⏳ MCP Server NEON aún no listo: ${status.error}`);
+    }
+    await new Promise((r) => setTimeout(r, 100));
+  }
+  neonMCPStatus = { ready: false, pending: false, error: lastError || 'timeout esperando /ready' };
+  console.warn(`[Main] ⚠️  MCP Server NEON no estuvo listo en ${timeoutMs} ms`);
+  return false;
+}
+
+// Llamar al MCP Server NEON (POST /mcp) solo cuando /ready lo confirma; si no, error sin enviar nada
+async function callNeonMCP(calls, options = {}) {
+  await neonMCPReady;
+  if (!neonMCPStatus.ready) {
+    return { success: false, error: neonMCPStatus.error || 'MCP Server NEON no disponible' };
+  }
+  const body = JSON.stringify({
+    mcp: true,
+    calls,
+    parallel: !!options.parallel,
+    ...(options.deadlineMs ? { deadline_ms: options.deadlineMs } : {})
+  });
+  return new Promise((resolve) => {
+    const http = require('http');
+    const req = http.request({
+      host: '127.0.0.1',
+      port: NEON_MCP_PORT,
+      path: '/mcp',
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Content-Length': Buffer.byteLength(body) }
+    }, (res) => {
+      let data = '';
+      res.setEncoding('utf8');
+      res.on('data', (chunk) => { data += chunk; });
+      res.on('end', () => {
+        try {
+          const parsed = JSON.parse(data);
+          resolve(res.statusCode === 200
+            ? { success: true, results: parsed.results }
+            : { success: false, error: parsed.error || `HTTP ${res.statusCode}` });
+        } catch (e) {
+          resolve({ success: false, error: `Respuesta inválida del MCP Server NEON (HTTP ${res.statusCode})` });
+        }
+      });
+    });
+    req.on('error', (e) => resolve({ success: false, error: e.message }));
+    req.end(body);
+  });
+}
 
 function startNeonMCPServer() {
   try {
@@ -189,13 +277,13 @@ function startNeonMCPServer() {
       return;
     }
 
-    // Verificar si DATABASE_URL está configurado
-    if (!process.env.DATABASE_URL) {
+    // Verificar si DATABASE_URL está configurado (el almacén local funciona sin ella)
+    if (!process.env.DATABASE_URL && process.env.MCP_NEON_STORE !== 'local') {
       console.warn('[Main] ⚠️ DATABASE_URL no configurada en variables de entorno');
-      console.warn('[Main] ⚠️ MCP Server NEON requiere DATABASE_URL para funcionar');
+      console.warn('[Main] ⚠️ MCP Server NEON requiere DATABASE_URL (o MCP_NEON_STORE=local) para funcionar');
       return;
     }
-    const DATABASE_URL = process.env.DATABASE_URL;
+    const DATABASE_URL = process.env.DATABASE_URL || '';
 
     console.log('[Main] 🚀 Iniciando MCP Server NEON...');
     neonMCPServer = spawn('python', [neonServerPath], {
@@ -218,12 +306,15 @@ function startNeonMCPServer() {
     });
 
     neonMCPServer.on('close', (code) => {
+      neonMCPStatus = { ready: false, pending: false, error: `terminado (código ${code})` };
       if (code !== 0 && code !== null) {
         console.warn(`[Main] ⚠️  MCP Server NEON terminó con código ${code}`);
       }
     });
 
-    console.log('[Main] ✅ MCP Server NEON iniciado en puerto 8765');
+    console.log(`[Main] 🚀 MCP Server NEON arrancando (pid ${neonMCPServer.pid}); esperando /ready...`);
+    neonMCPStatus = { ready: false, pending: true };
+    neonMCPReady = waitForNeonReady(neonMCPServer);
   } catch (e) {
     console.warn('[Main] ⚠️  No se pudo iniciar MCP Server NEON:', e.message);
   }
@@ -1285,6 +1376,22 @@ ipcMain.handle('mcp:listTools', async () => {
   return { success: true, tools: Object.keys(mcpServer.tools) };
 });
 
+// Estado del MCP Server NEON; con { wait: true } espera a que /ready responda
+ipcMain.handle('neon:ready', async (_e, options = {}) => {
+  if (options && options.wait) await neonMCPReady;
+  if (neonMCPStatus.ready) {
+    // Ya estuvo listo: confirmar que sigue respondiendo (NEON puede haberse caído)
+    const status = await fetchNeonReady();
+    if (status) neonMCPStatus = { ...status, pending: false };
+  }
+  return { ...neonMCPStatus, port: NEON_MCP_PORT };
+});
+
+ipcMain.handle('neon:call', async (_e, { calls, options } = {}) => {
+  if (!Array.isArray(calls)) return { success: false, error: 'calls debe ser una lista' };
+  return callNeonMCP(calls, options || {});
+});
+
 ipcMain.handle('mcp:getPort', async () => {
   return { success: true, port: mcpServer?.MCP_PORT || 19875 };
 });
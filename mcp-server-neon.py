@@ -5,11 +5,33 @@ Puerto: 8765
 Endpoint: /mcp
 Conecta con la base de datos PostgreSQL de NEON para almacenar memoria persistente de la Reina QWEN
 """
+import base64
+import codecs
+import contextvars
+import http.client
+import io
 import json
+import locale
+import mmap
 import os
+import queue
+import re
+import select
+import selectors
+import signal
+import socket
+import socketserver
+import sqlite3
 import sys
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from datetime import datetime
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from datetime import datetime, timezone
 
 # Cargar variables de entorno
 try:
@@ -28,35 +50,842 @@ except ImportError:
 
 # Obtener DATABASE_URL - URL real de NEON
 DATABASE_URL = os.getenv('DATABASE_URL')
-if not DATABASE_URL:
+
+# Almacen de reina_memory: 'neon' (cada acceso va a NEON) o 'local' (SQLite embebido como
+# primario de lecturas y escrituras, replicado a NEON en segundo plano; sin DATABASE_URL
+# funciona solo en local)
+MCP_STORE = os.getenv('MCP_NEON_STORE', 'neon').lower()
+MCP_LOCAL_PATH = os.getenv('MCP_NEON_LOCAL_PATH',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'sandra', 'reina_memory.sqlite3'))
+# Replicacion write-behind: espera para agrupar escrituras, filas por lote y cada cuantos
+# segundos se traen los cambios hechos en NEON por otras instancias
+MCP_REPLICATE_MS = int(os.getenv('MCP_NEON_REPLICATE_MS', 500))
+MCP_REPLICATE_BATCH = int(os.getenv('MCP_NEON_REPLICATE_BATCH', 500))
+MCP_PULL_INTERVAL = float(os.getenv('MCP_NEON_PULL_INTERVAL', 30))
+
+if not DATABASE_URL and MCP_STORE != 'local':
     print("[ERROR] DATABASE_URL no encontrado en variables de entorno")
-    print("   Por favor configura DATABASE_URL en tu archivo .env")
+    print("   Por favor configura DATABASE_URL en tu archivo .env (o usa MCP_NEON_STORE=local)")
     sys.exit(1)
 
 MCP_PORT = int(os.getenv('MCP_NEON_PORT', 8765))
 
-# Importar psycopg2
-try:
-    import psycopg2
-    from psycopg2.extras import Json
-except ImportError:
-    print("[ERROR] psycopg2 no instalado")
-    print("   Ejecuta: pip install psycopg2-binary")
-    sys.exit(1)
+# Modo de servicio: 'threaded' (un hilo por conexion) o 'single' (secuencial, legacy)
+MCP_MODE = os.getenv('MCP_NEON_MODE', 'threaded').lower()
+
+# Cola de conexiones pendientes del socket (listen). La de socketserver (5) se desborda con
+# pocos clientes concurrentes y el cliente espera el reintento del SYN (1 s)
+MCP_BACKLOG = int(os.getenv('MCP_NEON_BACKLOG', 128))
+# /ready vuelve a comprobar NEON con SELECT 1 como mucho cada N segundos
+MCP_READY_CHECK = float(os.getenv('MCP_NEON_READY_CHECK', 5))
+
+# Modo prefork (POSIX con SO_REUSEPORT): un supervisor lanza N procesos worker que escuchan en
+# el mismo puerto y el kernel les reparte las conexiones. Cada worker tiene su propio pool NEON,
+# cache, cola de escrituras y workers de Python (los limites de este archivo son por worker).
+# Las caches de reina_memory de los workers solo se mantienen coherentes con LISTEN/NOTIFY:
+# con MCP_NEON_CACHE_LISTEN=0 la cache se desactiva en prefork. 0/1 = un solo proceso
+MCP_WORKERS = int(os.getenv('MCP_NEON_WORKERS', 0))
+# Reciclar un worker tras N peticiones /mcp (0 = nunca); el supervisor arranca el relevo antes
+MCP_WORKER_MAX_REQUESTS = int(os.getenv('MCP_NEON_WORKER_MAX_REQUESTS', 0))
+# Al parar o reciclar un worker: espera maxima (s) a sus peticiones y trabajos en curso
+MCP_DRAIN_TIMEOUT = float(os.getenv('MCP_NEON_DRAIN_TIMEOUT', 30))
+# Hueco (0..N-1) de este proceso si lo lanzo el supervisor; None fuera del modo prefork
+MCP_WORKER_SLOT = int(os.environ['MCP_NEON_WORKER_SLOT']) if os.getenv('MCP_NEON_WORKER_SLOT') else None
+# Sockets Unix internos de los workers (worker-<pid>.sock) para reenviarse llamadas
+MCP_RUN_DIR = os.getenv('MCP_NEON_RUN_DIR', os.path.join(tempfile.gettempdir(), 'mcp-neon-' + str(MCP_PORT)))
+
+# Hilos para ejecutar en paralelo las llamadas de un mismo lote ("parallel": true)
+MCP_CALL_WORKERS = int(os.getenv('MCP_NEON_CALL_WORKERS', 8))
+
+# Plazo por defecto de una peticion /mcp en ms (0 = sin plazo); el cliente puede fijar el suyo
+# con "deadline_ms" en el cuerpo o la cabecera X-Request-Deadline-Ms, y se reparte entre sus llamadas
+MCP_REQUEST_DEADLINE_MS = int(os.getenv('MCP_NEON_REQUEST_DEADLINE_MS', 0))
+# Cada cuanto se comprueba si el cliente de una peticion en curso cerro la conexion (0 = nunca)
+MCP_CLIENT_WATCH_MS = int(os.getenv('MCP_NEON_CLIENT_WATCH_MS', 200))
+
+# Pool de conexiones a NEON
+MCP_POOL_MIN = int(os.getenv('MCP_NEON_POOL_MIN', 1))
+MCP_POOL_MAX = int(os.getenv('MCP_NEON_POOL_MAX', 10))
+# Segundos maximos esperando una conexion libre
+MCP_POOL_TIMEOUT = float(os.getenv('MCP_NEON_POOL_TIMEOUT', 10))
+# Conexiones inactivas mas de N segundos se verifican con SELECT 1 antes de usarse
+MCP_POOL_IDLE_CHECK = float(os.getenv('MCP_NEON_POOL_IDLE_CHECK', 30))
+# Sentencias preparadas (PREPARE/EXECUTE) para las consultas calientes. Se desactivan por
+# defecto con el endpoint -pooler de NEON (PgBouncer en modo transaccion no las conserva)
+MCP_PREPARE = os.getenv('MCP_NEON_PREPARE', '0' if '-pooler' in (DATABASE_URL or '') else '1') == '1'
+
+# Cache LRU+TTL de lecturas de reina_memory (0 entradas = desactivada)
+MCP_CACHE_SIZE = int(os.getenv('MCP_NEON_CACHE_SIZE', 1024))
+MCP_CACHE_TTL = float(os.getenv('MCP_NEON_CACHE_TTL', 60))
+# Invalidar la cache con LISTEN/NOTIFY cuando otra instancia escribe. Activado, la cache solo
+# sirve lecturas mientras la escucha esta conectada; a 0 (una sola instancia) confia en el TTL
+MCP_CACHE_LISTEN = os.getenv('MCP_NEON_CACHE_LISTEN', '1') == '1'
+
+# Endpoint /metrics (formato de texto Prometheus) y log de accesos en JSON por stderr
+MCP_METRICS = os.getenv('MCP_NEON_METRICS', '1') == '1'
+MCP_ACCESS_LOG = os.getenv('MCP_NEON_ACCESS_LOG', '0') == '1'
+
+# Tamano de los fragmentos emitidos en modo streaming (NDJSON)
+MCP_STREAM_CHUNK = int(os.getenv('MCP_NEON_STREAM_CHUNK', 65536))
+
+# Lecturas por rango de fs/read_file: maximo de bytes por respuesta y umbral para usar mmap
+MCP_READ_MAX = int(os.getenv('MCP_NEON_READ_MAX', 8 * 1024 * 1024))
+MCP_MMAP_THRESHOLD = int(os.getenv('MCP_NEON_MMAP_THRESHOLD', 1024 * 1024))
+
+# Pool de interpretes Python precalentados para python/run_code (0 = proceso nuevo por llamada)
+MCP_PYWORKERS = int(os.getenv('MCP_NEON_PYWORKERS', 2))
+# Reciclar cada worker tras N trabajos (el estado de modulos persiste entre trabajos)
+MCP_PYWORKER_MAX_JOBS = int(os.getenv('MCP_NEON_PYWORKER_MAX_JOBS', 100))
+# Modulos importados al arrancar cada worker, separados por comas (p.ej. "json,re,math")
+MCP_PYWORKER_PRELOAD = [m.strip() for m in os.getenv('MCP_NEON_PYWORKER_PRELOAD', '').split(',') if m.strip()]
+# Limites por worker (POSIX): memoria virtual en MB y segundos de CPU por trabajo (0 = sin limite)
+MCP_PYWORKER_MEM_MB = int(os.getenv('MCP_NEON_PYWORKER_MEM_MB', 0))
+MCP_PYWORKER_CPU_S = int(os.getenv('MCP_NEON_PYWORKER_CPU_S', 30))
+
+# Trabajos asincronos (jobs/*): concurrentes, en cola, buffer de salida por stream y retenidos
+MCP_MAX_JOBS = int(os.getenv('MCP_NEON_MAX_JOBS', 4))
+MCP_JOB_QUEUE_MAX = int(os.getenv('MCP_NEON_JOB_QUEUE_MAX', 100))
+MCP_JOB_BUFFER = int(os.getenv('MCP_NEON_JOB_BUFFER', 1024 * 1024))
+MCP_JOB_RETAIN = int(os.getenv('MCP_NEON_JOB_RETAIN', 100))
+MCP_JOB_TIMEOUT_MS = int(os.getenv('MCP_NEON_JOB_TIMEOUT_MS', 3600 * 1000))
+
+# Agrupar escrituras de reina/set_memory y set_many durante N ms (0 = cada llamada confirma
+# al momento). Dentro de la ventana solo se escribe el ultimo valor de cada (session_id, key)
+MCP_WRITE_COALESCE_MS = int(os.getenv('MCP_NEON_WRITE_COALESCE_MS', 0))
+# Con mas claves pendientes que esto se vuelca sin esperar al final de la ventana
+MCP_WRITE_COALESCE_MAX = int(os.getenv('MCP_NEON_WRITE_COALESCE_MAX', 10000))
+
+# Tamano de pagina por defecto y maximo de reina/list_keys
+MCP_LIST_LIMIT = int(os.getenv('MCP_NEON_LIST_LIMIT', 100))
+MCP_LIST_LIMIT_MAX = int(os.getenv('MCP_NEON_LIST_LIMIT_MAX', 1000))
+
+# Identificador de esta instancia; viaja como application_name en las notificaciones
+INSTANCE_ID = "mcp-neon-" + uuid.uuid4().hex[:12]
+
+# psycopg2 se importa en el primer uso (load_psycopg2): el puerto se abre sin esperarlo
+# y el almacen local sin DATABASE_URL no llega a cargarlo
+psycopg2 = None
+execute_values = None
+NeonConnection = None
+_psycopg2_lock = threading.Lock()
+
+def load_psycopg2():
+    """Importar psycopg2 y definir NeonConnection (una sola vez, seguro entre hilos)"""
+    global psycopg2, execute_values, NeonConnection
+    if NeonConnection is not None:
+        return psycopg2
+    with _psycopg2_lock:
+        if NeonConnection is None:
+            try:
+                import psycopg2.extensions
+                import psycopg2.extras
+            except ImportError:
+                raise RuntimeError("psycopg2 no instalado. Ejecuta: pip install psycopg2-binary")
+            execute_values = psycopg2.extras.execute_values
+            
+            class _NeonConnection(psycopg2.extensions.connection):
+                """Conexion del pool: recuerda sentencias preparadas y ultimo uso"""
+                
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    self.prepared = set()
+                    self.last_used = time.monotonic()
+            
+            NeonConnection = _NeonConnection
+    return psycopg2
+
+class Json:
+    """Parametro JSONB. Se adapta con psycopg2.extras.Json al enviarse (con una conexion
+    abierta psycopg2 ya esta cargado), asi construirlo no obliga a importar psycopg2"""
+    
+    def __init__(self, adapted):
+        self.adapted = adapted
+    
+    def __conform__(self, proto):
+        return psycopg2.extras.Json(self.adapted).__conform__(proto)
+
+# Buckets (segundos) de los histogramas de latencia
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+    """Contadores, gauges e histogramas en memoria, exportados en formato de texto Prometheus.
+    Cada serie se identifica por (nombre, etiquetas) con las etiquetas como tupla de pares."""
+    
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._values = {}
+        self._histograms = {}
+    
+    def describe(self, name, kind, text):
+        self._meta[name] = (kind, text)
+    
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._values[(name, labels)] = self._values.get((name, labels), 0) + value
+    
+    def dec(self, name, labels=(), value=1):
+        self.inc(name, labels, -value)
+    
+    def observe(self, name, labels, value):
+        with self._lock:
+            hist = self._histograms.get((name, labels))
+            if hist is None:
+                # Un contador por bucket (no acumulados) + suma + total
+                hist = self._histograms[(name, labels)] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+                    break
+            hist[-2] += value
+            hist[-1] += 1
+    
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = tuple(labels) + tuple(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+        return "{" + ",".join(k + '="' + v + '"' for (k, _), v in zip(pairs, escaped)) + "}"
+    
+    def render(self, gauges=()):
+        """Texto de exposicion; gauges son (nombre, etiquetas, valor) calculados al vuelo"""
+        with self._lock:
+            values = sorted(self._values.items())
+            histograms = sorted((k, list(v)) for k, v in self._histograms.items())
+        series = {}
+        for (name, labels), value in values:
+            series.setdefault(name, []).append(name + self._labels(labels) + " " + repr(value))
+        for name, labels, value in gauges:
+            series.setdefault(name, []).append(name + self._labels(labels) + " " + repr(value))
+        # Los buckets de cada serie van en orden creciente de `le`, seguidos de _sum y _count
+        for (name, labels), hist in histograms:
+            lines = series.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets, hist):
+                cumulative += count
+                lines.append(name + "_bucket" + self._labels(labels, (("le", repr(float(bound))),)) + " " + str(cumulative))
+            lines.append(name + "_bucket" + self._labels(labels, (("le", "+Inf"),)) + " " + str(hist[-1]))
+            lines.append(name + "_sum" + self._labels(labels) + " " + repr(round(hist[-2], 6)))
+            lines.append(name + "_count" + self._labels(labels) + " " + str(hist[-1]))
+        out = []
+        for name in sorted(series):
+            kind, text = self._meta.get(name, ("untyped", ""))
+            out.append("# HELP " + name + " " + text)
+            out.append("# TYPE " + name + " " + kind)
+            out.extend(series[name])
+        return "\n".join(out) + "\n"
+
+metrics = Metrics(METRICS_BUCKETS)
+for _name, _kind, _text in (
+    ("mcp_neon_calls_total", "counter", "Llamadas MCP ejecutadas por server/tool"),
+    ("mcp_neon_call_errors_total", "counter", "Llamadas MCP que devolvieron error"),
+    ("mcp_neon_call_duration_seconds", "histogram", "Duracion de cada llamada MCP"),
+    ("mcp_neon_call_db_seconds", "histogram", "Tiempo de base de datos dentro de cada llamada"),
+    ("mcp_neon_call_subprocess_seconds", "histogram", "Tiempo en subprocesos (python/shell) dentro de cada llamada"),
+    ("mcp_neon_calls_in_flight", "gauge", "Llamadas MCP en ejecucion"),
+    ("mcp_neon_http_requests_total", "counter", "Peticiones HTTP por metodo, ruta y codigo"),
+    ("mcp_neon_http_requests_in_flight", "gauge", "Peticiones HTTP en curso"),
+    ("mcp_neon_http_request_duration_seconds", "histogram", "Duracion de cada peticion HTTP"),
+    ("mcp_neon_http_request_bytes_total", "counter", "Bytes recibidos en cuerpos de peticion"),
+    ("mcp_neon_http_response_bytes_total", "counter", "Bytes enviados en cuerpos de respuesta"),
+    ("mcp_neon_pool_connections", "gauge", "Conexiones del pool NEON por estado"),
+    ("mcp_neon_pool_wait_seconds_total", "counter", "Tiempo total esperando una conexion del pool"),
+    ("mcp_neon_cache_lookups_total", "counter", "Lecturas de la cache de reina_memory por resultado"),
+    ("mcp_neon_pending_writes", "gauge", "Escrituras de reina_memory aun no confirmadas (cola o replicacion)"),
+    ("mcp_neon_calls_cancelled_total", "counter", "Llamadas MCP omitidas o cortadas por plazo agotado o desconexion"),
+):
+    metrics.describe(_name, _kind, _text)
+
+# Tiempos de la llamada MCP en curso ({"db": s, "subprocess": s}); cada hilo de
+# call_executor tiene su propio contexto, asi las llamadas en paralelo no se mezclan
+call_timing = contextvars.ContextVar('call_timing', default=None)
+
+@contextmanager
+def timed(kind):
+    """Sumar la duracion del bloque al tiempo `kind` de la llamada en curso"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing = call_timing.get()
+        if timing is not None:
+            timing[kind] += time.perf_counter() - start
+
+class DeadlineExceeded(Exception):
+    pass
+
+class RequestBudget:
+    """Plazo de una peticion /mcp, compartido por todas sus llamadas, y cancelacion del
+    trabajo en curso (subprocesos, consultas) cuando el cliente se desconecta"""
+    
+    def __init__(self, deadline_ms):
+        self.deadline = time.monotonic() + deadline_ms / 1000 if deadline_ms > 0 else None
+        self.cancelled = None
+        self._lock = threading.Lock()
+        self._cancels = {}
+        self._seq = 0
+    
+    def remaining(self):
+        """Segundos que quedan del plazo (None si no hay plazo)"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+    
+    def expired(self):
+        return self.cancelled is not None or (self.deadline is not None and time.monotonic() >= self.deadline)
+    
+    def error(self):
+        if self.cancelled is not None:
+            return {"error": "cancelled", "detail": self.cancelled}
+        return {"error": "deadline_exceeded"}
+    
+    def clamp_ms(self, timeout_ms):
+        """timeout_ms de una llamada recortado a lo que queda del plazo"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout_ms
+        return min(timeout_ms, max(1, remaining * 1000))
+    
+    @contextmanager
+    def cancellable(self, cancel):
+        """Registrar cancel() mientras dura el bloque; cancel() la invoca si el cliente se va"""
+        with self._lock:
+            self._seq += 1
+            token = self._seq
+            late = self.cancelled is not None
+            if not late:
+                self._cancels[token] = cancel
+        if late:
+            cancel()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._cancels.pop(token, None)
+    
+    def cancel(self, reason):
+        """Cancelar la peticion: las llamadas pendientes no empiezan y las en curso se cortan"""
+        with self._lock:
+            if self.cancelled is not None:
+                return
+            self.cancelled = reason
+            cancels = list(self._cancels.values())
+            self._cancels.clear()
+        for cancel in cancels:
+            try:
+                cancel()
+            except Exception as e:
+                print("[WARN] Error cancelando trabajo de la peticion: " + str(e))
+
+# Presupuesto de la peticion en curso; instrumented() lo fija en cada hilo de llamada
+call_budget = contextvars.ContextVar('call_budget', default=None)
+
+def budget_ms(timeout_ms):
+    """timeout_ms recortado al plazo de la peticion en curso"""
+    budget = call_budget.get()
+    return budget.clamp_ms(timeout_ms) if budget is not None else timeout_ms
+
+@contextmanager
+def cancellable(cancel):
+    """Como RequestBudget.cancellable para la peticion en curso (sin peticion, no hace nada)"""
+    budget = call_budget.get()
+    if budget is None:
+        yield
+        return
+    with budget.cancellable(cancel):
+        yield
+
+class ClientWatcher:
+    """Un solo hilo vigila los sockets de las peticiones /mcp en curso y cancela su
+    RequestBudget si el cliente cierra la conexion (EOF o reset). Usa un selector
+    persistente (epoll/kqueue/poll): sin el limite de FD_SETSIZE de select()."""
+    
+    def __init__(self, interval):
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._selector = selectors.DefaultSelector()
+        self._thread = None
+        self.disconnects = 0
+    
+    def watch(self, sock, budget):
+        with self._cond:
+            try:
+                self._selector.register(sock, selectors.EVENT_READ, budget)
+            except (OSError, ValueError, KeyError):
+                # Socket ya invalido o registrado: no se vigila (la peticion sigue igual)
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='mcp-client-watch', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+    
+    def unwatch(self, sock):
+        with self._cond:
+            self._forget(sock)
+    
+    def _forget(self, sock):
+        """Quitar sock del selector; devuelve su RequestBudget o None si ya no estaba"""
+        try:
+            return self._selector.unregister(sock).data
+        except (KeyError, ValueError, OSError):
+            return None
+    
+    def _disconnected(self, budget):
+        self.disconnects += 1
+        budget.cancel("cliente desconectado")
+    
+    def _drop_broken(self):
+        """El selector fallo: quitar solo los sockets ya cerrados y cancelar sus peticiones"""
+        with self._cond:
+            broken = [key for key in list(self._selector.get_map().values()) if key.fileobj.fileno() < 0]
+            for key in broken:
+                self._forget(key.fileobj)
+        for key in broken:
+            self._disconnected(key.data)
+        if not broken:
+            time.sleep(self.interval)
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._selector.get_map():
+                    self._cond.wait()
+            try:
+                events = self._selector.select(self.interval)
+            except (OSError, ValueError):
+                self._drop_broken()
+                continue
+            for key, _ in events:
+                sock = key.fileobj
+                try:
+                    gone = not sock.recv(1, socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0))
+                except BlockingIOError:
+                    # Falso aviso (el fd se reutilizo entre select y recv): se sigue vigilando
+                    continue
+                except (OSError, ValueError):
+                    gone = True
+                with self._cond:
+                    budget = self._forget(sock)
+                # Con datos pendientes (otra peticion en la misma conexion) se deja de vigilar
+                if gone and budget is not None:
+                    self._disconnected(budget)
+
+client_watcher = ClientWatcher(MCP_CLIENT_WATCH_MS / 1000.0)
 
 def get_neon_conn():
     """Obtener conexion a NEON"""
     try:
-        return psycopg2.connect(DATABASE_URL)
+        return load_psycopg2().connect(DATABASE_URL)
     except Exception as e:
         print("[ERROR] Error conectando a NEON: " + str(e))
         raise
 
+# Sentencias preparadas para las consultas calientes: nombre -> (tipos, SQL)
+PREPARED_STATEMENTS = {
+    "reina_get_memory": ("text, text", """
+        SELECT value, version FROM reina_memory
+        WHERE session_id = $1 AND key = $2
+        ORDER BY updated_at DESC LIMIT 1
+    """),
+    "reina_set_memory": ("text, text, jsonb", """
+        INSERT INTO reina_memory (session_id, key, value)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (session_id, key)
+        DO UPDATE SET value = EXCLUDED.value, version = reina_memory.version + 1, updated_at = NOW()
+        RETURNING version
+    """),
+}
+
+# Se apaga en caliente si el servidor resulta no conservar las sentencias preparadas
+prepare_enabled = MCP_PREPARE
+
+class PreparedStatementsUnsupported(Exception):
+    """PREPARE/EXECUTE fallo (PgBouncer en modo transaccion); NeonPool.run reintenta sin preparar"""
+
+def execute_prepared(cur, name, params):
+    """Ejecutar una sentencia preparada, preparandola en la conexion si hace falta.
+    Con las sentencias preparadas desactivadas se ejecuta el mismo SQL directamente."""
+    global prepare_enabled
+    types, sql = PREPARED_STATEMENTS[name]
+    if not prepare_enabled:
+        # $1, $2... aparecen en orden en estas consultas
+        cur.execute(re.sub(r"\$\d+", "%s", sql), params)
+        return
+    conn = cur.connection
+    try:
+        if name not in conn.prepared:
+            cur.execute("PREPARE " + name + "(" + types + ") AS " + sql)
+            conn.prepared.add(name)
+        placeholders = ", ".join(["%s"] * len(params))
+        cur.execute("EXECUTE " + name + "(" + placeholders + ")", params)
+    except psycopg2.Error as e:
+        # 26000: prepared statement does not exist / 42P05: already exists
+        if e.pgcode not in ("26000", "42P05"):
+            raise
+        prepare_enabled = False
+        print("[WARN] El servidor no conserva sentencias preparadas (pooler?); se desactivan: " + str(e).strip())
+        raise PreparedStatementsUnsupported(str(e))
+
+class PoolTimeout(Exception):
+    """No hubo conexion libre dentro de MCP_NEON_POOL_TIMEOUT"""
+
+class NeonPool:
+    """Pool acotado de conexiones a NEON con health checks y reconexion"""
+    
+    def __init__(self, dsn, minconn, maxconn, timeout, idle_check):
+        self.dsn = dsn
+        self.minconn = max(0, minconn)
+        self.maxconn = max(1, maxconn, self.minconn)
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+    
+    def _connect(self):
+        load_psycopg2()
+        return psycopg2.connect(
+            self.dsn,
+            connection_factory=NeonConnection,
+            application_name=INSTANCE_ID,
+            keepalives=1,
+            keepalives_idle=30,
+        )
+    
+    def _is_alive(self, conn):
+        """Comprobar una conexion que lleva tiempo inactiva (NEON suspende computes)"""
+        if conn.closed:
+            return False
+        if time.monotonic() - conn.last_used < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+    
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def warm(self):
+        """Abrir las conexiones minimas por adelantado"""
+        with self._cond:
+            missing = self.minconn - self._size
+            self._size += max(0, missing)
+        for _ in range(max(0, missing)):
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.created += 1
+                self._idle.append(conn)
+                self._cond.notify()
+    
+    def getconn(self, timeout=None):
+        start = time.monotonic()
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = start + timeout
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout("Sin conexiones libres en el pool NEON tras " + str(round(timeout, 3)) + "s")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self.created += 1
+            elif not self._is_alive(conn):
+                self.putconn(conn, discard=True)
+                continue
+            waited = time.monotonic() - start
+            with self._cond:
+                self.checkouts += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            return conn
+    
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+        if discard or conn.closed:
+            self._close(conn)
+            with self._cond:
+                self._size -= 1
+                self.discarded += 1
+                self._cond.notify()
+            return
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+    
+    def run(self, fn):
+        """Ejecutar fn(conn) en una transaccion; si la conexion estaba caida
+        (timeout de red, compute de NEON suspendido) se reintenta una vez.
+        Dentro de una peticion /mcp la espera y statement_timeout salen de lo que queda
+        de su plazo, y si el cliente se desconecta la consulta se cancela."""
+        budget = call_budget.get()
+        with timed("db"):
+            for attempt in (1, 2):
+                remaining = budget.remaining() if budget is not None else None
+                if budget is not None and budget.expired():
+                    raise DeadlineExceeded(budget.error()["error"])
+                conn = self.getconn(remaining)
+                try:
+                    if budget is None:
+                        result = fn(conn)
+                    else:
+                        with budget.cancellable(conn.cancel):
+                            if remaining is not None:
+                                # Lo que queda tras esperar conexion en el pool
+                                with conn.cursor() as cur:
+                                    cur.execute("SET LOCAL statement_timeout = %d" % max(1, int(budget.remaining() * 1000)))
+                            result = fn(conn)
+                    conn.commit()
+                except psycopg2.extensions.QueryCanceledError:
+                    self.putconn(conn)
+                    if budget is not None and budget.expired():
+                        raise DeadlineExceeded(budget.error()["error"])
+                    raise
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    broken = bool(conn.closed)
+                    self.putconn(conn, discard=broken)
+                    if broken and attempt == 1:
+                        print("[WARN] Conexion NEON perdida, reintentando: " + str(e).strip())
+                        continue
+                    raise
+                except PreparedStatementsUnsupported:
+                    self.putconn(conn)
+                    if attempt == 1:
+                        continue
+                    raise
+                except Exception:
+                    self.putconn(conn)
+                    raise
+                self.putconn(conn)
+                return result
+    
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._size - len(self._idle),
+                "min": self.minconn,
+                "max": self.maxconn,
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "created": self.created,
+                "discarded": self.discarded,
+                "wait_ms_total": round(self.wait_total * 1000, 3),
+                "wait_ms_avg": round(self.wait_total * 1000 / self.checkouts, 3) if self.checkouts else 0.0,
+                "wait_ms_max": round(self.wait_max * 1000, 3),
+            }
+
+neon_pool = NeonPool(DATABASE_URL, MCP_POOL_MIN, MCP_POOL_MAX, MCP_POOL_TIMEOUT, MCP_POOL_IDLE_CHECK)
+
+class MemoryCache:
+    """Cache LRU+TTL de reina_memory indexada por (session_id, key).
+    Guarda tambien las claves inexistentes (valor None, version 0). Cada entrada
+    lleva la version de la fila: un valor con version menor que la guardada se
+    ignora, asi dos escrituras concurrentes no dejan la mas antigua en cache.
+    Con `coherent` a False (sin LISTEN activo) no guarda ni sirve nada: otra
+    instancia podria haber escrito sin que nos enteremos."""
+    
+    def __init__(self, max_entries, ttl, coherent):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.coherent = coherent
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Se incrementa en cada escritura/invalidacion para descartar lecturas obsoletas
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+    
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.coherent
+    
+    def set_coherent(self, coherent):
+        """Activar/desactivar segun el estado de LISTEN; al cambiar se vacia la cache"""
+        self.coherent = coherent
+        self.clear()
+    
+    def epoch(self):
+        return self._epoch
+    
+    def get(self, session_id, key):
+        """Devuelve (encontrado, valor)"""
+        if not self.enabled:
+            return False, None
+        k = (session_id, key)
+        with self._lock:
+            entry = self._data.get(k)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            value, version, expires = entry
+            if time.monotonic() >= expires:
+                del self._data[k]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+            self._data.move_to_end(k)
+            self.hits += 1
+            return True, value
+    
+    def _store(self, k, value, version):
+        current = self._data.get(k)
+        if current is not None and current[1] > version:
+            return
+        self._data[k] = (value, version, time.monotonic() + self.ttl)
+        self._data.move_to_end(k)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+    
+    def put(self, session_id, key, value, version):
+        """Write-through tras una escritura confirmada en NEON (version = RETURNING version)"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._epoch += 1
+            self._store((session_id, key), value, version)
+    
+    def fill(self, session_id, key, value, version, epoch):
+        """Guardar un valor leido de NEON salvo que haya habido escrituras desde epoch"""
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._epoch == epoch:
+                self._store((session_id, key), value, version)
+    
+    def invalidate(self, session_id, key):
+        with self._lock:
+            self._epoch += 1
+            if self._data.pop((session_id, key), None) is not None:
+                self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+    
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "coherent": self.coherent,
+                "entries": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl_s": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+# Sin LISTEN la cache solo es segura en un unico proceso (en prefork escriben los demas workers)
+memory_cache = MemoryCache(MCP_CACHE_SIZE, MCP_CACHE_TTL,
+                           coherent=not MCP_CACHE_LISTEN and MCP_WORKER_SLOT is None)
+
+def listen_reina_memory():
+    """Hilo que escucha NOTIFY reina_memory e invalida la cache local. La cache solo
+    funciona mientras la escucha esta conectada; si se pierde se vacia y se desactiva
+    (pudo perder notificaciones) hasta reconectar."""
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            conn = load_psycopg2().connect(DATABASE_URL, application_name=INSTANCE_ID + "-listen")
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("LISTEN reina_memory")
+            memory_cache.set_coherent(True)
+            backoff = 1
+            while True:
+                if select.select([conn], [], [], 30) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        payload = json.loads(notify.payload)
+                    except ValueError:
+                        memory_cache.clear()
+                        continue
+                    # Nuestras propias escrituras ya actualizaron la cache (write-through)
+                    if payload.get("origin") != INSTANCE_ID:
+                        memory_cache.invalidate(payload.get("session_id"), payload.get("key"))
+        except Exception as e:
+            print("[WARN] LISTEN reina_memory interrumpido (cache desactivada): " + str(e).strip())
+            memory_cache.set_coherent(False)
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+        time.sleep(backoff)
+        backoff = min(backoff * 2, 30)
+
+# Clave del advisory lock que serializa el DDL de init_reina_memory
+REINA_DDL_LOCK = 0x7265696e61
+
+# Se activa cuando el trigger NOTIFY de reina_memory esta instalado (invalidacion entre instancias)
+reina_notify_installed = threading.Event()
+
 def init_reina_memory():
     """Inicializar tabla en NEON (si no existe)"""
     try:
         with get_neon_conn() as conn:
             with conn.cursor() as cur:
+                # Varias instancias (o workers prefork) arrancando a la vez: el DDL concurrente
+                # falla con "tuple concurrently updated", asi que se serializa
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (REINA_DDL_LOCK,))
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS reina_memory (
                         id SERIAL PRIMARY KEY,
@@ -68,49 +897,1849 @@ def init_reina_memory():
                     );
                     CREATE INDEX IF NOT EXISTS idx_session_key ON reina_memory(session_id, key);
                     CREATE INDEX IF NOT EXISTS idx_updated_at ON reina_memory(updated_at DESC);
+                    
+                    -- Version para concurrencia optimista (expected_version)
+                    ALTER TABLE reina_memory ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1;
                 """)
                 conn.commit()
         print("[OK] Tabla reina_memory verificada/creada en NEON")
-        return True
     except Exception as e:
         print("Advertencia al inicializar tabla: " + str(e))
         return False
+    
+    # Funcion de merge y trigger NOTIFY: en su propia transaccion para que un fallo aqui
+    # no deshaga la tabla ni la columna version
+    try:
+        with get_neon_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (REINA_DDL_LOCK,))
+                cur.execute("""
+                    -- Merge profundo de objetos JSONB para reina/merge_memory
+                    CREATE OR REPLACE FUNCTION reina_jsonb_deep_merge(a jsonb, b jsonb) RETURNS jsonb AS $$
+                    DECLARE
+                        result jsonb := a;
+                        k text;
+                        v jsonb;
+                    BEGIN
+                        IF jsonb_typeof(a) IS DISTINCT FROM 'object' OR jsonb_typeof(b) IS DISTINCT FROM 'object' THEN
+                            RETURN b;
+                        END IF;
+                        FOR k, v IN SELECT * FROM jsonb_each(b) LOOP
+                            IF result ? k THEN
+                                result := result || jsonb_build_object(k, reina_jsonb_deep_merge(result -> k, v));
+                            ELSE
+                                result := result || jsonb_build_object(k, v);
+                            END IF;
+                        END LOOP;
+                        RETURN result;
+                    END $$ LANGUAGE plpgsql IMMUTABLE;
+                    
+                    -- Notificar cambios para invalidar caches de otras instancias
+                    CREATE OR REPLACE FUNCTION reina_memory_notify() RETURNS trigger AS $$
+                    DECLARE r RECORD;
+                    BEGIN
+                        IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+                        PERFORM pg_notify('reina_memory', json_build_object(
+                            'session_id', r.session_id,
+                            'key', r.key,
+                            'origin', current_setting('application_name', true)
+                        )::text);
+                        RETURN NULL;
+                    END $$ LANGUAGE plpgsql;
+                    CREATE OR REPLACE TRIGGER reina_memory_notify
+                        AFTER INSERT OR UPDATE OR DELETE ON reina_memory
+                        FOR EACH ROW EXECUTE FUNCTION reina_memory_notify();
+                """)
+                conn.commit()
+        reina_notify_installed.set()
+    except Exception as e:
+        print("[WARN] No se pudo crear reina_jsonb_deep_merge / trigger reina_memory_notify: " + str(e).strip()
+              + " (merge_memory puede fallar y la cache no se invalida entre instancias)")
+    return True
+
+def json_deep_merge(a, b):
+    """Equivalente en Python de reina_jsonb_deep_merge"""
+    if not isinstance(a, dict) or not isinstance(b, dict):
+        return b
+    result = dict(a)
+    for k, v in b.items():
+        result[k] = json_deep_merge(result[k], v) if k in result else v
+    return result
+
+def json_concat(a, b):
+    """Equivalente de `a || b` en JSONB (b es siempre un objeto)"""
+    if isinstance(a, dict):
+        return dict(a, **b)
+    if isinstance(a, list):
+        return a + [b]
+    return [a, b]
+
+def _json_index(part, position):
+    try:
+        return int(part)
+    except ValueError:
+        raise ValueError("path element at position " + str(position) + " is not an integer: \"" + part + "\"")
+
+def json_set(doc, path, value, create_missing):
+    """Equivalente de jsonb_set(doc, path, value, create_missing): solo se crea el
+    ultimo elemento del path; si falta uno intermedio el documento no cambia"""
+    if not isinstance(doc, (dict, list)):
+        raise ValueError("cannot set path in scalar")
+    container = doc
+    for position, part in enumerate(path[:-1], 1):
+        if isinstance(container, dict):
+            if part not in container:
+                return doc
+            container = container[part]
+        elif isinstance(container, list):
+            index = _json_index(part, position)
+            if not -len(container) <= index < len(container):
+                return doc
+            container = container[index]
+        else:
+            return doc
+    last = path[-1]
+    if isinstance(container, dict):
+        if create_missing or last in container:
+            container[last] = value
+    elif isinstance(container, list):
+        index = _json_index(last, len(path))
+        if -len(container) <= index < len(container):
+            container[index] = value
+        elif create_missing:
+            if index < 0:
+                container.insert(0, value)
+            else:
+                container.append(value)
+    return doc
+
+def json_delete_path(doc, path):
+    """Equivalente de `doc #- path`"""
+    if not isinstance(doc, (dict, list)):
+        raise ValueError("cannot delete path in scalar")
+    container = doc
+    for position, part in enumerate(path, 1):
+        if isinstance(container, dict):
+            if part not in container:
+                return doc
+            if position == len(path):
+                del container[part]
+            else:
+                container = container[part]
+        elif isinstance(container, list):
+            index = _json_index(part, position)
+            if not -len(container) <= index < len(container):
+                return doc
+            if position == len(path):
+                del container[index]
+            else:
+                container = container[index]
+        else:
+            return doc
+    return doc
+
+class LocalStore:
+    """reina_memory en SQLite embebido (modo WAL), primario de lecturas y escrituras.
+    Cada escritura deja la fila marcada como pendiente (dirty) y avisa a ReinaReplicator,
+    que la lleva a NEON despues. updated_at (epoch, resolucion de microsegundos) crece
+    siempre en cada fila: gana la escritura mas reciente, local o remota."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self._write_lock = threading.Lock()
+        # Se activa en cada escritura para despertar al replicador
+        self.changed = threading.Event()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS reina_memory (
+                session_id TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                updated_at REAL NOT NULL,
+                dirty INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (session_id, key)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS reina_memory_dirty ON reina_memory (updated_at) WHERE dirty = 1;
+            CREATE TABLE IF NOT EXISTS replication (name TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+    
+    def _conn(self):
+        # Una conexion por hilo (sqlite3 no permite compartirlas entre hilos)
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self.local.conn = conn
+        return conn
+    
+    def _write(self, fn):
+        """Ejecutar fn(conn) en una transaccion de escritura"""
+        with timed("db"), self._write_lock:
+            conn = self._conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return result
+    
+    def _put(self, conn, session_id, key, value, current=None):
+        """Guardar value como cambio local pendiente; devuelve la version nueva"""
+        if current is None:
+            current = conn.execute(
+                "SELECT version, updated_at FROM reina_memory WHERE session_id = ? AND key = ?",
+                (session_id, key)
+            ).fetchone()
+        now = round(time.time(), 6)
+        if current:
+            version = current[0] + 1
+            now = max(now, round(current[1] + 0.000001, 6))
+        else:
+            version = 1
+        conn.execute(
+            "INSERT OR REPLACE INTO reina_memory (session_id, key, value, version, updated_at, dirty) "
+            "VALUES (?, ?, ?, ?, ?, 1)",
+            (session_id, key, json.dumps(value, ensure_ascii=False), version, now)
+        )
+        return version
+    
+    def get(self, session_id, key):
+        """(valor, version); (None, 0) si la clave no existe"""
+        with timed("db"):
+            row = self._conn().execute(
+                "SELECT value, version FROM reina_memory WHERE session_id = ? AND key = ?",
+                (session_id, key)
+            ).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+    
+    def get_many(self, session_id, keys):
+        """{key: valor} de las claves existentes"""
+        conn = self._conn()
+        values = {}
+        # SQLite limita los parametros por consulta
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            rows = conn.execute(
+                "SELECT key, value FROM reina_memory WHERE session_id = ? AND key IN ("
+                + ", ".join(["?"] * len(part)) + ")",
+                [session_id] + part
+            )
+            for key, value in rows:
+                values[key] = json.loads(value)
+        return values
+    
+    def set(self, session_id, key, value):
+        version = self._write(lambda conn: self._put(conn, session_id, key, value))
+        self.changed.set()
+        return version
+    
+    def set_many(self, session_id, values):
+        """Guardar varias claves en una transaccion; devuelve {key: version}"""
+        versions = self.set_rows({(session_id, key): value for key, value in values.items()})
+        return {key: version for (_, key), version in versions.items()}
+    
+    def set_rows(self, rows):
+        """Guardar {(session_id, key): valor} de varias sesiones en una transaccion"""
+        versions = self._write(lambda conn: {k: self._put(conn, k[0], k[1], value) for k, value in rows.items()})
+        self.changed.set()
+        return versions
+    
+    def update(self, session_id, key, fn, insert_value, expected_version):
+        """Como MCPHandler.reina_update: aplica fn(documento) y devuelve (version, version_actual)"""
+        def apply(conn):
+            current = conn.execute(
+                "SELECT value, version, updated_at FROM reina_memory WHERE session_id = ? AND key = ?",
+                (session_id, key)
+            ).fetchone()
+            if current is None:
+                if expected_version is None and insert_value is not None:
+                    return self._put(conn, session_id, key, insert_value), None
+                return None, None
+            if expected_version is not None and current[1] != expected_version:
+                return None, current[1]
+            return self._put(conn, session_id, key, fn(json.loads(current[0])), current[1:]), None
+        
+        result = self._write(apply)
+        if result[0] is not None:
+            self.changed.set()
+        return result
+    
+    def list_keys(self, session_id, cursor, limit):
+        """[(key, updated_at)] ordenadas por key a partir de cursor (excluido)"""
+        return self._conn().execute(
+            "SELECT key, updated_at FROM reina_memory WHERE session_id = ? AND key > ? ORDER BY key LIMIT ?",
+            (session_id, "" if cursor is None else str(cursor), limit)
+        ).fetchall()
+    
+    def pending(self, limit):
+        """Cambios locales aun no replicados, los mas antiguos primero"""
+        return self._conn().execute(
+            "SELECT session_id, key, value, version, updated_at FROM reina_memory "
+            "WHERE dirty = 1 ORDER BY updated_at LIMIT ?",
+            (limit,)
+        ).fetchall()
+    
+    def mark_clean(self, rows):
+        """Marcar como replicadas las filas salvo que hayan vuelto a cambiar mientras tanto"""
+        self._write(lambda conn: conn.executemany(
+            "UPDATE reina_memory SET dirty = 0 WHERE session_id = ? AND key = ? AND updated_at = ?",
+            [(session_id, key, updated_at) for session_id, key, _, _, updated_at in rows]
+        ))
+    
+    def apply_remote(self, rows):
+        """Aplicar filas traidas de NEON si son mas recientes que las locales.
+        Devuelve (aplicadas, cambios locales pendientes descartados)."""
+        def apply(conn):
+            applied = overwritten = 0
+            for session_id, key, value, version, updated_at in rows:
+                updated_at = round(updated_at.timestamp(), 6)
+                current = conn.execute(
+                    "SELECT updated_at, dirty FROM reina_memory WHERE session_id = ? AND key = ?",
+                    (session_id, key)
+                ).fetchone()
+                if current is not None and current[0] >= updated_at:
+                    continue
+                if isinstance(value, str):
+                    value = json.loads(value)
+                conn.execute(
+                    "INSERT OR REPLACE INTO reina_memory (session_id, key, value, version, updated_at, dirty) "
+                    "VALUES (?, ?, ?, ?, ?, 0)",
+                    (session_id, key, json.dumps(value, ensure_ascii=False), version, updated_at)
+                )
+                applied += 1
+                if current is not None and current[1]:
+                    overwritten += 1
+            return applied, overwritten
+        return self._write(apply)
+    
+    def get_meta(self, name):
+        row = self._conn().execute("SELECT value FROM replication WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+    
+    def set_meta(self, name, value):
+        self._write(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO replication (name, value) VALUES (?, ?)", (name, value)
+        ))
+    
+    def pending_count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM reina_memory WHERE dirty = 1").fetchone()[0]
+    
+    def stats(self):
+        conn = self._conn()
+        keys, pending, oldest = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(dirty), 0), MIN(CASE WHEN dirty = 1 THEN updated_at END) FROM reina_memory"
+        ).fetchone()
+        return {
+            "path": self.path,
+            "keys": keys,
+            "pending": pending,
+            "pending_age_s": round(time.time() - oldest, 3) if oldest else 0.0,
+        }
+
+# Al traer cambios de NEON se repasan tambien los ultimos segundos ya vistos: una transaccion
+# larga puede confirmar filas con updated_at (NOW() al empezar) anterior a la marca
+REPLICATE_PULL_OVERLAP = 5.0
+
+class ReinaReplicator:
+    """Hilo de replicacion entre LocalStore y la tabla reina_memory de NEON.
+    - push: los cambios pendientes se suben en lotes (un INSERT multi-fila por lote); en
+      NEON solo se sobrescribe una fila si la local tiene updated_at mas reciente.
+    - pull: trae las filas de NEON con updated_at posterior a la ultima marca vista.
+    Sin conexion los cambios siguen pendientes en SQLite y se reenvian al reconectar."""
+    
+    def __init__(self, store, pool, interval, batch, pull_interval):
+        self.store = store
+        self.pool = pool
+        self.interval = interval
+        self.batch = max(1, batch)
+        self.pull_interval = pull_interval
+        self.online = False
+        self.pushed = 0
+        self.pulled = 0
+        self.rejected = 0
+        self.overwritten = 0
+        self.errors = 0
+        self.last_error = None
+        self.last_sync = None
+    
+    def run(self):
+        schema_ready = False
+        backoff = 1
+        next_pull = 0
+        while True:
+            try:
+                if not schema_ready:
+                    if not init_reina_memory():
+                        raise RuntimeError("no se pudo verificar la tabla reina_memory")
+                    schema_ready = True
+                if not self.online or time.monotonic() >= next_pull:
+                    # Al (re)conectar primero se traen los cambios remotos y luego se reenvia lo pendiente
+                    self.pull()
+                    next_pull = time.monotonic() + self.pull_interval
+                while self.push():
+                    pass
+                if not self.online:
+                    print("[OK] Replicacion de reina_memory con NEON activa")
+                self.online = True
+                self.last_sync = time.time()
+                backoff = 1
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e).strip()
+                if self.online:
+                    print("[WARN] Replicacion con NEON interrumpida; los cambios quedan en local: " + self.last_error)
+                self.online = False
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            # Esperar a la siguiente escritura (o al siguiente pull) y agrupar las que lleguen en la ventana.
+            # En prefork las escrituras de otros workers no avisan: se revisa cada intervalo
+            timeout = max(0.0, next_pull - time.monotonic())
+            if MCP_WORKER_SLOT is not None:
+                timeout = min(timeout, self.interval)
+            self.store.changed.wait(timeout)
+            self.store.changed.clear()
+            time.sleep(self.interval)
+    
+    def push(self):
+        """Subir un lote de cambios pendientes; devuelve True si era un lote completo"""
+        rows = self.store.pending(self.batch)
+        if not rows:
+            return False
+        
+        def store(conn):
+            with conn.cursor() as cur:
+                return execute_values(
+                    cur,
+                    """INSERT INTO reina_memory (session_id, key, value, version, updated_at)
+                       VALUES %s
+                       ON CONFLICT (session_id, key)
+                       DO UPDATE SET value = EXCLUDED.value,
+                                     version = GREATEST(reina_memory.version + 1, EXCLUDED.version),
+                                     updated_at = EXCLUDED.updated_at
+                       WHERE reina_memory.updated_at < EXCLUDED.updated_at
+                       RETURNING key""",
+                    [(session_id, key, value, version, datetime.fromtimestamp(updated_at, timezone.utc))
+                     for session_id, key, value, version, updated_at in rows],
+                    template="(%s, %s, %s::jsonb, %s, %s)",
+                    page_size=len(rows),
+                    fetch=True
+                )
+        applied = self.pool.run(store)
+        # Las filas rechazadas son mas antiguas que las de NEON: el siguiente pull las trae
+        self.store.mark_clean(rows)
+        self.pushed += len(applied)
+        self.rejected += len(rows) - len(applied)
+        return len(rows) == self.batch
+    
+    def pull(self):
+        """Traer de NEON las filas modificadas desde la ultima marca"""
+        mark = self.store.get_meta("pull_mark")
+        since = datetime.fromisoformat(mark).timestamp() - REPLICATE_PULL_OVERLAP if mark else 0
+        cursor = (datetime.fromtimestamp(since, timezone.utc), "", "")
+        while True:
+            def fetch(conn):
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT session_id, key, value, version, updated_at FROM reina_memory
+                           WHERE (updated_at, session_id, key) > (%s, %s, %s)
+                           ORDER BY updated_at, session_id, key LIMIT %s""",
+                        cursor + (self.batch,)
+                    )
+                    return cur.fetchall()
+            rows = self.pool.run(fetch)
+            if not rows:
+                break
+            applied, overwritten = self.store.apply_remote(rows)
+            self.pulled += applied
+            self.overwritten += overwritten
+            last = rows[-1]
+            cursor = (last[4], last[0], last[1])
+            self.store.set_meta("pull_mark", last[4].isoformat())
+            if len(rows) < self.batch:
+                break
+    
+    def stats(self):
+        return {
+            "online": self.online,
+            "pushed": self.pushed,
+            "pulled": self.pulled,
+            "rejected": self.rejected,
+            "overwritten": self.overwritten,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_sync": datetime.fromtimestamp(self.last_sync, timezone.utc).isoformat() if self.last_sync else None,
+        }
+
+local_store = LocalStore(MCP_LOCAL_PATH) if MCP_STORE == 'local' else None
+replicator = None
+if local_store is not None and DATABASE_URL:
+    replicator = ReinaReplicator(local_store, neon_pool, MCP_REPLICATE_MS / 1000.0,
+                                 MCP_REPLICATE_BATCH, MCP_PULL_INTERVAL)
+
+class WriteCoalescer:
+    """Cola de escrituras de reina_memory agrupadas por (session_id, key).
+    set_memory/set_many dejan el valor en la cola y vuelven al momento; una escritura
+    posterior de la misma clave sustituye a la pendiente. Al cerrar la ventana todo lo
+    pendiente se escribe en una sola transaccion, asi las confirmaciones dependen del
+    numero de claves distintas y no del de llamadas. flush() es la barrera de durabilidad:
+    al volver, todo lo encolado antes esta confirmado (o se devuelve el error)."""
+    
+    def __init__(self, window, max_pending):
+        self.window = window
+        self.max_pending = max(1, max_pending)
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Un solo volcado a la vez: flush() espera al que este en curso
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # Cola llena: volcar sin esperar al final de la ventana
+        self._full = threading.Event()
+        self.calls = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.errors = 0
+        self.last_error = None
+    
+    @property
+    def enabled(self):
+        return self.window > 0
+    
+    def start(self):
+        threading.Thread(target=self._run, name='reina-coalesce', daemon=True).start()
+    
+    def put(self, session_id, values):
+        """Encolar {key: valor} de una sesion"""
+        with self._lock:
+            self.calls += 1
+            for key, value in values.items():
+                if (session_id, key) in self._pending:
+                    self.coalesced += 1
+                self._pending[(session_id, key)] = value
+            full = len(self._pending) >= self.max_pending
+        self._wakeup.set()
+        if full:
+            self._full.set()
+    
+    def get(self, session_id, key):
+        """(encontrado, valor) de una escritura aun no volcada"""
+        with self._lock:
+            k = (session_id, key)
+            if k in self._pending:
+                return True, self._pending[k]
+            return False, None
+    
+    def has_pending(self, session_id, keys=None):
+        with self._lock:
+            if keys is None:
+                return any(s == session_id for s, _ in self._pending)
+            return any((session_id, key) in self._pending for key in keys)
+    
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # Ventana de agrupacion (se corta si la cola se llena)
+            self._full.wait(self.window)
+            self._wakeup.clear()
+            self._full.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print("[WARN] No se pudieron volcar las escrituras agrupadas de reina_memory: " + str(e).strip())
+                time.sleep(min(5.0, max(self.window, 0.5)))
+                self._wakeup.set()
+    
+    def flush(self):
+        """Volcar todo lo pendiente en una transaccion; devuelve las filas escritas"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, {}
+            if not rows:
+                return 0
+            try:
+                if local_store is not None:
+                    local_store.set_rows(rows)
+                else:
+                    self._write_neon(rows)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                    self.last_error = str(e).strip()
+                    # Se devuelven a la cola salvo las claves que ya tienen un valor mas nuevo
+                    for k, value in rows.items():
+                        self._pending.setdefault(k, value)
+                raise
+            with self._lock:
+                self.flushes += 1
+                self.rows_written += len(rows)
+            return len(rows)
+    
+    def _write_neon(self, rows):
+        def store(conn):
+            with conn.cursor() as cur:
+                return execute_values(
+                    cur,
+                    """INSERT INTO reina_memory (session_id, key, value)
+                       VALUES %s
+                       ON CONFLICT (session_id, key)
+                       DO UPDATE SET value = EXCLUDED.value, version = reina_memory.version + 1,
+                                     updated_at = NOW()
+                       RETURNING session_id, key, version""",
+                    [(session_id, key, Json(value)) for (session_id, key), value in rows.items()],
+                    page_size=len(rows),
+                    fetch=True
+                )
+        for session_id, key, version in neon_pool.run(store):
+            memory_cache.put(session_id, key, rows[(session_id, key)], version)
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "window_ms": int(self.window * 1000),
+                "pending": len(self._pending),
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "flushes": self.flushes,
+                "rows_written": self.rows_written,
+                "errors": self.errors,
+                "last_error": self.last_error,
+            }
+
+write_queue = WriteCoalescer(MCP_WRITE_COALESCE_MS / 1000.0, MCP_WRITE_COALESCE_MAX)
+
+def process_group_kwargs():
+    """Lanzar subprocesos en su propio grupo para poder matar tambien a sus hijos"""
+    import subprocess
+    if os.name == 'nt':
+        return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {"start_new_session": True}
+
+def kill_process_tree(proc):
+    """Matar un subproceso lanzado con process_group_kwargs() y todos sus hijos"""
+    import signal
+    import subprocess
+    try:
+        if os.name == 'nt':
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], capture_output=True)
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except Exception:
+        pass
+    try:
+        proc.kill()
+    except Exception:
+        pass
+
+# Codigo del worker de python/run_code. Recibe trabajos JSON por stdin (uno por linea)
+# y responde por un duplicado privado de stdout; los fd 1/2 reales nunca llevan el
+# protocolo, asi la salida de subprocesos no puede corromperlo.
+# Entre trabajos se restauran cwd, os.environ y sys.path y se descargan los modulos
+# importados por el snippet. Lo que no se puede deshacer (hilos que siguen vivos) marca
+# el worker como sucio y el pool lo recicla. Los cambios sobre modulos ya cargados antes
+# del trabajo (monkeypatching, signal, atexit) si persisten: aislamiento de mejor esfuerzo.
+PY_WORKER_SOURCE = r"""
+import io, json, os, sys, tempfile, threading, traceback
+config = json.loads(sys.argv[1])
+encoding = config["encoding"]
+proto_in = os.fdopen(os.dup(0), 'rb')
+proto_out = os.fdopen(os.dup(1), 'wb')
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 0)
+# Salida de cada trabajo: archivos anonimos reutilizados; durante el trabajo los fd 1/2
+# apuntan a ellos, asi tambien se captura lo que escriben os.system, subprocess o extensiones C
+capture = {1: tempfile.TemporaryFile(), 2: tempfile.TemporaryFile()}
+for fd in (1, 2):
+    os.dup2(devnull, fd)
+for name in config["preload"]:
+    try:
+        __import__(name)
+    except Exception:
+        pass
+try:
+    import resource
+except ImportError:
+    resource = None
+if resource is not None and config["mem_mb"] > 0:
+    limit = config["mem_mb"] * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+def reply(data):
+    proto_out.write(json.dumps(data).encode("utf-8") + b"\n")
+    proto_out.flush()
+def fd_stream(fd):
+    return io.TextIOWrapper(io.FileIO(fd, 'w', closefd=False), encoding=encoding,
+                            errors='replace', write_through=True)
+def collect(fd):
+    f = capture[fd]
+    f.seek(0)
+    data = f.read()
+    f.seek(0)
+    f.truncate()
+    return data.decode(encoding, errors='replace').replace('\r\n', '\n')
+reply({"ready": True})
+for line in proto_in:
+    job = json.loads(line)
+    if resource is not None and config["cpu_s"] > 0:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = int(usage.ru_utime + usage.ru_stime)
+        hard = resource.getrlimit(resource.RLIMIT_CPU)[1]
+        soft = used + config["cpu_s"]
+        if hard != resource.RLIM_INFINITY:
+            soft = min(soft, hard)
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    for fd in (1, 2):
+        os.dup2(capture[fd].fileno(), fd)
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+    saved_path = list(sys.path)
+    saved_modules = set(sys.modules)
+    saved_threads = set(threading.enumerate())
+    sys.stdout, sys.stderr = fd_stream(1), fd_stream(2)
+    returncode = 0
+    try:
+        exec(compile(job["code"], "<run_code>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+    except SystemExit as e:
+        if e.code is None:
+            returncode = 0
+        elif isinstance(e.code, int):
+            returncode = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except BaseException:
+        etype, value, tb = sys.exc_info()
+        traceback.print_exception(etype, value, tb.tb_next)
+        returncode = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        for fd in (1, 2):
+            os.dup2(devnull, fd)
+        try:
+            os.chdir(saved_cwd)
+        except OSError:
+            pass
+        if dict(os.environ) != saved_env:
+            os.environ.clear()
+            os.environ.update(saved_env)
+        sys.path[:] = saved_path
+        for name in set(sys.modules) - saved_modules:
+            del sys.modules[name]
+    dirty = any(t.is_alive() for t in threading.enumerate() if t not in saved_threads)
+    reply({"stdout": collect(1), "stderr": collect(2), "returncode": returncode, "dirty": dirty})
+"""
+
+class PythonWorker:
+    """Interprete Python precalentado que ejecuta snippets recibidos por pipe"""
+    
+    def __init__(self):
+        import subprocess
+        config = {
+            "preload": MCP_PYWORKER_PRELOAD,
+            "mem_mb": MCP_PYWORKER_MEM_MB,
+            "cpu_s": MCP_PYWORKER_CPU_S,
+            # Misma codificacion con la que se decodificaba la salida con text=True
+            "encoding": locale.getpreferredencoding(False),
+        }
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", PY_WORKER_SOURCE, json.dumps(config)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            **process_group_kwargs()
+        )
+        self.jobs = 0
+        self.dead = False
+        # El ultimo trabajo dejo hilos vivos: no reutilizar
+        self.dirty = False
+        self._replies = queue.Queue()
+        threading.Thread(target=self._read_replies, name='pyworker-reader', daemon=True).start()
+        try:
+            ready = self._replies.get(timeout=60)
+        except queue.Empty:
+            ready = None
+        if not ready or not ready.get("ready"):
+            self.kill()
+            raise RuntimeError("El worker de Python no arranco")
+    
+    def _read_replies(self):
+        for line in self.proc.stdout:
+            self._replies.put(json.loads(line))
+        # EOF: el worker murio (limite de memoria/CPU, os._exit, ...)
+        self._replies.put(None)
+    
+    def run(self, code, timeout_ms):
+        self.jobs += 1
+        try:
+            self.proc.stdin.write(json.dumps({"code": code}).encode('utf-8') + b"\n")
+            self.proc.stdin.flush()
+            reply = self._replies.get(timeout=timeout_ms / 1000)
+        except queue.Empty:
+            self.kill()
+            return {"error": "timeout"}
+        except OSError as e:
+            self.kill()
+            return {"error": "worker terminado: " + str(e)}
+        if reply is None:
+            self.kill()
+            return {"error": "worker terminado", "returncode": self.proc.wait()}
+        self.dirty = reply.pop("dirty", False)
+        return reply
+    
+    def kill(self):
+        self.dead = True
+        kill_process_tree(self.proc)
+        try:
+            self.proc.wait(5)
+        except Exception:
+            pass
+
+class PythonWorkerPool:
+    """Pool acotado de PythonWorker con reciclado tras MCP_NEON_PYWORKER_MAX_JOBS trabajos"""
+    
+    def __init__(self, size, max_jobs):
+        self.size = size
+        self.max_jobs = max_jobs
+        self._idle = []
+        self._count = 0
+        self._cond = threading.Condition()
+        self.jobs = 0
+        self.spawned = 0
+        self.recycled = 0
+        self.killed = 0
+    
+    def _spawn(self):
+        worker = PythonWorker()
+        with self._cond:
+            self.spawned += 1
+        return worker
+    
+    def warm(self):
+        """Arrancar todos los workers por adelantado"""
+        for _ in range(self.size):
+            with self._cond:
+                if self._count >= self.size:
+                    return
+                self._count += 1
+            try:
+                worker = self._spawn()
+            except Exception:
+                with self._cond:
+                    self._count -= 1
+                raise
+            self._release(worker)
+    
+    def _acquire(self, timeout):
+        """Worker libre (o uno nuevo si hay hueco); None si no lo hay en `timeout` segundos"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+            if self._idle:
+                return self._idle.pop()
+            self._count += 1
+        try:
+            return self._spawn()
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+    
+    def _release(self, worker):
+        if not worker.dead and not worker.dirty and worker.jobs < self.max_jobs:
+            with self._cond:
+                self._idle.append(worker)
+                self._cond.notify()
+            return
+        recycled = not worker.dead
+        if recycled:
+            worker.kill()
+        with self._cond:
+            if recycled:
+                self.recycled += 1
+            else:
+                self.killed += 1
+            self._count -= 1
+            self._cond.notify()
+        # Reponer en segundo plano para que la siguiente llamada no pague el arranque
+        threading.Thread(target=self.refill, name='pyworker-refill', daemon=True).start()
+    
+    def refill(self):
+        """Completar el pool hasta su tamano sin propagar errores"""
+        try:
+            self.warm()
+        except Exception as e:
+            print("[WARN] No se pudo arrancar worker de Python: " + str(e))
+    
+    def run(self, code, timeout_ms):
+        # La espera por un worker libre cuenta dentro del timeout del trabajo
+        start = time.monotonic()
+        worker = self._acquire(timeout_ms / 1000)
+        if worker is None:
+            return {"error": "timeout", "detail": "sin worker de Python libre"}
+        remaining_ms = max(1, timeout_ms - (time.monotonic() - start) * 1000)
+        try:
+            # Si el cliente se va se mata el worker; _release lo repone
+            with cancellable(worker.kill):
+                return worker.run(code, remaining_ms)
+        finally:
+            with self._cond:
+                self.jobs += 1
+            self._release(worker)
+    
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "workers": self._count,
+                "idle": len(self._idle),
+                "jobs": self.jobs,
+                "spawned": self.spawned,
+                "recycled": self.recycled,
+                "killed": self.killed,
+            }
+
+python_pool = PythonWorkerPool(MCP_PYWORKERS, MCP_PYWORKER_MAX_JOBS)
+
+def iter_file_range(f, offset, length, chunk_size):
+    """Recorrer [offset, offset+length) de un archivo binario en fragmentos.
+    Los archivos grandes se leen via mmap: memoria constante sea cual sea su tamano."""
+    size = os.fstat(f.fileno()).st_size
+    end = min(size, offset + length)
+    if offset >= end:
+        return
+    if size >= MCP_MMAP_THRESHOLD:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for pos in range(offset, end, chunk_size):
+                yield mm[pos:min(pos + chunk_size, end)]
+        return
+    f.seek(offset)
+    remaining = end - offset
+    while remaining > 0:
+        data = f.read(min(chunk_size, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+# umask del proceso, para dar permisos normales a los archivos creados con atomic
+PROCESS_UMASK = os.umask(0)
+os.umask(PROCESS_UMASK)
+
+def encode_content(data, encoding):
+    """Bytes -> texto para JSON: base64 (binario seguro) o texto con el codec pedido.
+    Un codec desconocido o que no es de texto ("hex", "zip") lanza LookupError."""
+    if encoding == "base64":
+        return base64.b64encode(data).decode('ascii')
+    return data.decode(encoding, errors='replace')
+
+# Codificacion de la salida de subprocesos: la del locale, como hacia text=True
+# (cp850/cp1252 en Windows)
+OUTPUT_ENCODING = locale.getpreferredencoding(False)
+
+def output_decoder():
+    """Decodificador incremental equivalente a text=True: locale y saltos de linea universales"""
+    decoder = codecs.getincrementaldecoder(OUTPUT_ENCODING)(errors='replace')
+    return io.IncrementalNewlineDecoder(decoder, translate=True)
+
+def decode_output(data):
+    return output_decoder().decode(data, final=True)
+
+def pump_pipe(pipe, on_text):
+    """Leer un pipe binario a medida que llega y entregar el texto ya decodificado"""
+    decoder = output_decoder()
+    fd = pipe.fileno()
+    while True:
+        data = os.read(fd, MCP_STREAM_CHUNK)
+        text = decoder.decode(data, final=not data)
+        if text:
+            on_text(text)
+        if not data:
+            break
+    pipe.close()
+
+class RingBuffer:
+    """Buffer de texto acotado: guarda los ultimos `capacity` caracteres y un cursor
+    absoluto (total escrito) para que los clientes lean de forma incremental"""
+    
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._chunks = deque()
+        self._size = 0
+        self.total = 0
+    
+    @property
+    def start(self):
+        """Cursor del caracter mas antiguo que sigue en el buffer"""
+        return self.total - self._size
+    
+    def write(self, text):
+        if len(text) > self.capacity:
+            text = text[-self.capacity:]
+        self._chunks.append(text)
+        self._size += len(text)
+        self.total += len(text)
+        while self._size > self.capacity:
+            excess = self._size - self.capacity
+            head = self._chunks[0]
+            if len(head) <= excess:
+                self._chunks.popleft()
+                self._size -= len(head)
+            else:
+                self._chunks[0] = head[excess:]
+                self._size -= excess
+    
+    def read(self, cursor):
+        """Texto desde cursor; devuelve (texto, nuevo_cursor, se_perdio_salida)"""
+        cursor = max(0, int(cursor))
+        dropped = cursor < self.start
+        skip = max(cursor, self.start) - self.start
+        parts = []
+        for chunk in self._chunks:
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            parts.append(chunk[skip:])
+            skip = 0
+        return "".join(parts), self.total, dropped
+
+class Job:
+    """Comando shell o snippet Python ejecutado en segundo plano"""
+    
+    def __init__(self, job_id, kind, source, timeout_ms):
+        self.id = job_id
+        self.kind = kind
+        self.source = source
+        self.timeout_ms = timeout_ms
+        self.state = "queued"
+        self.returncode = None
+        self.error = None
+        self.proc = None
+        self.cancelled = False
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.stdout = RingBuffer(MCP_JOB_BUFFER)
+        self.stderr = RingBuffer(MCP_JOB_BUFFER)
+        self.cond = threading.Condition()
+    
+    @property
+    def done(self):
+        return self.state not in ("queued", "running")
+    
+    def snapshot(self, stdout_cursor=0, stderr_cursor=0):
+        """Estado del trabajo y salida nueva desde los cursores dados"""
+        with self.cond:
+            out, out_cursor, out_dropped = self.stdout.read(stdout_cursor)
+            err, err_cursor, err_dropped = self.stderr.read(stderr_cursor)
+            end = self.finished or time.time()
+            data = {
+                "job_id": self.id,
+                "kind": self.kind,
+                "state": self.state,
+                "returncode": self.returncode,
+                "stdout": out,
+                "stderr": err,
+                "stdout_cursor": out_cursor,
+                "stderr_cursor": err_cursor,
+                "truncated": out_dropped or err_dropped,
+                "elapsed_ms": int((end - self.started) * 1000) if self.started else 0,
+            }
+            if self.error:
+                data["error"] = self.error
+            return data
+
+# En prefork el job_id lleva el pid del worker que lo ejecuta: los demas le reenvian las llamadas
+JOB_ID_PREFIX = "w" + str(os.getpid()) + "-" if MCP_WORKER_SLOT is not None else ""
+
+class JobManager:
+    """Trabajos asincronos con limite de concurrencia (MCP_NEON_MAX_JOBS) y cola FIFO"""
+    
+    def __init__(self, max_running, max_queued, retain):
+        self.max_running = max(1, max_running)
+        self.max_queued = max_queued
+        self.retain = retain
+        self._jobs = OrderedDict()
+        self._pending = deque()
+        self._running = 0
+        self._lock = threading.Lock()
+    
+    def start(self, kind, source, timeout_ms):
+        with self._lock:
+            if len(self._pending) >= self.max_queued:
+                return {"error": "Cola de trabajos llena (" + str(self.max_queued) + ")"}
+            job = Job(JOB_ID_PREFIX + uuid.uuid4().hex[:12], kind, source, timeout_ms)
+            self._jobs[job.id] = job
+            self._prune()
+            if self._running < self.max_running:
+                self._running += 1
+                self._launch(job)
+            else:
+                self._pending.append(job)
+            position = len(self._pending)
+        return {"job_id": job.id, "state": job.state, "queue_position": position if job.state == "queued" else 0}
+    
+    def _prune(self):
+        """Olvidar los trabajos terminados mas antiguos por encima de MCP_NEON_JOB_RETAIN"""
+        finished = [j for j in self._jobs.values() if j.done]
+        for job in finished[:max(0, len(finished) - self.retain)]:
+            del self._jobs[job.id]
+    
+    def _launch(self, job):
+        job.state = "running"
+        job.started = time.time()
+        threading.Thread(target=self._run, args=(job,), name='job-' + job.id, daemon=True).start()
+    
+    def _run(self, job):
+        import subprocess
+        try:
+            if job.kind == "python":
+                job.proc = subprocess.Popen([sys.executable, "-u", "-"], stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            **process_group_kwargs())
+            else:
+                job.proc = subprocess.Popen(job.source, shell=True, stdin=subprocess.DEVNULL,
+                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                            **process_group_kwargs())
+            if job.cancelled:
+                kill_process_tree(job.proc)
+            
+            def writer(buffer):
+                def on_text(text):
+                    with job.cond:
+                        buffer.write(text)
+                        job.cond.notify_all()
+                return on_text
+            
+            pumps = [
+                threading.Thread(target=pump_pipe, args=(job.proc.stdout, writer(job.stdout)), daemon=True),
+                threading.Thread(target=pump_pipe, args=(job.proc.stderr, writer(job.stderr)), daemon=True),
+            ]
+            for t in pumps:
+                t.start()
+            if job.kind == "python":
+                try:
+                    job.proc.stdin.write(job.source.encode('utf-8'))
+                    job.proc.stdin.close()
+                except OSError:
+                    pass
+            
+            try:
+                job.proc.wait(timeout=job.timeout_ms / 1000)
+                state = "cancelled" if job.cancelled else "done"
+            except subprocess.TimeoutExpired:
+                kill_process_tree(job.proc)
+                job.proc.wait()
+                state = "timeout"
+            for t in pumps:
+                t.join(1)
+            with job.cond:
+                job.returncode = job.proc.returncode
+                job.state = state
+        except Exception as e:
+            with job.cond:
+                job.state = "failed"
+                job.error = str(e)
+        finally:
+            with job.cond:
+                job.finished = time.time()
+                job.cond.notify_all()
+            self._next()
+    
+    def _next(self):
+        """Un hueco libre: arrancar el siguiente trabajo de la cola"""
+        with self._lock:
+            while self._pending:
+                job = self._pending.popleft()
+                if not job.cancelled:
+                    self._launch(job)
+                    return
+            self._running -= 1
+    
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+    
+    def poll(self, job_id, stdout_cursor=0, stderr_cursor=0, wait_ms=0, until_done=False):
+        """Salida nueva y estado; con wait_ms espera (long-poll) a que haya algo nuevo,
+        o a que el trabajo termine si until_done"""
+        job = self.get(job_id)
+        if job is None:
+            return {"error": "Trabajo no encontrado: " + str(job_id)}
+        deadline = time.monotonic() + min(max(0, wait_ms), 60000) / 1000
+        with job.cond:
+            while not job.done and (until_done or (job.stdout.total <= stdout_cursor
+                                                   and job.stderr.total <= stderr_cursor)):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                job.cond.wait(remaining)
+        return job.snapshot(stdout_cursor, stderr_cursor)
+    
+    def follow(self, job_id, emit_chunk):
+        """Emitir la salida de un trabajo a medida que se produce hasta que termine"""
+        job = self.get(job_id)
+        if job is None:
+            return {"error": "Trabajo no encontrado: " + str(job_id)}
+        out_cursor = err_cursor = 0
+        while True:
+            data = self.poll(job_id, out_cursor, err_cursor, wait_ms=30000)
+            if data["stdout"]:
+                emit_chunk({"stdout": data["stdout"]})
+            if data["stderr"]:
+                emit_chunk({"stderr": data["stderr"]})
+            out_cursor, err_cursor = data["stdout_cursor"], data["stderr_cursor"]
+            if data["state"] not in ("queued", "running"):
+                data["stdout"] = data["stderr"] = ""
+                return data
+    
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return {"error": "Trabajo no encontrado: " + str(job_id)}
+        with self._lock:
+            job.cancelled = True
+            if job.state == "queued":
+                self._pending.remove(job)
+                with job.cond:
+                    job.state = "cancelled"
+                    job.finished = time.time()
+                    job.cond.notify_all()
+        if job.proc is not None and not job.done:
+            kill_process_tree(job.proc)
+        # Un trabajo en ejecucion pasa a "cancelled" en cuanto su proceso termina
+        return {"job_id": job.id, "state": job.state, "cancel_requested": True}
+    
+    def active(self):
+        """Trabajos en ejecucion o en cola"""
+        with self._lock:
+            return self._running + len(self._pending)
+    
+    def cancel_all(self):
+        with self._lock:
+            jobs = [j for j in self._jobs.values() if not j.done]
+        for job in jobs:
+            self.cancel(job.id)
+        return len(jobs)
+    
+    def list(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+            stats = {"running": self._running, "queued": len(self._pending), "max_running": self.max_running}
+        return dict(stats, jobs=[
+            {"job_id": j.id, "kind": j.kind, "state": j.state, "returncode": j.returncode,
+             "created": datetime.fromtimestamp(j.created).isoformat()}
+            for j in jobs
+        ])
+
+job_manager = JobManager(MCP_MAX_JOBS, MCP_JOB_QUEUE_MAX, MCP_JOB_RETAIN)
+
+# Pool compartido para las llamadas de un lote que se ejecutan en paralelo
+call_executor = ThreadPoolExecutor(max_workers=MCP_CALL_WORKERS, thread_name_prefix='mcp-call')
+
+class Readiness:
+    """Estado de arranque para /health y /ready. El puerto se abre antes de tocar NEON:
+    warm_up() verifica la tabla y calienta el pool en segundo plano. Con el almacen
+    local el servidor esta listo desde el principio (NEON solo recibe la replicacion)."""
+    
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ready_at = None
+        self.schema = False
+        self.pool_warmed = False
+        self.error = None
+        self._checked = 0.0
+        self._check_lock = threading.Lock()
+        # Peticiones en curso y servidas (/mcp), para drenar y reciclar el proceso
+        self.draining = False
+        self.requests = 0
+        self._inflight = 0
+        self._idle = threading.Condition()
+    
+    def begin(self, counted):
+        with self._idle:
+            self._inflight += 1
+            if counted:
+                self.requests += 1
+    
+    def end(self):
+        with self._idle:
+            self._inflight -= 1
+            self._idle.notify_all()
+    
+    def wait_idle(self, timeout):
+        """Esperar a que no quede ninguna peticion en curso; False si vence `timeout`"""
+        deadline = time.monotonic() + timeout
+        with self._idle:
+            while self._inflight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+    
+    def mark_ready(self):
+        self.ready_at = time.monotonic()
+        self.error = None
+    
+    def check_db(self):
+        """Ya listo: confirmar que NEON responde (resultado cacheado MCP_NEON_READY_CHECK s)"""
+        with self._check_lock:
+            if time.monotonic() - self._checked < MCP_READY_CHECK:
+                return self.error is None
+            def ping(conn):
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+            try:
+                neon_pool.run(ping)
+                self.error = None
+            except Exception as e:
+                self.error = str(e).strip()
+            self._checked = time.monotonic()
+            return self.error is None
+    
+    def status(self):
+        if local_store is not None:
+            ready = True
+        else:
+            ready = self.ready_at is not None and self.check_db()
+        status = {
+            "ready": ready and not self.draining,
+            "draining": self.draining,
+            "store": MCP_STORE,
+            "uptime_s": round(time.monotonic() - self.started, 3),
+            "startup_ms": round((self.ready_at - self.started) * 1000, 1) if self.ready_at else None,
+            "schema": self.schema,
+            "pool_warmed": self.pool_warmed,
+            "error": self.error,
+        }
+        if replicator is not None:
+            status["replication_online"] = replicator.online
+        if MCP_WORKER_SLOT is not None:
+            status["worker"] = MCP_WORKER_SLOT
+        return status
+
+readiness = Readiness()
+
+def warm_up():
+    """Arranque en segundo plano: tabla reina_memory, pool y LISTEN (almacen NEON) o
+    replicacion (almacen local). Si NEON no responde se reintenta con backoff."""
+    if local_store is not None:
+        readiness.mark_ready()
+        # En prefork replica solo el worker 0; los demas escriben en el mismo SQLite
+        if replicator is not None and MCP_WORKER_SLOT in (None, 0):
+            threading.Thread(target=replicator.run, name='reina-replicate', daemon=True).start()
+        return
+    backoff = 1
+    while not readiness.pool_warmed:
+        try:
+            if not readiness.schema:
+                if not init_reina_memory():
+                    raise RuntimeError("no se pudo verificar la tabla reina_memory. Verifica DATABASE_URL.")
+                readiness.schema = True
+            neon_pool.warm()
+            readiness.pool_warmed = True
+        except Exception as e:
+            readiness.error = str(e).strip()
+            print("[WARN] NEON no disponible todavia (reintento en " + str(backoff) + "s): " + readiness.error)
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+    readiness.mark_ready()
+    print("[OK] NEON lista. Reina puede reinar. Pool " + str(MCP_POOL_MIN) + "-" + str(MCP_POOL_MAX)
+          + " conexiones (" + str(round((readiness.ready_at - readiness.started) * 1000)) + " ms desde el arranque)")
+    if memory_cache.max_entries > 0 and MCP_CACHE_LISTEN:
+        if not reina_notify_installed.is_set():
+            print("[WARN] Sin trigger reina_memory_notify: la cache de reina_memory queda desactivada")
+            return
+        threading.Thread(target=listen_reina_memory, name='reina-listen', daemon=True).start()
+
+class PreforkBindMixin:
+    """Workers del modo prefork: todos escuchan en el mismo puerto (SO_REUSEPORT)"""
+    
+    def server_bind(self):
+        if MCP_WORKER_SLOT is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+class MCPHTTPServer(PreforkBindMixin, ThreadingHTTPServer):
+    """Un hilo por conexion: un run_command lento no bloquea a otros clientes"""
+    request_queue_size = MCP_BACKLOG
+
+class MCPSingleHTTPServer(PreforkBindMixin, HTTPServer):
+    """Modo 'single': peticiones en serie (legacy)"""
+    request_queue_size = MCP_BACKLOG
+
+def worker_socket(pid):
+    return os.path.join(MCP_RUN_DIR, "worker-" + str(pid) + ".sock")
+
+def worker_pids():
+    """pids de los demas workers con socket interno abierto"""
+    try:
+        names = os.listdir(MCP_RUN_DIR)
+    except OSError:
+        return []
+    pids = []
+    for m in (re.match(r"worker-(\d+)\.sock$", n) for n in names):
+        if m is None or int(m.group(1)) == os.getpid():
+            continue
+        try:
+            # Socket de un worker que murio sin borrarlo
+            os.kill(int(m.group(1)), 0)
+        except ProcessLookupError:
+            continue
+        except OSError:
+            pass
+        pids.append(int(m.group(1)))
+    return pids
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP sobre el socket Unix interno de un worker"""
+    
+    def __init__(self, path, timeout):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+    
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def worker_request(pid, method, path, body=None, timeout=5):
+    """Peticion a otro worker por su socket interno; devuelve el JSON de la respuesta"""
+    conn = UnixHTTPConnection(worker_socket(pid), timeout)
+    try:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+def worker_call(pid, server, tool, args, timeout):
+    """Ejecutar una llamada MCP en otro worker (el que tiene el trabajo o la cola)"""
+    try:
+        reply = worker_request(pid, "POST", "/mcp", {
+            "mcp": True,
+            "calls": [{"server": server, "tool": tool, "arguments": dict(args, local_only=True)}],
+        }, timeout)
+        return reply["results"][0]["result"]
+    except Exception as e:
+        return {"error": "Worker " + str(pid) + " no disponible: " + str(e)}
+
+def job_owner(args):
+    """pid del worker que tiene el trabajo args["job_id"] si no es este proceso"""
+    if MCP_WORKER_SLOT is None or args.get("local_only"):
+        return None
+    m = re.match(r"w(\d+)-", str(args.get("job_id") or ""))
+    if m is None or int(m.group(1)) == os.getpid():
+        return None
+    return int(m.group(1))
+
+def serve_worker_socket():
+    """Socket Unix interno del worker (para el supervisor y los demas workers)"""
+    class MCPWorkerServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+    
+    os.makedirs(MCP_RUN_DIR, exist_ok=True)
+    path = worker_socket(os.getpid())
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+    server = MCPWorkerServer(path, MCPHandler)
+    threading.Thread(target=server.serve_forever, name='mcp-worker-socket', daemon=True).start()
+    return server
+
+def watch_parent(server):
+    """Si el supervisor muere (kill -9) el worker drena y sale: no deja el puerto ocupado"""
+    parent = os.getppid()
+    while os.getppid() == parent:
+        time.sleep(1)
+    print("[WARN] Supervisor terminado: worker " + str(MCP_WORKER_SLOT) + " se detiene")
+    server.shutdown()
+
+def drain(server, timeout):
+    """Cierre ordenado: atender las conexiones que ya estaban en la cola del socket, esperar a
+    las peticiones y trabajos en curso (hasta `timeout` s), cancelar el resto y volcar escrituras"""
+    readiness.draining = True
+    deadline = time.monotonic() + timeout
+    server.timeout = 0
+    while select.select([server.socket], [], [], 0)[0]:
+        server.handle_request()
+    server.server_close()
+    if not readiness.wait_idle(timeout):
+        print("[WARN] Peticiones aun en curso tras " + str(timeout) + "s de drenado")
+    while job_manager.active() and time.monotonic() < deadline:
+        time.sleep(0.1)
+    cancelled = job_manager.cancel_all()
+    if cancelled:
+        print("[WARN] " + str(cancelled) + " trabajos cancelados al detener el servidor")
+    if write_queue.enabled:
+        try:
+            write_queue.flush()
+        except Exception as e:
+            print("[WARN] Escrituras agrupadas sin volcar: " + str(e))
+
+class Supervisor:
+    """Modo prefork: lanza MCP_NEON_WORKERS copias de este script como workers, reinicia las
+    que caen (con backoff si caen al arrancar) y las recicla sin cortar peticiones: el relevo
+    escucha antes de que el worker viejo deje de aceptar y drene.
+    SIGTERM/SIGINT: parar todo drenando. SIGHUP: reciclar todos los workers uno a uno."""
+    
+    def __init__(self, count):
+        self.count = count
+        self.workers = {}
+        self.started = {}
+        self.backoff = {}
+        self.restart_at = {}
+        self.retiring = []
+        self.stopping = False
+        self.reload = False
+    
+    def spawn(self, slot):
+        import subprocess
+        env = dict(os.environ, MCP_NEON_WORKER_SLOT=str(slot), MCP_NEON_RUN_DIR=MCP_RUN_DIR)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.workers[slot] = proc
+        self.started[slot] = time.monotonic()
+        self.restart_at.pop(slot, None)
+        return proc
+    
+    def serving(self, proc, timeout):
+        """Esperar a que el worker conteste /health por su socket interno"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline and proc.poll() is None:
+            try:
+                return worker_request(proc.pid, "GET", "/health", timeout=1)
+            except (OSError, ValueError):
+                time.sleep(0.05)
+        return None
+    
+    def replace(self, slot):
+        """Reciclar el worker de `slot` arrancando antes su relevo"""
+        old = self.workers.get(slot)
+        new = self.spawn(slot)
+        if self.serving(new, 60) is None:
+            print("[WARN] El relevo del worker " + str(slot) + " no arranco; se mantiene el actual")
+            new.kill()
+            new.wait()
+            self.workers[slot] = old
+            return
+        if old is not None and old.poll() is None:
+            self.retire(old)
+    
+    def retire(self, proc):
+        try:
+            proc.send_signal(signal.SIGTERM)
+        except OSError:
+            pass
+        self.retiring.append((proc, time.monotonic() + MCP_DRAIN_TIMEOUT + 5))
+    
+    def reap(self):
+        for proc, kill_at in list(self.retiring):
+            if proc.poll() is not None:
+                self.retiring.remove((proc, kill_at))
+            elif time.monotonic() >= kill_at:
+                proc.kill()
+    
+    def check(self, slot, proc):
+        """Reiniciar un worker caido; si cae nada mas arrancar, esperar cada vez mas"""
+        now = time.monotonic()
+        if slot not in self.restart_at:
+            try:
+                os.unlink(worker_socket(proc.pid))
+            except OSError:
+                pass
+            quick = now - self.started[slot] < 5
+            self.backoff[slot] = min(self.backoff.get(slot, 0.5) * 2, 30) if quick else 0.5
+            self.restart_at[slot] = now + self.backoff[slot]
+            print("[WARN] Worker " + str(slot) + " (pid " + str(proc.pid) + ") termino con codigo "
+                  + str(proc.returncode) + "; se reinicia en " + str(self.backoff[slot]) + "s")
+        elif now >= self.restart_at[slot]:
+            del self.restart_at[slot]
+            self.spawn(slot)
+    
+    def recycle_due(self, slot, proc):
+        if MCP_WORKER_MAX_REQUESTS <= 0 or time.monotonic() - self.started[slot] < 1:
+            return False
+        try:
+            health = worker_request(proc.pid, "GET", "/health", timeout=1)
+        except (OSError, ValueError):
+            return False
+        return health.get("requests", 0) >= MCP_WORKER_MAX_REQUESTS
+    
+    def stop(self, *_):
+        self.stopping = True
+    
+    def run(self):
+        # Comprobar el puerto aqui: si esta ocupado los workers caerian en bucle
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            probe.bind(('localhost', MCP_PORT))
+        except OSError as e:
+            print("[ERROR] Error iniciando servidor: " + str(e))
+            return 1
+        finally:
+            probe.close()
+        os.makedirs(MCP_RUN_DIR, exist_ok=True)
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, 'reload', True))
+        for slot in range(self.count):
+            self.spawn(slot)
+        print("[OK] Supervisor prefork (pid " + str(os.getpid()) + "): " + str(self.count)
+              + " workers en http://localhost:" + str(MCP_PORT) + "/mcp")
+        last_check = 0
+        while not self.stopping:
+            time.sleep(0.2)
+            if self.reload:
+                self.reload = False
+                print("[INFO] Reciclando workers...")
+                for slot in range(self.count):
+                    if not self.stopping:
+                        self.replace(slot)
+            recycle = time.monotonic() - last_check >= 1
+            if recycle:
+                last_check = time.monotonic()
+            for slot, proc in list(self.workers.items()):
+                if self.stopping:
+                    break
+                if proc.poll() is not None:
+                    self.check(slot, proc)
+                elif recycle and self.recycle_due(slot, proc):
+                    print("[INFO] Worker " + str(slot) + " llego a " + str(MCP_WORKER_MAX_REQUESTS)
+                          + " peticiones: reciclando")
+                    self.replace(slot)
+            self.reap()
+        print("\n[STOP] Deteniendo workers...")
+        for proc in self.workers.values():
+            if proc.poll() is None:
+                self.retire(proc)
+        while self.retiring:
+            self.reap()
+            time.sleep(0.1)
+        print("[STOP] MCP Server NEON detenido")
+        return 0
 
 class MCPHandler(BaseHTTPRequestHandler):
     """Handler para peticiones MCP"""
     
     def log_message(self, format, *args):
-        """Silenciar logs HTTP estandar"""
+        """Silenciar logs HTTP estandar (el log de accesos en JSON es log_access)"""
         pass
     
+    def parse_request(self):
+        """Preparar el estado por peticion: id, cronometro y contadores de bytes"""
+        self.request_id = None
+        if not super().parse_request():
+            return False
+        # El cliente puede fijar el id para correlacionar logs; si no, se genera uno
+        request_id = re.sub(r"[^\w.:-]", "", self.headers.get('X-Request-Id', ''))[:64]
+        self.request_id = request_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.status = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.timings = []
+        self.budget = None
+        return True
+    
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+    
+    def end_headers(self):
+        if getattr(self, 'request_id', None):
+            self.send_header('X-Request-Id', self.request_id)
+            self.send_header('Access-Control-Expose-Headers', 'X-Request-Id')
+        super().end_headers()
+    
+    def track(self, method, handler):
+        """Ejecutar el handler de la peticion registrando metricas HTTP y el log de accesos"""
+        path = self.path.split('?', 1)[0]
+        if path not in ('/mcp', '/metrics', '/health', '/ready'):
+            path = 'other'
+        metrics.inc("mcp_neon_http_requests_in_flight")
+        readiness.begin(method == "POST" and path == '/mcp')
+        try:
+            handler()
+        finally:
+            readiness.end()
+            metrics.dec("mcp_neon_http_requests_in_flight")
+            elapsed = time.perf_counter() - self.started
+            labels = (("method", method), ("path", path))
+            metrics.inc("mcp_neon_http_requests_total", labels + (("code", str(self.status)),))
+            metrics.observe("mcp_neon_http_request_duration_seconds", labels, elapsed)
+            metrics.inc("mcp_neon_http_request_bytes_total", labels, self.bytes_in)
+            metrics.inc("mcp_neon_http_response_bytes_total", labels, self.bytes_out)
+            if MCP_ACCESS_LOG:
+                self.log_access(method, elapsed)
+    
+    def log_access(self, method, elapsed):
+        """Una linea JSON por peticion en stderr"""
+        entry = {
+            "ts": datetime.now(timezone.utc).isoformat(),
+            "request_id": self.request_id,
+            # Por el socket Unix interno (otro worker) no hay direccion
+            "client": self.client_address[0] if self.client_address else "worker",
+            "method": method,
+            "path": self.path,
+            "status": self.status,
+            "duration_ms": round(elapsed * 1000, 3),
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "calls": len(self.timings),
+            "db_ms": round(sum(t["db"] for t in self.timings) * 1000, 3),
+            "subprocess_ms": round(sum(t["subprocess"] for t in self.timings) * 1000, 3),
+        }
+        try:
+            sys.stderr.write(json.dumps(entry) + "\n")
+            sys.stderr.flush()
+        except (OSError, ValueError):
+            pass
+    
+    def instrumented(self, server, tool, fn):
+        """Ejecutar fn() como la llamada server/tool: cuenta, errores, duracion y tiempo
+        de BD y subprocesos (acumulado en call_timing por NeonPool.run y timed())"""
+        timing = {"db": 0.0, "subprocess": 0.0}
+        self.timings.append(timing)
+        token = call_timing.set(timing)
+        budget = self.budget
+        budget_token = call_budget.set(budget)
+        metrics.inc("mcp_neon_calls_in_flight")
+        start = time.perf_counter()
+        result = None
+        try:
+            # Plazo agotado o cliente desconectado: la llamada ni empieza
+            if budget is not None and budget.expired():
+                result = budget.error()
+            else:
+                result = fn()
+            return result
+        finally:
+            elapsed = time.perf_counter() - start
+            call_budget.reset(budget_token)
+            call_timing.reset(token)
+            if budget is not None and budget.cancelled is not None:
+                metrics.inc("mcp_neon_calls_cancelled_total", (("reason", "disconnect"),))
+            elif budget is not None and budget.expired() and isinstance(result, dict) and "error" in result:
+                metrics.inc("mcp_neon_calls_cancelled_total", (("reason", "deadline"),))
+            metrics.dec("mcp_neon_calls_in_flight")
+            error = result is None or (isinstance(result, dict) and "error" in result)
+            if error and isinstance(result, dict) and str(result["error"]).startswith("Herramienta no soportada"):
+                # Nombres arbitrarios del cliente: una sola serie para no disparar la cardinalidad
+                server, tool = "unknown", "unknown"
+            labels = (("server", str(server)[:64]), ("tool", str(tool)[:64]))
+            metrics.inc("mcp_neon_calls_total", labels)
+            if error:
+                metrics.inc("mcp_neon_call_errors_total", labels)
+            metrics.observe("mcp_neon_call_duration_seconds", labels, elapsed)
+            if timing["db"]:
+                metrics.observe("mcp_neon_call_db_seconds", labels, timing["db"])
+            if timing["subprocess"]:
+                metrics.observe("mcp_neon_call_subprocess_seconds", labels, timing["subprocess"])
+    
+    def do_GET(self):
+        """GET /health (proceso vivo), /ready (listo para servir) y /metrics (Prometheus)"""
+        self.track("GET", self.handle_get)
+    
+    def handle_get(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/health':
+            self.respond(200, {"status": "ok", "pid": os.getpid(), "worker": MCP_WORKER_SLOT,
+                               "uptime_s": round(time.monotonic() - readiness.started, 3),
+                               "requests": readiness.requests, "draining": readiness.draining})
+            return
+        if path == '/ready':
+            status = readiness.status()
+            self.respond(200 if status["ready"] else 503, status)
+            return
+        if path == '/metrics' and MCP_METRICS:
+            body = self.metrics_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            self.bytes_out += len(body)
+            return
+        self.respond(404, {"error": "Not Found"})
+    
+    def metrics_text(self):
+        """Metricas acumuladas mas gauges leidos al vuelo del pool, la cache y las colas"""
+        pool = neon_pool.stats()
+        cache = memory_cache.stats()
+        pending = write_queue.stats()["pending"]
+        if local_store is not None:
+            pending += local_store.pending_count()
+        return metrics.render([
+            ("mcp_neon_pool_connections", (("state", "idle"),), pool["idle"]),
+            ("mcp_neon_pool_connections", (("state", "in_use"),), pool["in_use"]),
+            ("mcp_neon_pool_wait_seconds_total", (), pool["wait_ms_total"] / 1000.0),
+            ("mcp_neon_cache_lookups_total", (("result", "hit"),), cache["hits"]),
+            ("mcp_neon_cache_lookups_total", (("result", "miss"),), cache["misses"]),
+            ("mcp_neon_pending_writes", (), pending),
+        ])
+    
     def do_OPTIONS(self):
         """Manejar CORS preflight"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Request-Id, X-Request-Deadline-Ms')
         self.end_headers()
     
     def do_POST(self):
         """Manejar peticiones POST a /mcp"""
+        self.track("POST", self.handle_post)
+    
+    def handle_post(self):
         if self.path == '/mcp':
             try:
                 content_len = int(self.headers.get('Content-Length', 0))
                 post_body = self.rfile.read(content_len)
+                self.bytes_in = len(post_body)
                 req = json.loads(post_body.decode('utf-8'))
                 
                 if req.get("mcp") and isinstance(req.get("calls"), list):
-                    results = []
-                    for call in req["calls"]:
-                        server = call.get("server")
-                        tool = call.get("tool")
-                        args = call.get("arguments", {})
-                        result = self.handle_tool(server, tool, args)
-                        results.append({
-                            "server": server,
-                            "tool": tool,
-                            "result": result
-                        })
+                    calls = req["calls"]
+                    self.budget = RequestBudget(self.deadline_ms(req))
+                    if MCP_CLIENT_WATCH_MS > 0:
+                        client_watcher.watch(self.connection, self.budget)
+                    try:
+                        if req.get("stream") or 'application/x-ndjson' in self.headers.get('Accept', ''):
+                            self.stream_calls(calls, bool(req.get("parallel")))
+                            return
+                        if req.get("parallel") and len(calls) > 1:
+                            # map() conserva el orden original de las llamadas
+                            results = list(call_executor.map(self.run_call, calls))
+                        else:
+                            results = [self.run_call(call) for call in calls]
+                    finally:
+                        client_watcher.unwatch(self.connection)
+                    if self.budget.cancelled is not None:
+                        # Nadie leera la respuesta (499 como en nginx, solo para metricas y log)
+                        self.status = 499
+                        self.close_connection = True
+                        return
                     self.respond(200, {"status": "ok", "results": results})
                     return
             except Exception as e:
@@ -120,27 +2749,194 @@ class MCPHandler(BaseHTTPRequestHandler):
         
         self.respond(404, {"error": "Not Found"})
     
+    def deadline_ms(self, req):
+        """Plazo de la peticion: "deadline_ms" del cuerpo, cabecera X-Request-Deadline-Ms
+        o MCP_NEON_REQUEST_DEADLINE_MS; cuenta desde que se recibio la peticion"""
+        deadline = req.get("deadline_ms") or self.headers.get('X-Request-Deadline-Ms') or MCP_REQUEST_DEADLINE_MS
+        try:
+            deadline = float(deadline)
+        except (TypeError, ValueError):
+            return 0
+        if deadline <= 0:
+            return 0
+        return max(1, deadline - (time.perf_counter() - self.started) * 1000)
+    
+    def stream_calls(self, calls, parallel):
+        """Responder en NDJSON (chunked): una linea por resultado en cuanto termina,
+        con su indice; read_file y run_command emiten ademas lineas "chunk"."""
+        # Chunked requiere HTTP/1.1 en la linea de estado; la conexion se cierra al final
+        self.protocol_version = 'HTTP/1.1'
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Request-Id, X-Request-Deadline-Ms')
+        self.end_headers()
+        
+        lock = threading.Lock()
+        
+        def emit(data):
+            line = json.dumps(data, ensure_ascii=False).encode('utf-8') + b"\n"
+            with lock:
+                try:
+                    self.wfile.write(b"%x\r\n" % len(line) + line + b"\r\n")
+                except OSError:
+                    # El cliente se fue: cortar tambien las demas llamadas del lote
+                    self.budget.cancel("cliente desconectado")
+                    raise
+                self.bytes_out += len(line)
+        
+        def run(index, call):
+            server = call.get("server")
+            tool = call.get("tool")
+            
+            def emit_chunk(chunk):
+                emit({"index": index, "server": server, "tool": tool, "chunk": chunk})
+            
+            try:
+                result = self.instrumented(server, tool, lambda: self.handle_tool_stream(
+                    server, tool, call.get("arguments", {}), emit_chunk))
+            except Exception as e:
+                print("[ERROR] Error en " + str(server) + "/" + str(tool) + ": " + str(e))
+                result = {"error": str(e)}
+            emit({"index": index, "server": server, "tool": tool, "result": result})
+        
+        # Las cabeceras ya salieron: cualquier error se informa dentro del cuerpo NDJSON,
+        # nunca con una segunda linea de estado
+        try:
+            if parallel and len(calls) > 1:
+                futures = [call_executor.submit(run, i, call) for i, call in enumerate(calls)]
+                wait(futures)
+                for future in futures:
+                    future.result()
+            else:
+                for i, call in enumerate(calls):
+                    run(i, call)
+            emit({"status": "ok", "done": True, "count": len(calls)})
+        except (BrokenPipeError, ConnectionResetError):
+            print("[WARN] Cliente desconectado durante el streaming")
+            return
+        except Exception as e:
+            print("[ERROR] Error durante el streaming MCP: " + str(e))
+            try:
+                emit({"status": "error", "done": True, "error": str(e)})
+            except OSError:
+                return
+        try:
+            with lock:
+                self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            pass
+    
+    def run_call(self, call):
+        """Ejecutar una llamada del lote y envolver su resultado"""
+        server = call.get("server")
+        tool = call.get("tool")
+        args = call.get("arguments", {})
+        try:
+            result = self.instrumented(server, tool, lambda: self.handle_tool(server, tool, args))
+        except Exception as e:
+            print("[ERROR] Error en " + str(server) + "/" + str(tool) + ": " + str(e))
+            result = {"error": str(e)}
+        return {
+            "server": server,
+            "tool": tool,
+            "result": result
+        }
+    
     def handle_tool(self, server, tool, args):
         """Ejecutar herramienta MCP"""
         # Memoria de la Reina (NEON)
-        if server == "reina" and tool in ("get_memory", "set_memory"):
+        if server == "reina" and tool in ("get_memory", "set_memory", "get_many", "set_many", "list_keys",
+                                          "patch_memory", "merge_memory", "flush"):
             return self.handle_reina_memory(tool, args)
+        if server == "reina" and tool == "stats":
+            stats = {"pool": neon_pool.stats(), "cache": memory_cache.stats(), "python": python_pool.stats(),
+                     "writes": write_queue.stats()}
+            if MCP_WORKER_SLOT is not None:
+                stats["worker"] = {"slot": MCP_WORKER_SLOT, "pid": os.getpid(), "requests": readiness.requests}
+            if local_store is not None:
+                stats["store"] = dict(local_store.stats(),
+                                      replication=replicator.stats() if replicator is not None else None)
+            return stats
         
         # Ejecucion de codigo Python
         if server == "python" and tool == "run_code":
-            return self.run_code(args.get("code", ""), args.get("timeout_ms", 5000))
+            with timed("subprocess"):
+                return self.run_code(args.get("code", ""), budget_ms(args.get("timeout_ms", 5000)))
         
         # Sistema de archivos
         if server == "fs" and tool == "read_file":
-            return self.read_file(args.get("path", ""))
+            return self.read_file(args.get("path", ""), args.get("offset"), args.get("length"),
+                                  args.get("encoding", "utf-8"))
         if server == "fs" and tool == "write_file":
-            return self.write_file(args.get("path", ""), args.get("content", ""))
+            return self.write_file(args.get("path", ""), args.get("content", ""), args.get("mode", "overwrite"),
+                                   args.get("encoding", "utf-8"), bool(args.get("atomic", False)))
+        if server == "fs" and tool == "stat":
+            return self.stat_file(args.get("path", ""))
+        if server == "fs" and tool == "tail":
+            return self.tail_file(args.get("path", ""), args.get("lines", 100), args.get("encoding", "utf-8"))
         
         # Comandos shell
         if server == "shell" and tool == "run_command":
-            return self.run_command(args.get("command", ""), args.get("timeout_ms", 10000))
+            with timed("subprocess"):
+                return self.run_command(args.get("command", ""), budget_ms(args.get("timeout_ms", 10000)))
         
-        return {"error": "Herramienta no soportada: " + server + "/" + tool}
+        # Trabajos asincronos (shell o python) con salida incremental
+        if server == "jobs":
+            return self.handle_jobs(tool, args)
+        
+        return {"error": "Herramienta no soportada: " + str(server) + "/" + str(tool)}
+    
+    def handle_tool_stream(self, server, tool, args, emit_chunk):
+        """Como handle_tool, pero las herramientas con salida grande la emiten por partes"""
+        if server == "fs" and tool == "read_file":
+            return self.read_file_stream(args.get("path", ""), args.get("offset"), args.get("length"),
+                                         args.get("encoding", "utf-8"), emit_chunk)
+        if server == "shell" and tool == "run_command":
+            with timed("subprocess"):
+                return self.run_command_stream(args.get("command", ""), budget_ms(args.get("timeout_ms", 10000)),
+                                               emit_chunk)
+        if server == "jobs" and tool == "stream" and job_owner(args) is None:
+            return job_manager.follow(args.get("job_id"), emit_chunk)
+        return self.handle_tool(server, tool, args)
+    
+    def handle_jobs(self, tool, args):
+        """jobs/start devuelve un job_id al instante; poll/stream/cancel/list lo siguen"""
+        owner = job_owner(args)
+        if owner is not None and tool in ("poll", "stream", "cancel"):
+            # Trabajo de otro worker (prefork): la llamada se le reenvia
+            wait_ms = args.get("wait_ms", 30000 if tool == "stream" else 0)
+            return worker_call(owner, "jobs", tool, args, budget_ms(wait_ms) / 1000 + 10)
+        if tool == "list" and MCP_WORKER_SLOT is not None and not args.get("local_only"):
+            listed = job_manager.list()
+            for pid in worker_pids():
+                other = worker_call(pid, "jobs", "list", {}, 5)
+                if "jobs" in other:
+                    for field in ("running", "queued", "max_running", "jobs"):
+                        listed[field] += other[field]
+            return listed
+        if tool == "start":
+            kind = args.get("kind", "shell")
+            if kind not in ("shell", "python"):
+                return {"error": "kind debe ser 'shell' o 'python'"}
+            source = args.get("code" if kind == "python" else "command", "")
+            return job_manager.start(kind, source, args.get("timeout_ms", MCP_JOB_TIMEOUT_MS))
+        # Los trabajos sobreviven a la peticion; solo la espera se recorta a su plazo
+        if tool == "poll":
+            return job_manager.poll(args.get("job_id"), args.get("stdout_cursor", 0),
+                                    args.get("stderr_cursor", 0), budget_ms(args.get("wait_ms", 0)))
+        if tool == "stream":
+            # Fuera del modo streaming: esperar a que termine y devolver su salida
+            return job_manager.poll(args.get("job_id"), args.get("stdout_cursor", 0),
+                                    args.get("stderr_cursor", 0), budget_ms(args.get("wait_ms", 30000)), until_done=True)
+        if tool == "cancel":
+            return job_manager.cancel(args.get("job_id"))
+        if tool == "list":
+            return job_manager.list()
+        return {"error": "Herramienta no soportada: jobs/" + str(tool)}
     
     def handle_reina_memory(self, tool, args):
         """Manejar memoria de la Reina en NEON"""
@@ -148,109 +2944,580 @@ class MCPHandler(BaseHTTPRequestHandler):
         key = args.get("key", "core_identity")
         
         try:
+            if tool == "flush":
+                written = write_queue.flush()
+                # En prefork cada worker tiene su cola: la barrera los vacia todos
+                if MCP_WORKER_SLOT is not None and write_queue.enabled and not args.get("local_only"):
+                    for pid in worker_pids():
+                        other = worker_call(pid, "reina", "flush", {}, 60)
+                        if "error" in other:
+                            return dict(other, tool=tool)
+                        written += other.get("written", 0)
+                return {"status": "flushed", "written": written}
+            if write_queue.enabled:
+                result = self.reina_coalesced(tool, session_id, key, args)
+                if result is not None:
+                    return result
+            
+            if local_store is not None and tool not in ("patch_memory", "merge_memory"):
+                return self.reina_local(tool, session_id, key, args)
+            
             if tool == "get_memory":
-                with get_neon_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute(
-                            """SELECT value FROM reina_memory 
-                               WHERE session_id = %s AND key = %s 
-                               ORDER BY updated_at DESC LIMIT 1""",
-                            (session_id, key)
-                        )
-                        row = cur.fetchone()
-                        if row:
-                            # psycopg2 devuelve JSONB como dict/list directamente
-                            value = row[0]
-                            if isinstance(value, str):
-                                return json.loads(value)
-                            return value
-                        else:
-                            return {"status": "empty"}
+                if args.get("include_version"):
+                    return self.reina_get_versioned(session_id, key)
+                found, value = memory_cache.get(session_id, key)
+                if not found:
+                    epoch = memory_cache.epoch()
+                    def fetch(conn):
+                        with conn.cursor() as cur:
+                            execute_prepared(cur, "reina_get_memory", (session_id, key))
+                            return cur.fetchone()
+                    row = neon_pool.run(fetch)
+                    # psycopg2 devuelve JSONB como dict/list directamente
+                    value, version = row if row else (None, 0)
+                    if isinstance(value, str):
+                        value = json.loads(value)
+                    memory_cache.fill(session_id, key, value, version, epoch)
+                if value is None:
+                    return {"status": "empty"}
+                return value
             
             elif tool == "set_memory":
                 value = args.get("value", {})
-                with get_neon_conn() as conn:
+                def store(conn):
                     with conn.cursor() as cur:
                         # Usar Json() para convertir dict a JSONB
-                        cur.execute("""
-                            INSERT INTO reina_memory (session_id, key, value)
-                            VALUES (%s, %s, %s)
-                            ON CONFLICT (session_id, key)
-                            DO UPDATE SET value = EXCLUDED.value, updated_at = NOW()
-                        """, (session_id, key, Json(value)))
-                        conn.commit()
-                return {"status": "saved", "session_id": session_id, "key": key}
+                        execute_prepared(cur, "reina_set_memory", (session_id, key, Json(value)))
+                        return cur.fetchone()[0]
+                version = neon_pool.run(store)
+                memory_cache.put(session_id, key, value, version)
+                return {"status": "saved", "session_id": session_id, "key": key, "version": version}
+            
+            elif tool == "patch_memory":
+                return self.reina_patch(session_id, key, args)
+            
+            elif tool == "merge_memory":
+                return self.reina_merge(session_id, key, args)
+            
+            elif tool == "get_many":
+                return self.reina_get_many(session_id, args.get("keys", []))
+            
+            elif tool == "set_many":
+                return self.reina_set_many(session_id, args.get("values", {}))
+            
+            elif tool == "list_keys":
+                return self.reina_list_keys(session_id, args.get("cursor"), args.get("limit", MCP_LIST_LIMIT))
         
         except Exception as e:
             print("[ERROR] Error en handle_reina_memory: " + str(e))
             return {"error": str(e), "tool": tool}
     
-    def run_code(self, code, timeout_ms):
-        """Ejecutar codigo Python"""
-        import tempfile
-        import subprocess
-        import os
+    def reina_coalesced(self, tool, session_id, key, args):
+        """Escrituras agrupadas (MCP_NEON_WRITE_COALESCE_MS): set_memory/set_many se encolan
+        y las lecturas ven lo encolado. Devuelve None si la llamada sigue por el camino normal."""
+        if tool == "set_memory":
+            write_queue.put(session_id, {key: args.get("value", {})})
+            return {"status": "queued", "session_id": session_id, "key": key}
         
-        with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
-            f.write(code)
-            f_path = f.name
+        if tool == "set_many":
+            values = args.get("values", {})
+            if not isinstance(values, dict):
+                return {"error": "values debe ser un objeto {key: value}"}
+            if values:
+                write_queue.put(session_id, values)
+            return {"status": "queued", "session_id": session_id, "keys": list(values)}
         
-        try:
-            result = subprocess.run(
-                ["python", f_path],
-                capture_output=True,
-                text=True,
-                timeout=timeout_ms / 1000
-            )
+        if tool == "get_memory" and not args.get("include_version"):
+            found, value = write_queue.get(session_id, key)
+            if found:
+                return {"status": "empty"} if value is None else value
+            return None
+        
+        # Versiones, documentos a modificar y listados necesitan lo encolado ya confirmado
+        if tool in ("get_memory", "patch_memory", "merge_memory"):
+            pending = write_queue.has_pending(session_id, [key])
+        elif tool == "get_many":
+            keys = args.get("keys", [])
+            pending = isinstance(keys, list) and write_queue.has_pending(session_id, keys)
+        else:
+            pending = write_queue.has_pending(session_id)
+        if pending:
+            write_queue.flush()
+        return None
+    
+    def reina_local(self, tool, session_id, key, args):
+        """get/set/get_many/set_many/list_keys sobre el almacen local (MCP_NEON_STORE=local)"""
+        if tool == "get_memory":
+            value, version = local_store.get(session_id, key)
+            if args.get("include_version"):
+                return {"status": "empty"} if value is None else {"value": value, "version": version}
+            return {"status": "empty"} if value is None else value
+        
+        if tool == "set_memory":
+            version = local_store.set(session_id, key, args.get("value", {}))
+            return {"status": "saved", "session_id": session_id, "key": key, "version": version}
+        
+        if tool == "get_many":
+            keys = args.get("keys", [])
+            if not isinstance(keys, list):
+                return {"error": "keys debe ser una lista"}
+            keys = list(dict.fromkeys(keys))
+            values = local_store.get_many(session_id, keys)
+            return {
+                "session_id": session_id,
+                "values": {k: values[k] for k in keys if values.get(k) is not None},
+                "missing": [k for k in keys if values.get(k) is None],
+            }
+        
+        if tool == "set_many":
+            values = args.get("values", {})
+            if not isinstance(values, dict):
+                return {"error": "values debe ser un objeto {key: value}"}
+            if values:
+                local_store.set_many(session_id, values)
+            return {"status": "saved", "session_id": session_id, "keys": list(values)}
+        
+        if tool == "list_keys":
+            try:
+                limit = max(1, min(int(args.get("limit", MCP_LIST_LIMIT)), MCP_LIST_LIMIT_MAX))
+            except (TypeError, ValueError):
+                return {"error": "limit debe ser un entero"}
+            rows = local_store.list_keys(session_id, args.get("cursor"), limit + 1)
+            has_more = len(rows) > limit
+            rows = rows[:limit]
             return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode
+                "session_id": session_id,
+                "keys": [
+                    {"key": k, "updated_at": datetime.fromtimestamp(updated_at, timezone.utc).isoformat()}
+                    for k, updated_at in rows
+                ],
+                "next_cursor": rows[-1][0] if has_more else None,
             }
+    
+    def reina_get_many(self, session_id, keys):
+        """Leer varias claves de una sesion con una sola consulta"""
+        if not isinstance(keys, list):
+            return {"error": "keys debe ser una lista"}
+        values = {}
+        pending = []
+        for key in dict.fromkeys(keys):
+            found, value = memory_cache.get(session_id, key)
+            if found:
+                values[key] = value
+            else:
+                pending.append(key)
+        
+        if pending:
+            epoch = memory_cache.epoch()
+            def fetch(conn):
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """SELECT key, value, version FROM reina_memory
+                           WHERE session_id = %s AND key = ANY(%s)""",
+                        (session_id, pending)
+                    )
+                    return cur.fetchall()
+            rows = {key: (value, version) for key, value, version in neon_pool.run(fetch)}
+            for key in pending:
+                value, version = rows.get(key, (None, 0))
+                if isinstance(value, str):
+                    value = json.loads(value)
+                memory_cache.fill(session_id, key, value, version, epoch)
+                values[key] = value
+        
+        return {
+            "session_id": session_id,
+            "values": {k: v for k, v in values.items() if v is not None},
+            "missing": [k for k, v in values.items() if v is None],
+        }
+    
+    def reina_set_many(self, session_id, values):
+        """Guardar varias claves en una sola transaccion (INSERT multi-fila)"""
+        if not isinstance(values, dict):
+            return {"error": "values debe ser un objeto {key: value}"}
+        if not values:
+            return {"status": "saved", "session_id": session_id, "keys": []}
+        
+        def store(conn):
+            with conn.cursor() as cur:
+                return execute_values(
+                    cur,
+                    """INSERT INTO reina_memory (session_id, key, value)
+                       VALUES %s
+                       ON CONFLICT (session_id, key)
+                       DO UPDATE SET value = EXCLUDED.value, version = reina_memory.version + 1,
+                                     updated_at = NOW()
+                       RETURNING key, version""",
+                    [(session_id, key, Json(value)) for key, value in values.items()],
+                    page_size=len(values),
+                    fetch=True
+                )
+        versions = dict(neon_pool.run(store))
+        for key, value in values.items():
+            memory_cache.put(session_id, key, value, versions[key])
+        return {"status": "saved", "session_id": session_id, "keys": list(values)}
+    
+    def reina_get_versioned(self, session_id, key):
+        """Leer valor y version (sin cache) para usar luego expected_version"""
+        def fetch(conn):
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT value, version FROM reina_memory WHERE session_id = %s AND key = %s",
+                    (session_id, key)
+                )
+                return cur.fetchone()
+        row = neon_pool.run(fetch)
+        if not row:
+            return {"status": "empty"}
+        return {"value": row[0], "version": row[1]}
+    
+    def reina_update(self, session_id, key, expr, params, insert_value, expected_version, status, local=None):
+        """Aplicar una actualizacion parcial en el servidor (expr sobre la columna value).
+        Sin expected_version la clave se crea con insert_value si no existe (salvo que
+        insert_value sea None); con expected_version solo se actualiza si la version coincide.
+        Con el almacen local se aplica local(documento), el equivalente en Python de expr."""
+        def apply(conn):
+            with conn.cursor() as cur:
+                if expected_version is None and insert_value is not None:
+                    cur.execute(
+                        """INSERT INTO reina_memory (session_id, key, value)
+                           VALUES (%s, %s, %s)
+                           ON CONFLICT (session_id, key)
+                           DO UPDATE SET value = """ + expr + """,
+                                         version = reina_memory.version + 1, updated_at = NOW()
+                           RETURNING version""",
+                        (session_id, key, Json(insert_value)) + params
+                    )
+                    return cur.fetchone()[0], None
+                sql = """UPDATE reina_memory
+                         SET value = """ + expr + """, version = version + 1, updated_at = NOW()
+                         WHERE session_id = %s AND key = %s"""
+                if expected_version is None:
+                    cur.execute(sql + " RETURNING version", params + (session_id, key))
+                else:
+                    cur.execute(sql + " AND version = %s RETURNING version",
+                                params + (session_id, key, expected_version))
+                row = cur.fetchone()
+                if row:
+                    return row[0], None
+                cur.execute(
+                    "SELECT version FROM reina_memory WHERE session_id = %s AND key = %s",
+                    (session_id, key)
+                )
+                current = cur.fetchone()
+                return None, current[0] if current else None
+        
+        if local_store is not None:
+            version, current = local_store.update(session_id, key, local, insert_value, expected_version)
+        else:
+            version, current = neon_pool.run(apply)
+            # El documento nuevo no viaja de vuelta; la siguiente lectura lo trae de NEON
+            memory_cache.invalidate(session_id, key)
+        if version is None and current is None:
+            return {"status": "empty", "session_id": session_id, "key": key}
+        if version is None:
+            return {
+                "error": "version_conflict",
+                "session_id": session_id,
+                "key": key,
+                "expected_version": expected_version,
+                "current_version": current,
+            }
+        return {"status": status, "session_id": session_id, "key": key, "version": version}
+    
+    def reina_patch(self, session_id, key, args):
+        """Actualizar (o borrar con "delete": true) un path del documento con jsonb_set / #-"""
+        path = args.get("path")
+        if isinstance(path, str):
+            path = [p for p in path.split(".") if p]
+        if not isinstance(path, list) or not path:
+            return {"error": "path debe ser una lista o un string 'a.b.c' no vacio"}
+        path = [str(p) for p in path]
+        
+        # Borrar un path de una clave inexistente no crea nada
+        if args.get("delete"):
+            return self.reina_update(
+                session_id, key, "reina_memory.value #- %s::text[]", (path,),
+                None, args.get("expected_version"), "patched",
+                local=lambda doc: json_delete_path(doc, path)
+            )
+        
+        value = args.get("value")
+        create_missing = bool(args.get("create_missing", True))
+        # Documento inicial si la clave no existe: el path anidado ya construido
+        initial = None
+        if create_missing:
+            initial = value
+            for part in reversed(path):
+                initial = {part: initial}
+        return self.reina_update(
+            session_id, key, "jsonb_set(reina_memory.value, %s::text[], %s::jsonb, %s)",
+            (path, Json(value), create_missing),
+            initial, args.get("expected_version"), "patched",
+            local=lambda doc: json_set(doc, path, value, create_missing)
+        )
+    
+    def reina_merge(self, session_id, key, args):
+        """Fusionar un objeto con el documento guardado: || (superficial) o merge profundo"""
+        value = args.get("value")
+        if not isinstance(value, dict):
+            return {"error": "value debe ser un objeto"}
+        if args.get("deep"):
+            expr = "reina_jsonb_deep_merge(reina_memory.value, %s::jsonb)"
+            local = lambda doc: json_deep_merge(doc, value)
+        else:
+            expr = "reina_memory.value || %s::jsonb"
+            local = lambda doc: json_concat(doc, value)
+        return self.reina_update(
+            session_id, key, expr, (Json(value),),
+            value, args.get("expected_version"), "merged", local=local
+        )
+    
+    def reina_list_keys(self, session_id, cursor, limit):
+        """Listar claves de una sesion paginando por keyset (key > cursor) sobre idx_session_key"""
+        try:
+            limit = max(1, min(int(limit), MCP_LIST_LIMIT_MAX))
+        except (TypeError, ValueError):
+            return {"error": "limit debe ser un entero"}
+        
+        def fetch(conn):
+            with conn.cursor() as cur:
+                if cursor is None:
+                    cur.execute(
+                        """SELECT key, updated_at FROM reina_memory
+                           WHERE session_id = %s
+                           ORDER BY key LIMIT %s""",
+                        (session_id, limit + 1)
+                    )
+                else:
+                    cur.execute(
+                        """SELECT key, updated_at FROM reina_memory
+                           WHERE session_id = %s AND key > %s
+                           ORDER BY key LIMIT %s""",
+                        (session_id, str(cursor), limit + 1)
+                    )
+                return cur.fetchall()
+        rows = neon_pool.run(fetch)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "session_id": session_id,
+            "keys": [
+                {"key": key, "updated_at": updated_at.isoformat() if updated_at else None}
+                for key, updated_at in rows
+            ],
+            "next_cursor": rows[-1][0] if has_more else None,
+        }
+    
+    def run_code(self, code, timeout_ms):
+        """Ejecutar codigo Python (en un worker precalentado si el pool esta activo)"""
+        if MCP_PYWORKERS > 0:
+            return python_pool.run(code, timeout_ms)
+        
+        import subprocess
+        # El codigo llega por stdin: sin archivos temporales
+        proc = subprocess.Popen([sys.executable, "-"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True, **process_group_kwargs())
+        try:
+            with cancellable(lambda: kill_process_tree(proc)):
+                stdout, stderr = proc.communicate(code, timeout=timeout_ms / 1000)
         except subprocess.TimeoutExpired:
+            kill_process_tree(proc)
+            proc.communicate()
             return {"error": "timeout"}
-        finally:
-            try:
-                os.unlink(f_path)
-            except:
-                pass
+        return {
+            "stdout": stdout,
+            "stderr": stderr,
+            "returncode": proc.returncode
+        }
     
-    def read_file(self, path):
-        """Leer archivo"""
+    def read_file(self, path, offset=None, length=None, encoding="utf-8"):
+        """Leer archivo completo (texto) o un rango de bytes con offset/length"""
         try:
-            with open(path, 'r', encoding='utf-8') as f:
-                return {"content": f.read()}
+            if offset is None and length is None and encoding != "base64":
+                with open(path, 'r', encoding=encoding) as f:
+                    return {"content": f.read()}
+            
+            offset = max(0, int(offset or 0))
+            length = min(int(length), MCP_READ_MAX) if length is not None else MCP_READ_MAX
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                data = b"".join(iter_file_range(f, offset, length, MCP_STREAM_CHUNK))
+            return {
+                "content": encode_content(data, encoding),
+                "encoding": encoding,
+                "offset": offset,
+                "length": len(data),
+                "size": size,
+                "eof": offset + len(data) >= size,
+            }
         except Exception as e:
             return {"error": str(e)}
     
-    def write_file(self, path, content):
-        """Escribir archivo"""
+    def read_file_stream(self, path, offset, length, encoding, emit_chunk):
+        """Leer archivo por fragmentos sin cargarlo entero en memoria"""
         try:
-            os.makedirs(os.path.dirname(path), exist_ok=True)
-            with open(path, 'w', encoding='utf-8') as f:
-                f.write(content)
-            return {"status": "written", "path": path}
+            if offset is None and length is None and encoding != "base64":
+                length = 0
+                with open(path, 'r', encoding=encoding) as f:
+                    while True:
+                        piece = f.read(MCP_STREAM_CHUNK)
+                        if not piece:
+                            break
+                        emit_chunk({"content": piece})
+                        length += len(piece)
+                return {"status": "streamed", "length": length}
+            
+            offset = max(0, int(offset or 0))
+            sent = 0
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # En streaming no hace falta limitar a MCP_NEON_READ_MAX
+                length = int(length) if length is not None else size
+                for data in iter_file_range(f, offset, length, MCP_STREAM_CHUNK):
+                    emit_chunk({"content": encode_content(data, encoding), "offset": offset + sent})
+                    sent += len(data)
+            return {"status": "streamed", "encoding": encoding, "offset": offset, "length": sent, "size": size}
+        except Exception as e:
+            return {"error": str(e)}
+    
+    def stat_file(self, path):
+        """Metadatos de un archivo o directorio"""
+        try:
+            st = os.stat(path)
+            return {
+                "path": path,
+                "size": st.st_size,
+                "is_file": os.path.isfile(path),
+                "is_dir": os.path.isdir(path),
+                "mode": oct(st.st_mode & 0o7777),
+                "mtime": datetime.fromtimestamp(st.st_mtime).isoformat(),
+            }
+        except Exception as e:
+            return {"error": str(e)}
+    
+    def tail_file(self, path, lines, encoding="utf-8"):
+        """Ultimas N lineas leyendo bloques desde el final del archivo"""
+        try:
+            lines = max(1, int(lines))
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                pos = size
+                blocks = []
+                read = 0
+                newlines = 0
+                # Una linea mas: la ultima del archivo puede acabar en salto de linea
+                while pos > 0 and newlines <= lines:
+                    step = min(MCP_STREAM_CHUNK, pos)
+                    pos -= step
+                    f.seek(pos)
+                    block = f.read(step)
+                    newlines += block.count(b"\n")
+                    blocks.append(block)
+                    read += len(block)
+                    if read > MCP_READ_MAX:
+                        break
+            data = b"".join(reversed(blocks))
+            tail = data.splitlines(keepends=True)[-lines:]
+            data = b"".join(tail)
+            return {
+                "content": encode_content(data, encoding),
+                "encoding": encoding,
+                "lines": len(tail),
+                "offset": size - len(data),
+                "size": size,
+            }
+        except Exception as e:
+            return {"error": str(e)}
+    
+    def write_file(self, path, content, mode="overwrite", encoding="utf-8", atomic=False):
+        """Escribir archivo: sobrescribir o anadir (append); atomic escribe en un temporal
+        del mismo directorio y lo renombra, asi nunca queda un archivo a medias"""
+        import tempfile
+        try:
+            data = base64.b64decode(content) if encoding == "base64" else content.encode(encoding)
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            
+            if mode == "append":
+                with open(path, 'ab') as f:
+                    f.write(data)
+                return {"status": "appended", "path": path, "bytes": len(data)}
+            
+            if not atomic:
+                with open(path, 'wb') as f:
+                    f.write(data)
+                return {"status": "written", "path": path, "bytes": len(data)}
+            
+            fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', dir=directory or '.')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.path.exists(path):
+                    os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+                else:
+                    os.chmod(tmp_path, 0o666 & ~PROCESS_UMASK)
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+            return {"status": "written", "path": path, "bytes": len(data), "atomic": True}
         except Exception as e:
             return {"error": str(e)}
     
     def run_command(self, cmd, timeout_ms):
-        """Ejecutar comando shell"""
+        """Ejecutar comando shell (en timeout devuelve la salida parcial)"""
         import subprocess
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                **process_group_kwargs())
         try:
-            result = subprocess.run(
-                cmd,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=timeout_ms / 1000
-            )
+            with cancellable(lambda: kill_process_tree(proc)):
+                stdout, stderr = proc.communicate(timeout=timeout_ms / 1000)
+        except subprocess.TimeoutExpired:
+            kill_process_tree(proc)
+            stdout, stderr = proc.communicate()
             return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "returncode": result.returncode
+                "error": "timeout",
+                "stdout": decode_output(stdout),
+                "stderr": decode_output(stderr),
+                "returncode": proc.returncode
             }
+        return {
+            "stdout": decode_output(stdout),
+            "stderr": decode_output(stderr),
+            "returncode": proc.returncode
+        }
+    
+    def run_command_stream(self, cmd, timeout_ms, emit_chunk):
+        """Ejecutar comando shell emitiendo stdout/stderr a medida que llegan"""
+        import subprocess
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                **process_group_kwargs())
+        pumps = [
+            threading.Thread(target=pump_pipe, args=(proc.stdout, lambda text: emit_chunk({"stdout": text})), daemon=True),
+            threading.Thread(target=pump_pipe, args=(proc.stderr, lambda text: emit_chunk({"stderr": text})), daemon=True),
+        ]
+        for t in pumps:
+            t.start()
+        try:
+            with cancellable(lambda: kill_process_tree(proc)):
+                proc.wait(timeout=timeout_ms / 1000)
+            timed_out = False
         except subprocess.TimeoutExpired:
-            return {"error": "timeout"}
+            kill_process_tree(proc)
+            proc.wait()
+            timed_out = True
+        for t in pumps:
+            t.join(1)
+        if timed_out:
+            return {"error": "timeout", "returncode": proc.returncode}
+        return {"returncode": proc.returncode}
     
     def respond(self, code, data):
         """Responder peticion HTTP"""
@@ -258,27 +3525,68 @@ class MCPHandler(BaseHTTPRequestHandler):
         self.send_header('Content-Type', 'application/json; charset=utf-8')
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, X-Request-Id, X-Request-Deadline-Ms')
         self.end_headers()
-        self.wfile.write(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.wfile.write(body)
+        self.bytes_out += len(body)
 
 if __name__ == '__main__':
-    print("[INFO] Iniciando MCP Server NEON en puerto " + str(MCP_PORT) + "...")
-    print("[INFO] Conectando a NEON: " + DATABASE_URL.split('@')[1].split('/')[0])
+    if MCP_WORKERS > 1 and MCP_WORKER_SLOT is None:
+        if hasattr(socket, 'SO_REUSEPORT') and hasattr(socketserver, 'ThreadingUnixStreamServer'):
+            sys.exit(Supervisor(MCP_WORKERS).run())
+        print("[WARN] MCP_NEON_WORKERS necesita SO_REUSEPORT (Linux/macOS): se usa un solo proceso")
     
-    # Inicializar tabla
-    if init_reina_memory():
-        print("[OK] NEON lista. Reina puede reinar.")
+    if MCP_WORKER_SLOT is not None:
+        print("[INFO] Worker " + str(MCP_WORKER_SLOT) + " (pid " + str(os.getpid()) + ") en puerto " + str(MCP_PORT) + "...")
     else:
-        print("[WARN] Advertencia: No se pudo verificar tabla. Verifica DATABASE_URL.")
+        print("[INFO] Iniciando MCP Server NEON en puerto " + str(MCP_PORT) + "...")
+    if DATABASE_URL:
+        print("[INFO] Conectando a NEON: " + DATABASE_URL.split('@')[-1].split('/')[0])
     
+    # Primero el puerto: /health responde ya y /ready indica cuando NEON esta lista
     try:
-        server = HTTPServer(('localhost', MCP_PORT), MCPHandler)
-        print("[OK] MCP Server NEON corriendo en http://localhost:" + str(MCP_PORT) + "/mcp")
-        print("   Presiona Ctrl+C para detener")
-        server.serve_forever()
-    except KeyboardInterrupt:
-        print("\n[STOP] MCP Server NEON detenido")
+        server_class = MCPSingleHTTPServer if MCP_MODE == 'single' else MCPHTTPServer
+        server = server_class(('localhost', MCP_PORT), MCPHandler)
     except Exception as e:
         print("[ERROR] Error iniciando servidor: " + str(e))
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+    print("[OK] MCP Server NEON corriendo en http://localhost:" + str(MCP_PORT) + "/mcp (modo " + MCP_MODE + ")")
+    print("   Presiona Ctrl+C para detener")
+    
+    if local_store is not None:
+        print("[OK] Memoria local en " + MCP_LOCAL_PATH)
+        if replicator is None:
+            print("[INFO] Sin DATABASE_URL: la memoria no se replica a NEON")
+    threading.Thread(target=warm_up, name='mcp-warm-up', daemon=True).start()
+    
+    if write_queue.enabled:
+        write_queue.start()
+        print("[OK] Escrituras de reina_memory agrupadas cada " + str(MCP_WRITE_COALESCE_MS) + " ms")
+    
+    if MCP_PYWORKERS > 0:
+        threading.Thread(target=python_pool.refill, name='pyworker-warm', daemon=True).start()
+    
+    worker_server = None
+    if MCP_WORKER_SLOT is not None:
+        if MCP_CACHE_SIZE > 0 and not MCP_CACHE_LISTEN and MCP_WORKER_SLOT == 0:
+            print("[WARN] Prefork con MCP_NEON_CACHE_LISTEN=0: la cache de reina_memory queda desactivada")
+        worker_server = serve_worker_socket()
+        threading.Thread(target=watch_parent, args=(server,), name='mcp-watch-parent', daemon=True).start()
+    # SIGTERM: dejar de aceptar y drenar (shutdown() no puede llamarse desde el hilo de serve_forever)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    drain(server, MCP_DRAIN_TIMEOUT)
+    if worker_server is not None:
+        worker_server.shutdown()
+        worker_server.server_close()
+        try:
+            os.unlink(worker_socket(os.getpid()))
+        except OSError:
+            pass
+    print("\n[STOP] MCP Server NEON detenido" if MCP_WORKER_SLOT is None
+          else "[STOP] Worker " + str(MCP_WORKER_SLOT) + " (pid " + str(os.getpid()) + ") detenido")
@@ -128,6 +128,10 @@ contextBridge.exposeInMainWorld('sandraAPI', {
   mcpListTools: () => ipcRenderer.invoke('mcp:listTools'),
   mcpGetPort: () => ipcRenderer.invoke('mcp:getPort'),
 
+  // MCP Server NEON: estado de /ready ({ wait: true } espera al arranque) y llamadas solo cuando está listo
+  neonReady: (options) => ipcRenderer.invoke('neon:ready', options),
+  neonCall: (calls, options) => ipcRenderer.invoke('neon:call', { calls, options }),
+
   // Memoria persistente
   memoryList: () => ipcRenderer.invoke('memory:list'),
   memoryStore: (key, value, tags) => ipcRenderer.invoke('memory:store', { key, value, tags }),
@@ -1,11 +1,17 @@
 // 🤖 CHATGPT INTEGRATION — versión ligera (sin Selenium)
 // Igual que claude-integration.js, pero para ChatGPT
 
-const { exec } = require('child_process');
+const { exec, spawn } = require('child_process');
 const path = require('path');
+const readline = require('readline');
 
 const CHATGPT_WRAPPER = path.resolve(__dirname, 'chatgpt_wrapper.py');
 
+// Daemon `chatgpt_wrapper.py serve`: un solo proceso Python con la sesión HTTP caliente
+let daemon = null;
+let daemonSeq = 0;
+const daemonPending = new Map();
+
 function isPythonAvailable() {
   return new Promise((resolve) => {
     exec('python --version', (err) => {
@@ -14,41 +20,23 @@ function isPythonAvailable() {
   });
 }
 
+// chatId: el `chat_id` devuelto por una respuesta anterior continúa esa conversación
 async function useChatGPT(prompt, options = {}) {
-  const { chatId = null, fallbackToQwen = true, timeout = 120000 } = options;
+  const { chatId = null, fallbackToQwen = true, timeout = 120000, onDelta = null, cache = undefined } = options;
 
   try {
     const hasPython = await isPythonAvailable();
     if (!hasPython) throw new Error("Python no disponible → usando Qwen");
 
-    // Llamar a wrapper Python
-    const args = ['send_message', prompt];
-    if (chatId) args.unshift('--chat-id', chatId);
-
-    const cmd = `python "${CHATGPT_WRAPPER}" ${args.map(arg => JSON.stringify(arg)).join(' ')}`;
-    
-    return new Promise((resolve, reject) => {
-      const child = exec(cmd, { timeout, maxBuffer: 1024 * 1024 * 10 });
-      let stdout = '', stderr = '';
-
-      child.stdout?.on('data', d => stdout += d);
-      child.stderr?.on('data', d => stderr += d);
-
-      child.on('close', (code) => {
-        if (code === 0) {
-          try {
-            const result = JSON.parse(stdout.trim());
-            resolve(result);
-          } catch (e) {
-            resolve({ error: `JSON falló: ${stdout}` });
-          }
-        } else {
-          resolve({ error: `Exit ${code}: ${stderr || stdout}` });
-        }
-      });
+    const params = { prompt };
+    if (chatId) params.chat_id = chatId;
+    if (cache !== undefined) params.cache = cache;
 
-      child.on('error', (err) => resolve({ error: `Exec: ${err.message}` }));
-    });
+    const result = onDelta
+      ? await callChatGPT('stream_message', params, timeout, onDelta)
+      : await callChatGPT('send_message', params, timeout);
+    if (result.error && !result.success) throw new Error(result.error);
+    return result;
 
   } catch (e) {
     console.warn(`⚠️ ChatGPT falló: ${e.message}`);
@@ -60,5 +48,135 @@ async function useChatGPT(prompt, options = {}) {
   }
 }
 
-module.exports = { useChatGPT };
-exports.useChatGPT = useChatGPT;
\ No newline at end of file
+// 🔌 Arranca (una vez) el daemon JSON-RPC; se resuelve cuando responde a un ping
+function getDaemon() {
+  if (daemon) return daemon;
+
+  const child = spawn('python', [CHATGPT_WRAPPER, 'serve'], { stdio: ['pipe', 'pipe', 'pipe'] });
+
+  readline.createInterface({ input: child.stdout }).on('line', (line) => {
+    let msg;
+    try {
+      msg = JSON.parse(line);
+    } catch (e) {
+      return;
+    }
+    if (msg.method === 'delta') {
+      const streaming = msg.params && daemonPending.get(msg.params.id);
+      if (streaming && streaming.onDelta) streaming.onDelta(msg.params.text);
+      return;
+    }
+    const pending = daemonPending.get(msg.id);
+    if (!pending) return;
+    daemonPending.delete(msg.id);
+    clearTimeout(pending.timer);
+    pending.resolve(msg.error ? { error: msg.error.message } : msg.result);
+  });
+
+  child.stderr.on('data', (data) => {
+    const msg = data.toString().trim();
+    if (msg) console.warn(`[chatgpt_wrapper] ${msg}`);
+  });
+
+  child.stdin.on('error', (err) => {
+    console.warn(`[chatgpt_wrapper] stdin: ${err.message}`);
+  });
+
+  const ready = new Promise((resolve, reject) => {
+    const onExit = (reason) => {
+      if (daemon === ready) daemon = null;
+      for (const [id, pending] of daemonPending) {
+        clearTimeout(pending.timer);
+        pending.resolve({ error: `Daemon terminado: ${reason}` });
+        daemonPending.delete(id);
+      }
+      reject(new Error(reason));
+    };
+    child.on('exit', (code) => onExit(`exit ${code}`));
+    child.on('error', (err) => onExit(err.message));
+
+    sendToDaemon(child, 'ping', {}, 15000).then((res) => {
+      if (res && res.pong) {
+        resolve(child);
+      } else {
+        child.kill();
+        reject(new Error(res && res.error ? res.error : 'ping sin respuesta'));
+      }
+    });
+  });
+  ready.catch(() => {});
+
+  daemon = ready;
+  return ready;
+}
+
+function sendToDaemon(child, method, params, timeout, onDelta = null) {
+  return new Promise((resolve) => {
+    const id = ++daemonSeq;
+    const timer = setTimeout(() => {
+      daemonPending.delete(id);
+      resolve({ error: `Timeout (${timeout} ms) esperando a chatgpt_wrapper` });
+    }, timeout);
+    daemonPending.set(id, { resolve, timer, onDelta });
+    try {
+      child.stdin.write(JSON.stringify({ jsonrpc: '2.0', id, method, params }) + '\n');
+    } catch (e) {
+      daemonPending.delete(id);
+      clearTimeout(timer);
+      resolve({ error: `Daemon no disponible: ${e.message}` });
+    }
+  });
+}
+
+// 📨 Llamada al daemon; si no arranca, un proceso por orden
+async function callChatGPT(method, params = {}, timeout = 120000, onDelta = null) {
+  let child;
+  try {
+    child = await getDaemon();
+  } catch (e) {
+    console.warn(`⚠️ Daemon chatgpt_wrapper no disponible (${e.message}) → un proceso por orden`);
+    const args = [method];
+    if (params.prompt !== undefined) args.push(params.prompt);
+    if (params.chat_id) args.unshift('--chat-id', params.chat_id);
+    if (params.cache !== undefined) args.push(params.cache ? '--cache' : '--no-cache');
+    return runPython(args, timeout);
+  }
+  return sendToDaemon(child, method, params, timeout, onDelta);
+}
+
+function stopChatGPTDaemon() {
+  if (daemon) {
+    const ready = daemon;
+    daemon = null;
+    ready.then((child) => child.stdin.end(), () => {});
+  }
+}
+
+function runPython(args, timeout = 120000) {
+  return new Promise((resolve) => {
+    const cmd = `python "${CHATGPT_WRAPPER}" ${args.map(arg => JSON.stringify(arg)).join(' ')}`;
+    const child = exec(cmd, { timeout, maxBuffer: 1024 * 1024 * 10 });
+    let stdout = '', stderr = '';
+
+    child.stdout?.on('data', d => stdout += d);
+    child.stderr?.on('data', d => stderr += d);
+
+    child.on('close', (code) => {
+      if (code === 0) {
+        try {
+          const result = JSON.parse(stdout.trim());
+          resolve(result);
+        } catch (e) {
+          resolve({ error: `JSON falló: ${stdout}` });
+        }
+      } else {
+        resolve({ error: `Exit ${code}: ${stderr || stdout}` });
+      }
+    });
+
+    child.on('error', (err) => resolve({ error: `Exec: ${err.message}` }));
+  });
+}
+
+module.exports = { useChatGPT, callChatGPT, stopChatGPTDaemon };
+exports.useChatGPT = useChatGPT;
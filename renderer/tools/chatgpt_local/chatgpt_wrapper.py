@@ -2,12 +2,55 @@
 """
 Wrapper ligero para ChatGPT — sin Selenium, solo requests
 Requiere cookie de chat.openai.com
+
+Modos:
+  python chatgpt_wrapper.py [--chat-id ID] send_message <prompt>   → una orden por proceso
+  python chatgpt_wrapper.py serve                                   → daemon JSON-RPC por stdin/stdout
+
+La respuesta se lee en streaming y el `chat_id` devuelto es el conversation_id
+de ChatGPT. Pasandolo en la siguiente llamada (--chat-id o params.chat_id) el
+mensaje continua esa conversacion desde su ultimo mensaje, asi el servidor
+conserva el contexto y no hay que reenviarlo. El ultimo message_id de cada
+conversacion se guarda en CHATGPT_STATE_PATH.
+
+El modo `serve` sigue el mismo protocolo que claude_wrapper.py: una peticion
+JSON-RPC 2.0 por linea, notificaciones `delta` con el texto que va llegando en
+`stream_message`, y `ping` / `shutdown`.
 """
 
 import sys
 import json
 import os
+import uuid
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+
+# response_cache.py vive en renderer/tools, compartido con claude_local
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import response_cache
+
+MODEL = "text-davinci-002-render-sha"
+URL = os.getenv("CHATGPT_API_URL", "https://chatgpt.com/backend-api/conversation")
+
+STATE_PATH = os.getenv(
+    "CHATGPT_STATE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sandra", "chatgpt_state.json"),
+)
+SERVE_WORKERS = int(os.getenv("CHATGPT_WRAPPER_WORKERS", 4))
+
+# Sesion HTTP compartida: keep-alive entre mensajes del mismo proceso
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=SERVE_WORKERS))
+
+state_lock = threading.Lock()
+# conversation_id -> [lock, usuarios]; la entrada se borra al salir el ultimo
+conversation_locks = {}
+# Sin on_delta, read_stream solo parsea uno de cada READ_STREAM_BATCH eventos
+READ_STREAM_BATCH = 16
+
 
 def get_secrets():
     secrets_path = os.path.join(os.path.dirname(__file__), 'secrets', 'chatgpt_cookies.json')
@@ -16,7 +59,79 @@ def get_secrets():
     with open(secrets_path, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def send_to_chatgpt(prompt):
+
+def load_state():
+    try:
+        with open(STATE_PATH, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_parent(conversation_id, message_id):
+    """Recordar el ultimo mensaje de la conversacion (escritura atomica)"""
+    with state_lock:
+        data = load_state()
+        data[conversation_id] = {"parent_message_id": message_id}
+        os.makedirs(os.path.dirname(STATE_PATH) or ".", exist_ok=True)
+        tmp_path = f"{STATE_PATH}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, STATE_PATH)
+
+
+@contextmanager
+def conversation_lock(conversation_id):
+    # Los mensajes de una misma conversacion van en serie: cada uno cuelga del anterior
+    with state_lock:
+        entry = conversation_locks.setdefault(conversation_id, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with state_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del conversation_locks[conversation_id]
+
+
+def send_to_chatgpt(prompt, chat_id=None, cache=None, on_delta=None, on_open=None):
+    """
+    Enviar `prompt` (continuando `chat_id` si se da) y devolver el dict de respuesta.
+    `cache`: True/False fuerza o salta la cache de respuestas (por defecto RESPONSE_CACHE).
+    `on_delta` recibe el texto nuevo segun llega.
+    `on_open` recibe la respuesta HTTP abierta; cerrarla desde otro hilo cancela la lectura.
+    """
+    if not response_cache.use_cache({"cache": cache}):
+        return send_uncached(prompt, chat_id, on_delta, on_open)
+
+    store = response_cache.get_cache()
+    # En una conversacion la respuesta depende de su historial: la clave incluye el ultimo mensaje
+    context = ""
+    if chat_id:
+        context = f"{chat_id}:{load_state().get(chat_id, {}).get('parent_message_id', '')}"
+    key = response_cache.make_key("chatgpt", MODEL, prompt, context=context)
+    hit = store.get(key)
+    if hit is not None:
+        if on_delta:
+            on_delta(hit["answer"])
+        return dict(hit, cached=True)
+    result = send_uncached(prompt, chat_id, on_delta, on_open)
+    if result.get("success") and result.get("answer"):
+        store.put(key, "chatgpt", result)
+    return result
+
+
+def send_uncached(prompt, chat_id=None, on_delta=None, on_open=None):
+    if chat_id:
+        with conversation_lock(chat_id):
+            return post_message(prompt, chat_id, on_delta, on_open)
+    return post_message(prompt, None, on_delta, on_open)
+
+
+def post_message(prompt, chat_id, on_delta, on_open=None):
     secrets = get_secrets()
     if not secrets:
         return {"error": "Falta chatgpt_cookies.json"}
@@ -24,53 +139,186 @@ def send_to_chatgpt(prompt):
     headers = {
         "Authorization": f"Bearer {secrets['session_token']}",
         "Content-Type": "application/json",
+        "Accept": "text/event-stream",
         "User-Agent": secrets.get("user_agent", "Mozilla/5.0"),
     }
 
     # Endpoint público (no oficial)
-    url = "https://chatgpt.com/backend-api/conversation"
-    
     payload = {
         "action": "next",
         "messages": [{
-            "id": "123",
+            "id": str(uuid.uuid4()),
             "role": "user",
             "content": {"content_type": "text", "parts": [prompt]}
         }],
-        "model": "text-davinci-002-render-sha",
-        "parent_message_id": "000"
+        "model": MODEL,
     }
+    warning = None
+    parent = load_state().get(chat_id, {}).get("parent_message_id") if chat_id else None
+    if parent:
+        payload["conversation_id"] = chat_id
+        payload["parent_message_id"] = parent
+    else:
+        # Conversacion nueva (o chat_id sin estado guardado: no se puede continuar)
+        if chat_id:
+            warning = f"Conversacion desconocida {chat_id}: se abre una nueva"
+        payload["parent_message_id"] = str(uuid.uuid4())
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
-        if response.status_code == 200:
-            # Parsear stream de eventos
-            text = ""
-            for line in response.text.splitlines():
-                if line.startswith("data: ") and "message" in line:
-                    try:
-                        data = json.loads(line[6:])
-                        if "message" in data and "content" in data["message"]:
-                            parts = data["message"]["content"]["parts"]
-                            if parts:
-                                text = parts[0]
-                    except:
-                        pass
-            return {"success": True, "answer": text, "source": "chatgpt"}
-        else:
-            return {"error": f"HTTP {response.status_code}: {response.text[:200]}"}
+        with http.post(URL, headers=headers, json=payload, timeout=120, stream=True) as response:
+            if response.status_code != 200:
+                return {"error": f"HTTP {response.status_code}: {response.text[:200]}"}
+            if on_open:
+                on_open(response)
+            text, conversation_id, message_id = read_stream(response, on_delta)
     except Exception as e:
         return {"error": str(e)}
 
+    if conversation_id and message_id:
+        save_parent(conversation_id, message_id)
+    result = {"success": True, "answer": text, "source": "chatgpt", "chat_id": conversation_id or chat_id}
+    if warning:
+        result["warning"] = warning
+    return result
+
+
+def read_stream(response, on_delta=None):
+    """
+    Leer el SSE segun llega. Cada evento trae el texto acumulado en `parts[0]`:
+    con `on_delta` se parsea cada uno para emitir la parte nueva; sin el, los
+    eventos se acumulan sin parsear y cada READ_STREAM_BATCH se comprueba el
+    ultimo: si es valido descarta los anteriores. Al final gana el ultimo evento
+    que parse_event acepta.
+    """
+    text = ""
+    last = None
+    pending = []
+    for line in response.iter_lines(chunk_size=None):
+        if not line.startswith(b"data: "):
+            continue
+        data = line[6:]
+        if data == b"[DONE]":
+            break
+        if b'"message"' not in data:
+            continue
+        if on_delta is None:
+            pending.append(data)
+            if len(pending) >= READ_STREAM_BATCH:
+                event = parse_event(data)
+                if event is not None:
+                    last = event
+                    pending.clear()
+            continue
+        event = parse_event(data)
+        if event is None:
+            continue
+        last = event
+        snapshot = event[0]
+        if snapshot.startswith(text) and len(snapshot) > len(text):
+            on_delta(snapshot[len(text):])
+        text = snapshot
+
+    for data in reversed(pending):
+        event = parse_event(data)
+        if event is not None:
+            last = event
+            break
+    if last is None:
+        return text, None, None
+    return last
+
+
+def parse_event(data):
+    """(texto acumulado, conversation_id, message_id) de un evento, o None"""
+    try:
+        event = json.loads(data)
+        message = event["message"]
+        if message.get("author", {}).get("role", "assistant") != "assistant":
+            return None
+        parts = message["content"]["parts"]
+        text = parts[0] if parts and isinstance(parts[0], str) else ""
+        return text, event.get("conversation_id"), message.get("id")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+def run_command(cmd, params, on_delta=None):
+    """Ejecutar una orden y devolver el dict que se imprime como JSON"""
+    if cmd in ("send_message", "stream_message"):
+        if params.get("prompt") is None:
+            return {"error": f"{cmd} <prompt>"}
+        return send_to_chatgpt(
+            params["prompt"],
+            params.get("chat_id"),
+            params.get("cache"),
+            on_delta if cmd == "stream_message" else None,
+        )
+    elif cmd == "cache_stats":
+        return response_cache.get_cache().stats()
+    return {"error": f"Comando desconocido: {cmd}"}
+
+
+def serve():
+    """Daemon JSON-RPC: una peticion por linea en stdin, una respuesta por linea en stdout"""
+    write_lock = threading.Lock()
+
+    def reply(data):
+        with write_lock:
+            sys.stdout.write(json.dumps(data) + "\n")
+            sys.stdout.flush()
+
+    def handle(req):
+        req_id = req.get("id")
+        method = req.get("method")
+        try:
+            if method == "ping":
+                result = {"pong": True}
+            else:
+                on_delta = lambda text: reply({"jsonrpc": "2.0", "method": "delta", "params": {"id": req_id, "text": text}})
+                result = run_command(method, req.get("params") or {}, on_delta)
+            reply({"jsonrpc": "2.0", "id": req_id, "result": result})
+        except Exception as e:
+            reply({"jsonrpc": "2.0", "id": req_id, "error": {"code": -32000, "message": str(e)}})
+
+    with ThreadPoolExecutor(max_workers=SERVE_WORKERS) as executor:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                req = json.loads(line)
+            except ValueError as e:
+                reply({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": str(e)}})
+                continue
+            if req.get("method") == "shutdown":
+                reply({"jsonrpc": "2.0", "id": req.get("id"), "result": {"stopping": True}})
+                break
+            executor.submit(handle, req)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(json.dumps({"error": "Uso: send_message <prompt>"}))
+    args = sys.argv[1:]
+    params = {}
+    if "--cache" in args or "--no-cache" in args:
+        params["cache"] = "--cache" in args
+    args = [arg for arg in args if arg not in ("--cache", "--no-cache")]
+    if "--chat-id" in args:
+        i = args.index("--chat-id")
+        params["chat_id"] = args[i + 1] if i + 1 < len(args) else None
+        del args[i:i + 2]
+
+    if not args:
+        print(json.dumps({"error": "Uso: [--chat-id ID] send_message <prompt> | serve"}))
         sys.exit(1)
 
-    cmd = sys.argv[1]
-    if cmd == "send_message":
-        prompt = sys.argv[2]
-        result = send_to_chatgpt(prompt)
-        print(json.dumps(result))
+    cmd = args[0]
+    if cmd == "serve":
+        serve()
+    elif cmd in ("send_message", "stream_message"):
+        if len(args) < 2:
+            print(json.dumps({"error": "Uso: [--chat-id ID] send_message <prompt>"}))
+            sys.exit(1)
+        params["prompt"] = args[1]
+        print(json.dumps(run_command(cmd, params)))
     else:
-        print(json.dumps({"error": f"Comando desconocido: {cmd}"}))
\ No newline at end of file
+        print(json.dumps(run_command(cmd, params)))
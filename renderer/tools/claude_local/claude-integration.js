@@ -2,11 +2,17 @@
 // Copia este archivo a: renderer/orchestrator/claude-bridge.js
 // Luego: import { useClaude } from './orchestrator/claude-bridge.js';
 
-const { exec } = require('child_process');
+const { exec, spawn } = require('child_process');
 const path = require('path');
+const readline = require('readline');
 
 const CLAUDE_WRAPPER = path.resolve(__dirname, '../tools/claude_local/claude_wrapper.py');
 
+// Daemon `claude_wrapper.py serve`: un solo proceso Python con el cliente ya caliente
+let daemon = null;
+let daemonSeq = 0;
+const daemonPending = new Map();
+
 // 🧪 Probar si Python está accesible desde Node
 function isPythonAvailable() {
   return new Promise((resolve) => {
@@ -22,7 +28,9 @@ async function useClaude(prompt, options = {}) {
     chatId = null, 
     attachments = [], 
     fallbackToQwen = true,
-    timeout = 120000 
+    timeout = 120000,
+    onDelta = null,
+    cache = undefined   // true/false fuerza o salta la caché de respuestas (RESPONSE_CACHE)
   } = options;
 
   try {
@@ -33,15 +41,21 @@ async function useClaude(prompt, options = {}) {
 
     // 1. Crear chat si no hay ID
     let currentChatId = chatId;
+    const fresh = !currentChatId;
     if (!currentChatId) {
-      const createRes = await runPython(['create_chat']);
+      const createRes = await callClaude('create_chat', {}, timeout);
       if (createRes.error) throw new Error(createRes.error);
       currentChatId = createRes.chat_id;
       if (!currentChatId) throw new Error("No se pudo crear chat en Claude");
     }
 
-    // 2. Enviar mensaje
-    const sendRes = await runPython(['send_message', currentChatId, prompt]);
+    // 2. Enviar mensaje (con onDelta, el texto llega por fragmentos según se genera)
+    // `fresh`: chat sin historial, la respuesta cacheada no depende del chat_id
+    const sendParams = { chat_id: currentChatId, prompt, fresh };
+    if (cache !== undefined) sendParams.cache = cache;
+    const sendRes = onDelta
+      ? await callClaude('stream_message', sendParams, timeout, onDelta)
+      : await callClaude('send_message', sendParams, timeout);
     if (sendRes.error || !sendRes.answer) {
       throw new Error(`Claude error: ${sendRes.error || 'no answer'}`);
     }
@@ -77,6 +91,114 @@ async function useClaude(prompt, options = {}) {
   }
 }
 
+// 🔌 Arranca (una vez) el daemon JSON-RPC y enruta las respuestas por id.
+// Devuelve una promesa que se resuelve con el proceso cuando responde a un ping;
+// si Python no existe o el daemon muere antes, se rechaza.
+function getDaemon() {
+  if (daemon) return daemon;
+
+  const child = spawn('python', [CLAUDE_WRAPPER, 'serve'], { stdio: ['pipe', 'pipe', 'pipe'] });
+
+  readline.createInterface({ input: child.stdout }).on('line', (line) => {
+    let msg;
+    try {
+      msg = JSON.parse(line);
+    } catch (e) {
+      return;
+    }
+    if (msg.method === 'delta') {
+      const streaming = msg.params && daemonPending.get(msg.params.id);
+      if (streaming && streaming.onDelta) streaming.onDelta(msg.params.text);
+      return;
+    }
+    const pending = daemonPending.get(msg.id);
+    if (!pending) return;
+    daemonPending.delete(msg.id);
+    clearTimeout(pending.timer);
+    pending.resolve(msg.error ? { error: msg.error.message } : msg.result);
+  });
+
+  child.stderr.on('data', (data) => {
+    const msg = data.toString().trim();
+    if (msg) console.warn(`[claude_wrapper] ${msg}`);
+  });
+
+  // EPIPE al escribir en un daemon muerto: se gestiona en 'exit'/'error', no debe tumbar Electron
+  child.stdin.on('error', (err) => {
+    console.warn(`[claude_wrapper] stdin: ${err.message}`);
+  });
+
+  const ready = new Promise((resolve, reject) => {
+    const onExit = (reason) => {
+      if (daemon === ready) daemon = null;
+      for (const [id, pending] of daemonPending) {
+        clearTimeout(pending.timer);
+        pending.resolve({ error: `Daemon terminado: ${reason}` });
+        daemonPending.delete(id);
+      }
+      reject(new Error(reason));
+    };
+    child.on('exit', (code) => onExit(`exit ${code}`));
+    child.on('error', (err) => onExit(err.message));
+
+    sendToDaemon(child, 'ping', {}, 15000).then((res) => {
+      if (res && res.pong) {
+        resolve(child);
+      } else {
+        child.kill();
+        reject(new Error(res && res.error ? res.error : 'ping sin respuesta'));
+      }
+    });
+  });
+  // Evitar "unhandled rejection" si nadie espera la promesa
+  ready.catch(() => {});
+
+  daemon = ready;
+  return ready;
+}
+
+function sendToDaemon(child, method, params, timeout, onDelta = null) {
+  return new Promise((resolve) => {
+    const id = ++daemonSeq;
+    const timer = setTimeout(() => {
+      daemonPending.delete(id);
+      resolve({ error: `Timeout (${timeout} ms) esperando a claude_wrapper` });
+    }, timeout);
+    daemonPending.set(id, { resolve, timer, onDelta });
+    try {
+      child.stdin.write(JSON.stringify({ jsonrpc: '2.0', id, method, params }) + '\n');
+    } catch (e) {
+      daemonPending.delete(id);
+      clearTimeout(timer);
+      resolve({ error: `Daemon no disponible: ${e.message}` });
+    }
+  });
+}
+
+// 📨 Llamada JSON-RPC al daemon; si no arranca, vuelve al modo un-proceso-por-orden
+async function callClaude(method, params = {}, timeout = 120000, onDelta = null) {
+  let child;
+  try {
+    child = await getDaemon();
+  } catch (e) {
+    console.warn(`⚠️ Daemon claude_wrapper no disponible (${e.message}) → un proceso por orden`);
+    const args = (method === 'send_message' || method === 'stream_message') ? [method, params.chat_id, params.prompt]
+      : method === 'delete_chat' ? [method, params.chat_id] : [method];
+    if (params.cache !== undefined) args.push(params.cache ? '--cache' : '--no-cache');
+    if (params.fresh) args.push('--fresh');
+    return runPython(args);
+  }
+  return sendToDaemon(child, method, params, timeout, onDelta);
+}
+
+function stopClaudeDaemon() {
+  if (daemon) {
+    const ready = daemon;
+    daemon = null;
+    ready.then((child) => child.stdin.end(), () => {});
+  }
+}
+
 // 🐍 Ejecuta wrapper Python con timeout y captura JSON
 function runPython(args) {
   return new Promise((resolve, reject) => {
@@ -110,5 +232,5 @@ function runPython(args) {
 }
 
 // 🧩 Export
-module.exports = { useClaude, runPython };
+module.exports = { useClaude, runPython, callClaude, stopClaudeDaemon };
 exports.useClaude = useClaude;
\ No newline at end of file
@@ -3,14 +3,24 @@ from .client import (
     ClaudeAPIClient,
     SendMessageResponse,
     HTTPProxy,
+    create_http_session,
 )
+from .async_client import AsyncClaudeAPIClient
+from .stream import MessageStream, AsyncMessageStream, SSEParser
+from .scheduler import ClaudeScheduler
 from .session import SessionData, get_session_data
 from .errors import ClaudeAPIError, MessageRateLimitError, OverloadError
 
 __all__ = [
     "ClaudeAPIClient",
+    "AsyncClaudeAPIClient",
     "SendMessageResponse",
     "HTTPProxy",
+    "create_http_session",
+    "MessageStream",
+    "AsyncMessageStream",
+    "SSEParser",
+    "ClaudeScheduler",
     "SessionData",
     "get_session_data",
     "MessageRateLimitError",
@@ -0,0 +1,264 @@
+"""Async client module — misma API que ClaudeAPIClient sobre asyncio + httpx"""
+import asyncio
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps, loads
+from time import perf_counter
+from typing import Optional
+from uuid import uuid4
+
+from tzlocal import get_localzone
+from .session import SessionData
+from .errors import ClaudeAPIError, MessageRateLimitError, OverloadError
+from .stream import AsyncMessageStream, raise_for_error
+from .client import (
+    DEFAULT_METADATA_CACHE,
+    HTTPProxy,
+    SendMessageResponse,
+    CHAT_FILES_MAX,
+    _load_metadata,
+    _save_metadata,
+)
+from .attachments import MultipartFileBody, file_sha256, is_inline_text, prepare_text_file_attachment
+
+
+def _import_httpx():
+    # httpx es opcional: solo hace falta para el cliente asíncrono
+    try:
+        import httpx
+    except ImportError as e:
+        raise ImportError("AsyncClaudeAPIClient requires httpx (pip install httpx)") from e
+    return httpx
+
+
+class AsyncClaudeAPIClient:
+    """
+    Cliente asíncrono para llevar muchas conversaciones a la vez desde un solo hilo.
+
+    `max_concurrency` limita las peticiones en vuelo (un stream abierto ocupa su
+    hueco hasta que termina o se cierra) y el tamaño del pool de conexiones.
+    Cancelar la tarea que lee un stream cierra la conexión de inmediato.
+    """
+
+    __BASE_URL = "https://claude.ai"
+
+    def __init__(
+        self,
+        session: SessionData,
+        model_name: str = None,
+        proxy: HTTPProxy = None,
+        timeout: float = 240,
+        max_concurrency: int = 8,
+        metadata_cache_path: Optional[str] = DEFAULT_METADATA_CACHE,
+        base_url: str = None,
+    ) -> None:
+        httpx = _import_httpx()
+        if base_url:
+            self.__BASE_URL = base_url.rstrip("/")
+        self.model_name = model_name
+        self.timeout = timeout
+        self.proxy = proxy
+        self.__session = session
+        if not self.__session.cookie or not self.__session.user_agent:
+            raise ValueError("Invalid SessionData: cookie and user_agent required")
+
+        self.__http = httpx.AsyncClient(
+            timeout=timeout,
+            proxy=proxy.url if proxy else None,
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency),
+        )
+        self.__slots = asyncio.Semaphore(max_concurrency)
+        self.__metadata_cache_path = metadata_cache_path
+        self.__cookie_hash = sha256(self.__session.cookie.encode("utf-8")).hexdigest()
+        self.__bootstrap_lock = asyncio.Lock()
+        self.__chat_files: OrderedDict[str, dict] = OrderedDict()
+
+        cached = _load_metadata(metadata_cache_path).get(self.__cookie_hash, {}) if metadata_cache_path else {}
+        if self.__session.organization_id is None:
+            self.__session.organization_id = cached.get("organization_id")
+        self.timezone = cached.get("timezone")
+
+    async def __aenter__(self) -> "AsyncClaudeAPIClient":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Cerrar las conexiones HTTP del pool"""
+        await self.__http.aclose()
+
+    def __headers(self, content_type: str = None, accept: str = None) -> dict:
+        headers = {
+            "Cookie": self.__session.cookie,
+            "User-Agent": self.__session.user_agent,
+        }
+        if content_type:
+            headers["Content-Type"] = content_type
+        if accept:
+            headers["Accept"] = accept
+        return headers
+
+    def __save_metadata(self, **values) -> None:
+        if self.__metadata_cache_path:
+            _save_metadata(self.__metadata_cache_path, self.__cookie_hash, values)
+
+    async def get_organization_id(self) -> str:
+        """ID de organización; se pide a /api/organizations solo si no estaba en caché"""
+        if self.__session.organization_id is None:
+            async with self.__bootstrap_lock:
+                if self.__session.organization_id is None:
+                    async with self.__slots:
+                        response = await self.__http.get(
+                            f"{self.__BASE_URL}/api/organizations",
+                            headers=self.__headers(accept="application/json"),
+                        )
+                    j = response.json() if response.status_code == 200 else None
+                    if not (j and isinstance(j, list) and "uuid" in j[0]):
+                        raise RuntimeError(f"Cannot retrieve Organization ID (status {response.status_code})")
+                    self.__session.organization_id = j[0]["uuid"]
+                    self.__save_metadata(organization_id=self.__session.organization_id)
+        return self.__session.organization_id
+
+    def __get_timezone(self) -> str:
+        if self.timezone is None:
+            self.timezone = get_localzone().key
+            self.__save_metadata(timezone=self.timezone)
+        return self.timezone
+
+    async def __upload_file(self, file_path: str) -> str:
+        """Subir un fichero en streaming (lecturas en un hilo) y devolver su file_uuid"""
+        body = MultipartFileBody(file_path)
+        chunks = iter(body)
+
+        async def content():
+            while True:
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    return
+                yield chunk
+
+        org_id = await self.get_organization_id()
+        headers = self.__headers(body.content_type)
+        headers["Content-Length"] = str(len(body))
+        async with self.__slots:
+            response = await self.__http.post(f"{self.__BASE_URL}/api/{org_id}/upload", headers=headers, content=content())
+        if response.status_code == 200:
+            file_uuid = response.json().get("file_uuid")
+            if file_uuid:
+                return file_uuid
+        raise ClaudeAPIError(f"Upload failed for {file_path}: {response.status_code}")
+
+    async def __prepare_attachment(self, chat_id: str, file_path: str) -> tuple[str, object]:
+        """Como en ClaudeAPIClient: texto en línea o subida, deduplicado por sha256 en cada chat"""
+        digest = await asyncio.to_thread(file_sha256, file_path)
+        known = self.__chat_files.get(chat_id, {}).get(digest)
+        if known is not None:
+            return known
+        if is_inline_text(file_path):
+            item = ("attachments", await asyncio.to_thread(prepare_text_file_attachment, file_path))
+        else:
+            item = ("files", await self.__upload_file(file_path))
+        self.__chat_files.setdefault(chat_id, {})[digest] = item
+        self.__chat_files.move_to_end(chat_id)
+        while len(self.__chat_files) > CHAT_FILES_MAX:
+            self.__chat_files.popitem(last=False)
+        return item
+
+    async def create_chat(self) -> str:
+        org_id = await self.get_organization_id()
+        url = f"{self.__BASE_URL}/api/organizations/{org_id}/chat_conversations"
+        payload = dumps({"name": "", "uuid": str(uuid4())})
+        async with self.__slots:
+            response = await self.__http.post(url, headers=self.__headers("application/json"), content=payload)
+        if response.status_code == 201:
+            return response.json().get("uuid")
+        raise ClaudeAPIError(f"Create chat failed: {response.status_code}")
+
+    async def stream_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None) -> AsyncMessageStream:
+        """
+        Enviar un mensaje y devolver un `AsyncMessageStream` ya abierto. Mismas
+        reglas de error que `ClaudeAPIClient.stream_message`.
+        """
+        org_id = await self.get_organization_id()
+        items = await asyncio.gather(*(self.__prepare_attachment(chat_id, path) for path in attachment_paths or []))
+        attachments = [value for kind, value in items if kind == "attachments"]
+        files = [value for kind, value in items if kind == "files"]
+
+        url = f"{self.__BASE_URL}/api/organizations/{org_id}/chat_conversations/{chat_id}/completion"
+        payload = {
+            "prompt": prompt,
+            "timezone": self.__get_timezone(),
+            "attachments": attachments,
+            "files": files,
+        }
+        if self.model_name:
+            payload["model"] = self.model_name
+
+        await self.__slots.acquire()
+        response = None
+        try:
+            started = perf_counter()
+            request = self.__http.build_request(
+                "POST", url, headers=self.__headers("application/json", "text/event-stream"), content=dumps(payload)
+            )
+            response = await self.__http.send(request, stream=True)
+
+            async def release():
+                try:
+                    await response.aclose()
+                finally:
+                    self.__slots.release()
+
+            if response.status_code != 200:
+                body = await response.aread()
+                await release()
+                try:
+                    error = loads(body).get("error")
+                except (ValueError, AttributeError):
+                    error = None
+                if isinstance(error, dict):
+                    try:
+                        raise_for_error(error)
+                    except (MessageRateLimitError, OverloadError):
+                        raise
+                    except ClaudeAPIError:
+                        pass
+                stream = AsyncMessageStream(None, response.status_code, started)
+                stream.raw_error = body
+                return stream
+
+            return AsyncMessageStream(response.aiter_bytes(), response.status_code, started, release)
+        except BaseException:
+            # Incluye CancelledError: no dejar el hueco ni la conexión colgados
+            if response is None:
+                self.__slots.release()
+            elif not response.is_closed:
+                await response.aclose()
+                self.__slots.release()
+            raise
+
+    async def send_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None) -> SendMessageResponse:
+        """Versión bloqueante (para la corrutina) de `stream_message`"""
+        stream = await self.stream_message(chat_id, prompt, attachment_paths)
+        try:
+            answer = await stream.text()
+        except (MessageRateLimitError, OverloadError):
+            raise
+        except ClaudeAPIError as e:
+            return SendMessageResponse(None, stream.status_code, str(e).encode())
+        finally:
+            await stream.aclose()
+
+        if stream.status_code != 200:
+            return SendMessageResponse(None, stream.status_code, stream.raw_error)
+        return SendMessageResponse(answer.strip(), stream.status_code, b"")
+
+    async def delete_chat(self, chat_id: str) -> bool:
+        org_id = await self.get_organization_id()
+        url = f"{self.__BASE_URL}/api/organizations/{org_id}/chat_conversations/{chat_id}"
+        async with self.__slots:
+            response = await self.__http.request(
+                "DELETE", url, headers=self.__headers("application/json"), content=f'"{chat_id}"'
+            )
+        return response.status_code == 204
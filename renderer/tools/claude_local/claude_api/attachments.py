@@ -0,0 +1,100 @@
+"""Attachments module — digests, texto en línea y cuerpos multipart en streaming"""
+from hashlib import sha256
+from mimetypes import guess_type
+from os import path as ospath, stat
+from threading import Lock
+from typing import Iterator
+from uuid import uuid4
+
+READ_CHUNK = 256 * 1024
+"""Tamaño de lectura al calcular digests y al subir ficheros"""
+
+TEXT_INLINE_MAX = 1024 * 1024
+"""Los ficheros de texto hasta este tamaño van en línea (`attachments`); los mayores se suben"""
+
+TEXT_TYPES = {"application/json", "application/xml", "application/javascript", "application/x-sh"}
+
+_digest_cache: dict[tuple, str] = {}
+_digest_lock = Lock()
+
+
+def file_sha256(file_path: str) -> str:
+    """
+    sha256 del contenido leyendo por trozos. Se recuerda por (ruta, tamaño, mtime)
+    para no volver a leer un fichero que no ha cambiado.
+    """
+    st = stat(file_path)
+    key = (ospath.abspath(file_path), st.st_size, st.st_mtime_ns)
+    with _digest_lock:
+        digest = _digest_cache.get(key)
+    if digest is not None:
+        return digest
+    h = sha256()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    with _digest_lock:
+        if len(_digest_cache) >= 4096:
+            _digest_cache.clear()
+        _digest_cache[key] = digest
+    return digest
+
+
+def get_content_type(file_path: str) -> str:
+    mime_type, _ = guess_type(file_path)
+    return mime_type or "application/octet-stream"
+
+
+def is_inline_text(file_path: str) -> bool:
+    """¿Se manda como texto extraído en `attachments` en lugar de subirse?"""
+    mime_type = get_content_type(file_path)
+    is_text = mime_type.startswith("text/") or mime_type in TEXT_TYPES
+    return is_text and ospath.getsize(file_path) <= TEXT_INLINE_MAX
+
+
+def prepare_text_file_attachment(file_path: str) -> dict:
+    file_name = ospath.basename(file_path)
+    file_size = ospath.getsize(file_path)
+    with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
+        file_content = file.read()
+    return {
+        "extracted_content": file_content,
+        "file_name": file_name,
+        "file_size": f"{file_size}",
+        "file_type": "text/plain",
+    }
+
+
+class MultipartFileBody:
+    """
+    Cuerpo multipart/form-data con un único fichero que se lee por trozos al
+    enviarlo. Define `__len__`, así que requests manda Content-Length en lugar de
+    chunked y la memoria no depende del tamaño del fichero.
+    """
+
+    def __init__(self, file_path: str, field: str = "file") -> None:
+        self.file_path = file_path
+        self.boundary = uuid4().hex
+        file_name = ospath.basename(file_path).replace("\\", "\\\\").replace('"', '\\"')
+        self.head = (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{field}"; filename="{file_name}"\r\n'
+            f"Content-Type: {get_content_type(file_path)}\r\n\r\n"
+        ).encode("utf-8")
+        self.tail = f"\r\n--{self.boundary}--\r\n".encode("ascii")
+        self.size = ospath.getsize(file_path)
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self) -> int:
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield self.head
+        with open(self.file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(READ_CHUNK), b""):
+                yield chunk
+        yield self.tail
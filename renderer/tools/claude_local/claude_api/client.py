@@ -1,21 +1,30 @@
 """Client module — versión adaptada para Sandra (sin Selenium ni brotli)"""
 
-from os import path as ospath
+from os import path as ospath, makedirs, replace as os_replace, getpid
 from re import sub, search
+from hashlib import sha256
+from threading import Lock
+from socket import SHUT_RDWR
+from time import time, perf_counter
 from typing import Optional
 from dataclasses import dataclass
 from ipaddress import IPv4Address
 from json import dumps, loads
 from uuid import uuid4
-from mimetypes import guess_type
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from zlib import decompress as zlib_decompress
 from zlib import MAX_WBITS
 
 # Usamos solo requests estándar (evitamos curl_cffi y brotli)
 from tzlocal import get_localzone
-from requests import post as requests_post, get as requests_get, delete as requests_delete
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from .session import SessionData
 from .errors import ClaudeAPIError, MessageRateLimitError, OverloadError
+from .stream import MessageStream, raise_for_error
+from .attachments import MultipartFileBody, file_sha256, is_inline_text, prepare_text_file_attachment
 
 @dataclass(frozen=True)
 class SendMessageResponse:
@@ -38,6 +47,85 @@ class HTTPProxy:
         self.proxy_port = port
         IPv4Address(self.proxy_ip)
 
+    @property
+    def url(self) -> str:
+        auth = ""
+        if self.proxy_username and self.proxy_password:
+            auth = f"{self.proxy_username}:{self.proxy_password}@"
+        scheme = "https" if self.use_ssl else "http"
+        return f"{scheme}://{auth}{self.proxy_ip}:{self.proxy_port}"
+
+# Caché en disco de organization_id y timezone, indexada por hash de la cookie
+DEFAULT_METADATA_CACHE = ospath.join(ospath.expanduser("~"), ".cache", "claude_api", "bootstrap.json")
+
+_metadata_lock = Lock()
+
+
+def _load_metadata(cache_path: str) -> dict:
+    try:
+        with open(cache_path, "r", encoding="utf-8") as f:
+            data = loads(f.read())
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_metadata(cache_path: str, cookie_hash: str, values: dict) -> None:
+    """Fusionar `values` en la entrada de la cookie; escritura atómica (tmp + rename)"""
+    with _metadata_lock:
+        try:
+            data = _load_metadata(cache_path)
+            entry = data.get(cookie_hash, {})
+            entry.update(values)
+            entry["saved_at"] = int(time())
+            data[cookie_hash] = entry
+            makedirs(ospath.dirname(cache_path) or ".", exist_ok=True)
+            tmp_path = f"{cache_path}.{getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(dumps(data))
+            os_replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+
+# Adjuntos preparados a la vez por mensaje y chats cuyo registro de ficheros se recuerda
+ATTACHMENT_WORKERS = 4
+CHAT_FILES_MAX = 64
+
+
+def abort_response(response) -> None:
+    """Cortar desde otro hilo una respuesta en streaming: shutdown del socket
+    despierta la lectura bloqueada (close() por sí solo no lo garantiza)"""
+    try:
+        sock = response.raw.connection.sock
+        if sock is not None:
+            sock.shutdown(SHUT_RDWR)
+    except (AttributeError, OSError):
+        pass
+
+
+def create_http_session(pool_size: int = 10, retries: int = 2, proxies: dict = None) -> Session:
+    """Sesión HTTP con keep-alive y pool de conexiones. Los reintentos cubren errores de
+    conexión y 502/503/504 en GET/DELETE; un POST ya enviado nunca se repite."""
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=0,
+        status=retries,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "DELETE"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    http = Session()
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    if proxies:
+        http.proxies.update(proxies)
+    return http
+
+
 class ClaudeAPIClient:
     __BASE_URL = "https://claude.ai"
 
@@ -47,7 +135,20 @@ class ClaudeAPIClient:
         model_name: str = None,
         proxy: HTTPProxy = None,
         timeout: float = 240,
+        pool_size: int = 10,
+        retries: int = 2,
+        http_session: Session = None,
+        metadata_cache_path: Optional[str] = DEFAULT_METADATA_CACHE,
+        base_url: str = None,
     ) -> None:
+        """
+        Construir el cliente no hace ninguna petición de red: `organization_id` y la
+        zona horaria salen de `metadata_cache_path` (por cookie) o se resuelven en el
+        primer uso. `http_session` permite compartir una sesión entre clientes;
+        `metadata_cache_path=None` desactiva la caché en disco.
+        """
+        if base_url:
+            self.__BASE_URL = base_url.rstrip("/")
         self.model_name = model_name
         self.timeout = timeout
         self.proxy = proxy
@@ -55,19 +156,52 @@ class ClaudeAPIClient:
         if not self.__session.cookie or not self.__session.user_agent:
             raise ValueError("Invalid SessionData: cookie and user_agent required")
 
+        self.__http = http_session or create_http_session(pool_size, retries, self.__get_proxies())
+        self.__metadata_cache_path = metadata_cache_path
+        self.__cookie_hash = sha256(self.__session.cookie.encode("utf-8")).hexdigest()
+        self.__bootstrap_lock = Lock()
+        self.__timezone = None
+        self.__attachments_lock = Lock()
+        self.__chat_files: OrderedDict[str, dict] = OrderedDict()
+
+        cached = _load_metadata(metadata_cache_path).get(self.__cookie_hash, {}) if metadata_cache_path else {}
+        if self.__session.organization_id is None:
+            self.__session.organization_id = cached.get("organization_id")
+        self.__timezone = cached.get("timezone")
+
+    @property
+    def organization_id(self) -> str:
+        """ID de organización; se pide a /api/organizations solo si no estaba en caché"""
         if self.__session.organization_id is None:
-            self.__session.organization_id = self.__get_organization_id()
-        self.timezone = get_localzone().key
+            with self.__bootstrap_lock:
+                if self.__session.organization_id is None:
+                    self.__session.organization_id = self.__get_organization_id()
+                    self.__save_metadata(organization_id=self.__session.organization_id)
+        return self.__session.organization_id
+
+    @property
+    def timezone(self) -> str:
+        if self.__timezone is None:
+            self.__timezone = get_localzone().key
+            self.__save_metadata(timezone=self.__timezone)
+        return self.__timezone
+
+    @timezone.setter
+    def timezone(self, value: str) -> None:
+        self.__timezone = value
+
+    def __save_metadata(self, **values) -> None:
+        if self.__metadata_cache_path:
+            _save_metadata(self.__metadata_cache_path, self.__cookie_hash, values)
+
+    def close(self) -> None:
+        """Cerrar las conexiones HTTP del pool"""
+        self.__http.close()
 
     def __get_proxies(self):
         if not self.proxy:
             return None
-        auth = ""
-        if self.proxy.proxy_username and self.proxy.proxy_password:
-            auth = f"{self.proxy.proxy_username}:{self.proxy.proxy_password}@"
-        scheme = "https" if self.proxy.use_ssl else "http"
-        proxy_url = f"{scheme}://{auth}{self.proxy.proxy_ip}:{self.proxy.proxy_port}"
-        return {"http": proxy_url, "https": proxy_url}
+        return {"http": self.proxy.url, "https": self.proxy.url}
 
     def __get_organization_id(self) -> str:
         url = f"{self.__BASE_URL}/api/organizations"
@@ -76,31 +210,70 @@ class ClaudeAPIClient:
             "User-Agent": self.__session.user_agent,
             "Accept": "application/json",
         }
-        response = requests_get(url, headers=headers, proxies=self.__get_proxies(), timeout=self.timeout)
+        response = self.__http.get(url, headers=headers, timeout=self.timeout)
         if response.status_code == 200:
             j = response.json()
             if j and isinstance(j, list) and len(j) > 0 and "uuid" in j[0]:
                 return j[0]["uuid"]
         raise RuntimeError(f"Cannot retrieve Organization ID (status {response.status_code})")
 
-    def __prepare_text_file_attachment(self, file_path: str) -> dict:
-        file_name = ospath.basename(file_path)
-        file_size = ospath.getsize(file_path)
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as file:
-            file_content = file.read()
-        return {
-            "extracted_content": file_content,
-            "file_name": file_name,
-            "file_size": f"{file_size}",
-            "file_type": "text/plain",
+    def __upload_file(self, file_path: str) -> str:
+        """Subir un fichero en streaming y devolver su file_uuid"""
+        body = MultipartFileBody(file_path)
+        url = f"{self.__BASE_URL}/api/{self.organization_id}/upload"
+        headers = {
+            "Cookie": self.__session.cookie,
+            "User-Agent": self.__session.user_agent,
+            "Content-Type": body.content_type,
         }
+        response = self.__http.post(url, headers=headers, data=body, timeout=self.timeout)
+        if response.status_code == 200:
+            file_uuid = response.json().get("file_uuid")
+            if file_uuid:
+                return file_uuid
+        raise ClaudeAPIError(f"Upload failed for {ospath.basename(file_path)}: {response.status_code}")
+
+    def __prepare_attachment(self, chat_id: str, file_path: str) -> tuple[str, object]:
+        """
+        Devuelve ("attachments", dict) para texto en línea o ("files", file_uuid)
+        para ficheros subidos. Un fichero con el mismo sha256 ya usado en el chat
+        se referencia sin volver a leerlo ni subirlo.
+        """
+        digest = file_sha256(file_path)
+        with self.__attachments_lock:
+            known = self.__chat_files.get(chat_id, {}).get(digest)
+        if known is not None:
+            return known
 
-    def __get_content_type(self, fpath: str):
-        mime_type, _ = guess_type(fpath)
-        return mime_type or "application/octet-stream"
+        if is_inline_text(file_path):
+            item = ("attachments", prepare_text_file_attachment(file_path))
+        else:
+            item = ("files", self.__upload_file(file_path))
+
+        with self.__attachments_lock:
+            files = self.__chat_files.setdefault(chat_id, {})
+            self.__chat_files.move_to_end(chat_id)
+            files[digest] = item
+            while len(self.__chat_files) > CHAT_FILES_MAX:
+                self.__chat_files.popitem(last=False)
+        return item
+
+    def __prepare_attachments(self, chat_id: str, attachment_paths: list[str]) -> tuple[list, list]:
+        """Preparar varios adjuntos en paralelo conservando el orden"""
+        if not attachment_paths:
+            return [], []
+        if len(attachment_paths) == 1:
+            items = [self.__prepare_attachment(chat_id, attachment_paths[0])]
+        else:
+            workers = min(ATTACHMENT_WORKERS, len(attachment_paths))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                items = list(executor.map(lambda p: self.__prepare_attachment(chat_id, p), attachment_paths))
+        attachments = [value for kind, value in items if kind == "attachments"]
+        files = [value for kind, value in items if kind == "files"]
+        return attachments, files
 
     def create_chat(self) -> str:
-        url = f"{self.__BASE_URL}/api/organizations/{self.__session.organization_id}/chat_conversations"
+        url = f"{self.__BASE_URL}/api/organizations/{self.organization_id}/chat_conversations"
         new_uuid = str(uuid4())
         payload = dumps({"name": "", "uuid": new_uuid})
         headers = {
@@ -108,28 +281,27 @@ class ClaudeAPIClient:
             "User-Agent": self.__session.user_agent,
             "Content-Type": "application/json",
         }
-        response = requests_post(url, headers=headers, data=payload, proxies=self.__get_proxies(), timeout=self.timeout)
+        response = self.__http.post(url, headers=headers, data=payload, timeout=self.timeout)
         if response.status_code == 201:
             j = response.json()
             return j.get("uuid")
         raise ClaudeAPIError(f"Create chat failed: {response.status_code}")
 
-    def send_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None) -> SendMessageResponse:
-        attachments = []
-        if attachment_paths:
-            for path in attachment_paths:
-                if path.endswith(".txt"):
-                    attachments.append(self.__prepare_text_file_attachment(path))
-                else:
-                    # Soporte básico de archivos binarios omitido por simplicidad (puedo añadirlo luego)
-                    pass
+    def stream_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None) -> MessageStream:
+        """
+        Enviar un mensaje y devolver un `MessageStream` que produce los fragmentos de
+        texto según llegan. Los errores de límite y sobrecarga se lanzan como
+        `MessageRateLimitError` / `OverloadError`; si la petición falla con otro
+        código HTTP el stream queda vacío con `status_code` y `raw_error` rellenos.
+        """
+        attachments, files = self.__prepare_attachments(chat_id, attachment_paths)
 
-        url = f"{self.__BASE_URL}/api/organizations/{self.__session.organization_id}/chat_conversations/{chat_id}/completion"
+        url = f"{self.__BASE_URL}/api/organizations/{self.organization_id}/chat_conversations/{chat_id}/completion"
         payload = {
             "prompt": prompt,
             "timezone": self.timezone,
             "attachments": attachments,
-            "files": [],
+            "files": files,
         }
         if self.model_name:
             payload["model"] = self.model_name
@@ -141,42 +313,57 @@ class ClaudeAPIClient:
             "Accept": "text/event-stream",
         }
 
-        response = requests_post(url, headers=headers, data=dumps(payload), proxies=self.__get_proxies(), timeout=self.timeout, stream=True)
+        started = perf_counter()
+        response = self.__http.post(url, headers=headers, data=dumps(payload), timeout=self.timeout, stream=True)
 
-        full_text = ""
+        if response.status_code != 200:
+            body = response.content
+            response.close()
+            try:
+                error = loads(body).get("error")
+            except (ValueError, AttributeError):
+                error = None
+            if isinstance(error, dict):
+                try:
+                    raise_for_error(error)
+                except (MessageRateLimitError, OverloadError):
+                    raise
+                except ClaudeAPIError:
+                    pass
+            stream = MessageStream((), response.status_code, started)
+            stream.raw_error = body
+            return stream
+
+        return MessageStream(
+            response.iter_content(chunk_size=None),
+            response.status_code,
+            started,
+            response.close,
+            lambda: abort_response(response),
+        )
+
+    def send_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None) -> SendMessageResponse:
+        """Versión bloqueante de `stream_message`: devuelve la respuesta completa"""
+        stream = self.stream_message(chat_id, prompt, attachment_paths)
         try:
-            for line in response.iter_lines():
-                if line:
-                    decoded = line.decode("utf-8")
-                    if decoded.startswith("data: "):
-                        json_str = decoded[6:].strip()
-                        if json_str == "[DONE]":
-                            break
-                        try:
-                            data = loads(json_str)
-                            if "completion" in data:
-                                full_text += data["completion"]
-                            elif "error" in data:
-                                error = data["error"]
-                                if "resets_at" in error:
-                                    raise MessageRateLimitError(int(error["resets_at"]))
-                                elif error.get("type") == "overloaded_error":
-                                    raise OverloadError(error.get("message", "Overloaded"))
-                                else:
-                                    raise ClaudeAPIError(f"API error: {error}")
-                        except Exception:
-                            pass
-        except Exception as e:
-            return SendMessageResponse(None, response.status_code, str(e).encode())
-
-        return SendMessageResponse(full_text.strip(), response.status_code, b"")
+            answer = stream.text()
+        except (MessageRateLimitError, OverloadError):
+            raise
+        except ClaudeAPIError as e:
+            return SendMessageResponse(None, stream.status_code, str(e).encode())
+        finally:
+            stream.close()
+
+        if stream.status_code != 200:
+            return SendMessageResponse(None, stream.status_code, stream.raw_error)
+        return SendMessageResponse(answer.strip(), stream.status_code, b"")
 
     def delete_chat(self, chat_id: str) -> bool:
-        url = f"{self.__BASE_URL}/api/organizations/{self.__session.organization_id}/chat_conversations/{chat_id}"
+        url = f"{self.__BASE_URL}/api/organizations/{self.organization_id}/chat_conversations/{chat_id}"
         headers = {
             "Cookie": self.__session.cookie,
             "User-Agent": self.__session.user_agent,
             "Content-Type": "application/json",
         }
-        response = requests_delete(url, headers=headers, data=f'"{chat_id}"', proxies=self.__get_proxies(), timeout=self.timeout)
+        response = self.__http.delete(url, headers=headers, data=f'"{chat_id}"', timeout=self.timeout)
         return response.status_code == 204
\ No newline at end of file
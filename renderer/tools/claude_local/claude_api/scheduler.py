@@ -0,0 +1,264 @@
+"""Scheduler module — reparte mensajes entre varias cuentas respetando sus límites"""
+from collections import deque
+from random import uniform
+from threading import Condition
+from time import time
+from typing import Callable, Optional
+
+from .session import SessionData
+from .errors import ClaudeAPIError, MessageRateLimitError, OverloadError
+from .client import ClaudeAPIClient
+
+
+class AccountState:
+    """Estado de una cuenta dentro del scheduler"""
+
+    def __init__(self, index: int, client: ClaudeAPIClient) -> None:
+        self.index = index
+        self.client = client
+        self.in_flight = 0
+        self.sent: deque[float] = deque()
+        """Instantes de envío dentro de la ventana actual"""
+        self.parked_until = 0.0
+        """Cuenta aparcada por MessageRateLimitError hasta este instante (con jitter)"""
+        self.backoff_until = 0.0
+        self.overloads = 0
+        """Errores de sobrecarga seguidos; fija el exponente del backoff"""
+        self.last_used = 0.0
+        self.total_sent = 0
+        self.rate_limited = 0
+
+    def available_at(self, now: float) -> float:
+        return max(self.parked_until, self.backoff_until, now)
+
+
+class ClaudeScheduler:
+    """
+    Cola de mensajes sobre un pool de cuentas (`SessionData`).
+
+    Cada chat nuevo va a la cuenta con más capacidad restante: la que menos
+    mensajes ha enviado en la ventana `window_sec` (o más le quedan hasta
+    `window_limit`, si se conoce) y menos peticiones tiene en vuelo. Un chat
+    queda ligado a la cuenta que lo creó.
+
+    - `MessageRateLimitError`: la cuenta se aparca hasta `reset_timestamp` más un
+      jitter aleatorio de hasta `reset_jitter` s, para que al reabrirse no salgan
+      todas las peticiones en espera a la vez. La petición se reintenta en otra
+      cuenta si no estaba ligada a un chat.
+    - `OverloadError`: backoff exponencial (`base_backoff * 2^n`, tope
+      `max_backoff`) con full jitter, y reintento hasta `max_retries`.
+
+    Expone la misma interfaz que `ClaudeAPIClient` (`create_chat`,
+    `send_message`, `stream_message`, `delete_chat`); las llamadas bloquean el
+    hilo que las hace mientras esperan cuenta libre.
+    """
+
+    def __init__(
+        self,
+        sessions: list[SessionData],
+        client_factory: Callable[[SessionData], ClaudeAPIClient] = None,
+        max_in_flight: int = 2,
+        window_limit: Optional[int] = None,
+        window_sec: float = 5 * 3600,
+        max_retries: int = 5,
+        base_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        reset_jitter: float = 30.0,
+        max_wait: float = 600.0,
+    ) -> None:
+        if not sessions:
+            raise ValueError("ClaudeScheduler needs at least one SessionData")
+        client_factory = client_factory or ClaudeAPIClient
+        self.accounts = [AccountState(i, client_factory(s)) for i, s in enumerate(sessions)]
+        self.max_in_flight = max_in_flight
+        self.window_limit = window_limit
+        self.window_sec = window_sec
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.reset_jitter = reset_jitter
+        self.max_wait = max_wait
+        self.__cond = Condition()
+        self.__chat_owner: dict[str, AccountState] = {}
+
+    def __remaining(self, account: AccountState, now: float) -> float:
+        cutoff = now - self.window_sec
+        while account.sent and account.sent[0] < cutoff:
+            account.sent.popleft()
+        used = len(account.sent) + account.in_flight
+        if self.window_limit is None:
+            return -used
+        return self.window_limit - used
+
+    def __acquire(self, pinned: Optional[AccountState] = None) -> AccountState:
+        deadline = time() + self.max_wait
+        with self.__cond:
+            while True:
+                now = time()
+                candidates = [pinned] if pinned else self.accounts
+                ready = [
+                    a for a in candidates
+                    if a.available_at(now) <= now
+                    and a.in_flight < self.max_in_flight
+                    and (self.window_limit is None or self.__remaining(a, now) > 0)
+                ]
+                if ready:
+                    account = max(ready, key=lambda a: (self.__remaining(a, now), -a.last_used))
+                    account.in_flight += 1
+                    account.last_used = now
+                    return account
+
+                wake = min(
+                    (a.available_at(now) for a in candidates if a.available_at(now) > now),
+                    default=now + 1.0,
+                )
+                if wake > deadline:
+                    parked = [a for a in candidates if a.parked_until > now]
+                    if parked:
+                        reset = min(a.parked_until for a in parked)
+                        raise MessageRateLimitError(int(reset), "All accounts are rate limited")
+                    raise ClaudeAPIError("No account available before max_wait")
+                self.__cond.wait(max(0.01, min(wake, deadline) - now))
+
+    def __release(self, account: AccountState, error: Exception = None) -> None:
+        """Devolver la cuenta al pool, aparcándola o en backoff según el error"""
+        with self.__cond:
+            now = time()
+            account.in_flight -= 1
+            if isinstance(error, MessageRateLimitError):
+                account.rate_limited += 1
+                account.parked_until = max(account.parked_until, error.reset_timestamp + uniform(0, self.reset_jitter))
+            elif isinstance(error, OverloadError):
+                account.overloads += 1
+                cap = min(self.max_backoff, self.base_backoff * (2 ** (account.overloads - 1)))
+                account.backoff_until = now + uniform(0, cap)
+            elif error is None:
+                account.overloads = 0
+            self.__cond.notify_all()
+
+    def __record_sent(self, account: AccountState) -> None:
+        with self.__cond:
+            account.sent.append(time())
+            account.total_sent += 1
+
+    def __run(self, chat_id: Optional[str], call: Callable[[AccountState], object], hold: bool = False):
+        """Ejecutar `call` en una cuenta, reintentando límites y sobrecargas.
+        Con `hold=True` la cuenta sigue ocupada y se devuelve junto al resultado."""
+        pinned = self.__chat_owner.get(chat_id) if chat_id else None
+        if chat_id and pinned is None:
+            # Chat creado fuera del scheduler: se asume que es de la primera cuenta
+            pinned = self.accounts[0]
+        attempt = 0
+        while True:
+            account = self.__acquire(pinned)
+            try:
+                result = call(account)
+            except (MessageRateLimitError, OverloadError) as e:
+                # Un chat ligado espera a su cuenta (aparcada o en backoff) en __acquire,
+                # que falla si la espera supera max_wait; el resto prueba otra cuenta
+                self.__release(account, e)
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                continue
+            except BaseException as e:
+                self.__release(account, e)
+                raise
+            if hold:
+                return result, account
+            self.__release(account)
+            return result
+
+    def create_chat(self) -> str:
+        def call(account: AccountState) -> str:
+            chat_id = account.client.create_chat()
+            with self.__cond:
+                self.__chat_owner[chat_id] = account
+            return chat_id
+        return self.__run(None, call)
+
+    def send_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None):
+        def call(account: AccountState):
+            self.__record_sent(account)
+            return account.client.send_message(chat_id, prompt, attachment_paths)
+        return self.__run(chat_id, call)
+
+    def stream_message(self, chat_id: str, prompt: str, attachment_paths: list[str] = None):
+        """
+        Como `ClaudeAPIClient.stream_message`. Solo se reintentan los errores que
+        llegan al abrir la petición; la cuenta queda ocupada hasta cerrar el stream.
+        """
+        def call(account: AccountState):
+            self.__record_sent(account)
+            return account.client.stream_message(chat_id, prompt, attachment_paths)
+
+        stream, account = self.__run(chat_id, call, hold=True)
+        return _TrackedStream(stream, lambda error=None: self.__release(account, error))
+
+    def delete_chat(self, chat_id: str) -> bool:
+        ok = self.__run(chat_id, lambda account: account.client.delete_chat(chat_id))
+        with self.__cond:
+            self.__chat_owner.pop(chat_id, None)
+        return ok
+
+    def stats(self) -> list[dict]:
+        with self.__cond:
+            now = time()
+            return [
+                {
+                    "account": a.index,
+                    "in_flight": a.in_flight,
+                    "sent_in_window": len(a.sent),
+                    "total_sent": a.total_sent,
+                    "rate_limited": a.rate_limited,
+                    "parked_for_sec": max(0, round(a.parked_until - now, 1)),
+                    "backoff_for_sec": max(0, round(a.backoff_until - now, 1)),
+                }
+                for a in self.accounts
+            ]
+
+
+class _TrackedStream:
+    """Envuelve un MessageStream para devolver la cuenta al scheduler al terminar"""
+
+    def __init__(self, stream, release) -> None:
+        self._stream = stream
+        self._release = release
+        self._iterator = self._iterate()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def __iter__(self):
+        return self._iterator
+
+    def __next__(self) -> str:
+        return next(self._iterator)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._iterator.close()
+        self._stream.close()
+        self.__finish()
+
+    def text(self) -> str:
+        return "".join(self)
+
+    def __finish(self, error: Exception = None) -> None:
+        if self._release is not None:
+            release, self._release = self._release, None
+            release(error)
+
+    def _iterate(self):
+        try:
+            yield from self._stream
+        except (MessageRateLimitError, OverloadError) as e:
+            self.__finish(e)
+            raise
+        finally:
+            self.__finish()
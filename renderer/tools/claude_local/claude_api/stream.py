@@ -0,0 +1,265 @@
+"""SSE stream module — parser incremental a nivel de bytes y eventos de completion"""
+from json import loads
+from time import perf_counter
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional
+
+from .errors import ClaudeAPIError, MessageRateLimitError, OverloadError
+
+
+class SSEParser:
+    """
+    Parser incremental de Server-Sent Events.
+
+    `feed()` recibe trozos de bytes tal cual llegan del socket (pueden cortar una
+    línea o un carácter UTF-8 por la mitad) y devuelve los eventos completos como
+    tuplas `(event, data)`. El búfer solo guarda la línea pendiente, así que el
+    coste total es lineal en el tamaño de la respuesta.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = bytearray()
+        self._event = ""
+        self._data: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[tuple[str, str]]:
+        events = []
+        self._buffer += chunk
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(self._buffer[start:end])
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            event = self._line(line)
+            if event is not None:
+                events.append(event)
+        del self._buffer[:start]
+        return events
+
+    def flush(self) -> list[tuple[str, str]]:
+        """Cerrar el stream: procesar la última línea y el evento sin línea en blanco final"""
+        events = []
+        if self._buffer:
+            event = self._line(bytes(self._buffer))
+            self._buffer.clear()
+            if event is not None:
+                events.append(event)
+        event = self._line(b"")
+        if event is not None:
+            events.append(event)
+        return events
+
+    def _line(self, line: bytes) -> Optional[tuple[str, str]]:
+        if not line:
+            if not self._data:
+                self._event = ""
+                return None
+            event = (self._event or "message", b"\n".join(self._data).decode("utf-8", errors="replace"))
+            self._event = ""
+            self._data = []
+            return event
+        if line.startswith(b":"):
+            return None
+        field, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if field == b"data":
+            self._data.append(value)
+        elif field == b"event":
+            self._event = value.decode("utf-8", errors="replace")
+        return None
+
+
+def raise_for_error(error) -> None:
+    """Convertir el objeto `error` de la API en la excepción correspondiente"""
+    if not isinstance(error, dict):
+        raise ClaudeAPIError(f"API error: {error}")
+    resets_at = error.get("resets_at")
+    if resets_at is None and isinstance(error.get("message"), str):
+        # A veces el detalle del límite viene serializado dentro de `message`
+        try:
+            resets_at = loads(error["message"]).get("resetsAt")
+        except (ValueError, AttributeError):
+            resets_at = None
+    if resets_at is not None:
+        raise MessageRateLimitError(int(resets_at), error.get("message", "Rate limit"))
+    if error.get("type") == "overloaded_error":
+        raise OverloadError(error.get("message", "Overloaded"))
+    raise ClaudeAPIError(f"API error: {error}")
+
+
+def completion_delta(data: str) -> Optional[str]:
+    """
+    Extraer el texto de un evento `data:`. Devuelve None si el evento no aporta
+    texto y lanza la excepción adecuada si es un error.
+    """
+    data = data.strip()
+    if not data or data == "[DONE]":
+        return None
+    try:
+        payload = loads(data)
+    except ValueError:
+        return None
+    if not isinstance(payload, dict):
+        return None
+    if "error" in payload:
+        raise_for_error(payload["error"])
+    if payload.get("completion"):
+        return payload["completion"]
+    delta = payload.get("delta")
+    if payload.get("type") == "content_block_delta" and isinstance(delta, dict):
+        return delta.get("text") or None
+    return None
+
+
+def is_terminal(data: str) -> bool:
+    return data.strip() == "[DONE]"
+
+
+class MessageStream:
+    """
+    Iterador sobre los fragmentos de texto de una respuesta en streaming.
+
+    Además de los deltas expone `status_code`, `ttft` (segundos hasta el primer
+    fragmento con texto) y `total` (segundos hasta el final del stream), medidos
+    desde el envío de la petición. Si la API respondió con un código de error,
+    `raw_error` guarda el cuerpo. `close()` corta la conexión en cualquier
+    momento; también se usa como context manager. `abort()` se puede llamar desde
+    otro hilo para cortar una lectura bloqueada.
+    """
+
+    def __init__(self, chunks: Iterable[bytes], status_code: int, started: float, close=None, abort=None) -> None:
+        self.status_code = status_code
+        self.ttft: Optional[float] = None
+        self.total: Optional[float] = None
+        self.raw_error: bytes = b""
+        self._chunks = chunks
+        self._started = started
+        self._close = close
+        self._abort = abort
+        self._iterator = self._iterate()
+
+    def abort(self) -> None:
+        if self._abort is not None:
+            self._abort()
+
+    def __iter__(self) -> Iterator[str]:
+        return self._iterator
+
+    def __next__(self) -> str:
+        return next(self._iterator)
+
+    def __enter__(self) -> "MessageStream":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._iterator.close()
+        if self._close is not None:
+            self._close()
+            self._close = None
+
+    def text(self) -> str:
+        """Consumir el resto del stream y devolver el texto completo"""
+        return "".join(self)
+
+    def _iterate(self) -> Iterator[str]:
+        parser = SSEParser()
+        try:
+            for chunk in self._chunks:
+                for _, data in parser.feed(chunk):
+                    if is_terminal(data):
+                        return
+                    delta = completion_delta(data)
+                    if delta:
+                        if self.ttft is None:
+                            self.ttft = perf_counter() - self._started
+                        yield delta
+            for _, data in parser.flush():
+                if is_terminal(data):
+                    return
+                delta = completion_delta(data)
+                if delta:
+                    if self.ttft is None:
+                        self.ttft = perf_counter() - self._started
+                    yield delta
+        finally:
+            self.total = perf_counter() - self._started
+            if self._close is not None:
+                self._close()
+                self._close = None
+
+
+class AsyncMessageStream:
+    """
+    Equivalente asíncrono de `MessageStream` (`async for delta in stream`).
+
+    `aclose()` —o salir del `async with`, o cancelar la tarea que itera— cierra la
+    conexión en el acto y libera el hueco de concurrencia del cliente.
+    """
+
+    def __init__(self, chunks: Optional[AsyncIterable[bytes]], status_code: int, started: float, close=None) -> None:
+        self.status_code = status_code
+        self.ttft: Optional[float] = None
+        self.total: Optional[float] = None
+        self.raw_error: bytes = b""
+        self._chunks = chunks
+        self._started = started
+        self._close = close
+        self._iterator = self._iterate()
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iterator
+
+    async def __anext__(self) -> str:
+        return await self._iterator.__anext__()
+
+    async def __aenter__(self) -> "AsyncMessageStream":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        await self._iterator.aclose()
+        await self._release()
+
+    async def text(self) -> str:
+        """Consumir el resto del stream y devolver el texto completo"""
+        return "".join([delta async for delta in self])
+
+    async def _release(self) -> None:
+        if self._close is not None:
+            close, self._close = self._close, None
+            await close()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        parser = SSEParser()
+        try:
+            if self._chunks is None:
+                return
+            async for chunk in self._chunks:
+                for _, data in parser.feed(chunk):
+                    if is_terminal(data):
+                        return
+                    delta = completion_delta(data)
+                    if delta:
+                        if self.ttft is None:
+                            self.ttft = perf_counter() - self._started
+                        yield delta
+            for _, data in parser.flush():
+                if is_terminal(data):
+                    return
+                delta = completion_delta(data)
+                if delta:
+                    if self.ttft is None:
+                        self.ttft = perf_counter() - self._started
+                    yield delta
+        finally:
+            self.total = perf_counter() - self._started
+            await self._release()
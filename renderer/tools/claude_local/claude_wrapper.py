@@ -1,65 +1,227 @@
 #!/usr/bin/env python3
 """
 Wrapper listo para usar desde tu app Electron (Node.js → Python)
+
+Modos:
+  python claude_wrapper.py <command> [...args]   → una orden por proceso
+  python claude_wrapper.py serve                 → daemon JSON-RPC por stdin/stdout
+
+En modo `serve` cada linea de stdin es una peticion JSON-RPC 2.0
+({"jsonrpc": "2.0", "id": 1, "method": "send_message", "params": {...}}) y cada
+respuesta sale como una linea por stdout con el mismo id. Las peticiones se
+atienden en paralelo, asi que las respuestas pueden llegar desordenadas.
+`stream_message` emite ademas una notificacion por fragmento de texto
+({"jsonrpc": "2.0", "method": "delta", "params": {"id": 1, "text": "..."}})
+antes de la respuesta final.
+
+Con RESPONSE_CACHE=1 (o `"cache": true` en los params) las respuestas se
+guardan en la cache de disco compartida (renderer/tools/response_cache.py).
+Si el chat ya tiene historial, la clave incluye su chat_id; el llamador marca
+los chats recien creados con `"fresh": true` para que compartan clave.
+El cliente (cookies, organization_id, conexiones HTTP) se crea una sola vez.
 """
 
 import sys
 import json
 import os
-from claude_api import ClaudeAPIClient, SessionData
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from claude_api import ClaudeAPIClient, ClaudeScheduler, SessionData
+
+# response_cache.py vive en renderer/tools, compartido con chatgpt_local
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import response_cache
+
+# Peticiones atendidas a la vez en modo serve
+SERVE_WORKERS = int(os.getenv("CLAUDE_WRAPPER_WORKERS", 4))
 
-def main():
-    if len(sys.argv) < 2:
-        print(json.dumps({"error": "Usage: python claude_wrapper.py <command> [...args]"}))
-        return
 
-    cmd = sys.argv[1]
-    
+def load_client():
+    """Crear el cliente a partir de secrets/claude_cookies.json"""
     # Asumimos que secrets/claude_cookies.json existe (lo creas 1 vez)
     secrets_path = os.path.join(os.path.dirname(__file__), "secrets", "claude_cookies.json")
-    
+
     if not os.path.exists(secrets_path):
-        print(json.dumps({"error": f"Missing {secrets_path}. Create it with cookie + user_agent"}))
-        return
+        raise FileNotFoundError(f"Missing {secrets_path}. Create it with cookie + user_agent")
 
     with open(secrets_path, "r", encoding="utf-8") as f:
         secrets = json.load(f)
 
+    # Varias cuentas ({"accounts": [{cookie, user_agent, organization_id}, ...]}):
+    # el scheduler reparte los chats y respeta los limites de cada una
+    if secrets.get("accounts"):
+        sessions = [
+            SessionData(
+                cookie=acc["cookie"],
+                user_agent=acc["user_agent"],
+                organization_id=acc.get("organization_id")
+            )
+            for acc in secrets["accounts"]
+        ]
+        return ClaudeScheduler(sessions, client_factory=lambda s: ClaudeAPIClient(s, timeout=120))
+
     session = SessionData(
         cookie=secrets["cookie"],
         user_agent=secrets["user_agent"],
         organization_id=secrets.get("organization_id")
     )
-    client = ClaudeAPIClient(session, timeout=120)
+    return ClaudeAPIClient(session, timeout=120)
+
+
+def run_command(client, cmd, params, on_delta=None):
+    """Ejecutar una orden y devolver el dict que se imprime como JSON.
+    `on_delta` recibe cada fragmento de texto en `stream_message`."""
+    if cmd == "create_chat":
+        chat_id = client.create_chat()
+        return {"chat_id": chat_id}
+
+    elif cmd == "cache_stats":
+        return response_cache.get_cache().stats()
+
+    elif cmd in ("send_message", "stream_message"):
+        if not params.get("chat_id") or params.get("prompt") is None:
+            return {"error": f"{cmd} <chat_id> <prompt>"}
+        if not response_cache.use_cache(params):
+            return send_uncached(client, cmd, params, on_delta)
+
+        cache = response_cache.get_cache()
+        key = response_cache.make_key(
+            "claude",
+            getattr(client, "model_name", None),
+            params["prompt"],
+            params.get("attachments"),
+            "" if params.get("fresh") else params["chat_id"],
+        )
+        hit = cache.get(key)
+        if hit is not None:
+            if on_delta:
+                on_delta(hit["answer"])
+            return dict(hit, cached=True)
+        result = send_uncached(client, cmd, params, on_delta)
+        if result.get("answer"):
+            cache.put(key, "claude", {"answer": result["answer"], "status_code": result["status_code"], "error": None})
+        return result
+
+    elif cmd == "delete_chat":
+        ok = client.delete_chat(params["chat_id"])
+        return {"deleted": ok}
+
+    return {"error": f"Unknown command: {cmd}"}
+
+
+def send_uncached(client, cmd, params, on_delta=None):
+    """send_message / stream_message contra la API"""
+    if cmd == "send_message":
+        res = client.send_message(params["chat_id"], params["prompt"], params.get("attachments"))
+        return {
+            "answer": res.answer,
+            "status_code": res.status_code,
+            "error": None if res.answer else "Check status_code"
+        }
+
+    elif cmd == "stream_message":
+        parts = []
+        with client.stream_message(params["chat_id"], params["prompt"], params.get("attachments")) as stream:
+            for delta in stream:
+                parts.append(delta)
+                if on_delta:
+                    on_delta(delta)
+        answer = "".join(parts).strip()
+        return {
+            "answer": answer,
+            "status_code": stream.status_code,
+            "ttft_ms": round(stream.ttft * 1000, 1) if stream.ttft is not None else None,
+            "total_ms": round(stream.total * 1000, 1) if stream.total is not None else None,
+            "error": None if answer else "Check status_code"
+        }
+
+    return {"error": f"Unknown command: {cmd}"}
+
+
+def serve():
+    """Daemon JSON-RPC: una peticion por linea en stdin, una respuesta por linea en stdout"""
+    write_lock = threading.Lock()
+    client = None
+    client_lock = threading.Lock()
+
+    def reply(data):
+        with write_lock:
+            sys.stdout.write(json.dumps(data) + "\n")
+            sys.stdout.flush()
+
+    def get_client():
+        nonlocal client
+        with client_lock:
+            if client is None:
+                client = load_client()
+            return client
+
+    def handle(req):
+        req_id = req.get("id")
+        method = req.get("method")
+        try:
+            if method == "ping":
+                result = {"pong": True}
+            elif method == "cache_stats":
+                result = run_command(None, method, {})
+            else:
+                on_delta = lambda text: reply({"jsonrpc": "2.0", "method": "delta", "params": {"id": req_id, "text": text}})
+                result = run_command(get_client(), method, req.get("params") or {}, on_delta)
+            reply({"jsonrpc": "2.0", "id": req_id, "result": result})
+        except Exception as e:
+            reply({"jsonrpc": "2.0", "id": req_id, "error": {"code": -32000, "message": str(e)}})
+
+    with ThreadPoolExecutor(max_workers=SERVE_WORKERS) as executor:
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                req = json.loads(line)
+            except ValueError as e:
+                reply({"jsonrpc": "2.0", "id": None, "error": {"code": -32700, "message": str(e)}})
+                continue
+            if req.get("method") == "shutdown":
+                reply({"jsonrpc": "2.0", "id": req.get("id"), "result": {"stopping": True}})
+                break
+            executor.submit(handle, req)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(json.dumps({"error": "Usage: python claude_wrapper.py <command> [...args]"}))
+        return
+
+    # Flags de cache: --cache / --no-cache fuerzan o saltan la cache, --fresh marca un chat nuevo
+    flags = {arg for arg in sys.argv[1:] if arg in ("--cache", "--no-cache", "--fresh")}
+    argv = [arg for arg in sys.argv if arg not in flags]
+    cmd = argv[1]
+
+    if cmd == "serve":
+        serve()
+        return
+
+    if cmd in ("send_message", "stream_message") and len(argv) < 4:
+        print(json.dumps({"error": f"{cmd} <chat_id> <prompt>"}))
+        return
 
     try:
-        if cmd == "create_chat":
-            chat_id = client.create_chat()
-            print(json.dumps({"chat_id": chat_id}))
-
-        elif cmd == "send_message":
-            if len(sys.argv) < 4:
-                print(json.dumps({"error": "send_message <chat_id> <prompt>"}))
-                return
-            chat_id = sys.argv[2]
-            prompt = sys.argv[3]
-            res = client.send_message(chat_id, prompt)
-            print(json.dumps({
-                "answer": res.answer,
-                "status_code": res.status_code,
-                "error": None if res.answer else "Check status_code"
-            }))
+        client = load_client() if cmd != "cache_stats" else None
 
+        if cmd in ("send_message", "stream_message"):
+            params = {"chat_id": argv[2], "prompt": argv[3]}
+            if "--cache" in flags or "--no-cache" in flags:
+                params["cache"] = "--cache" in flags
+            if "--fresh" in flags:
+                params["fresh"] = True
         elif cmd == "delete_chat":
-            chat_id = sys.argv[2]
-            ok = client.delete_chat(chat_id)
-            print(json.dumps({"deleted": ok}))
-
+            params = {"chat_id": argv[2]}
         else:
-            print(json.dumps({"error": f"Unknown command: {cmd}"}))
+            params = {}
+        print(json.dumps(run_command(client, cmd, params)))
 
     except Exception as e:
         print(json.dumps({"error": str(e)}))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
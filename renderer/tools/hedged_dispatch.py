@@ -0,0 +1,440 @@
+"""
+Despacho con cobertura (hedging) entre proveedores: Claude y ChatGPT
+
+Se lanza la petición al proveedor primario; si no da su primer token dentro del
+presupuesto de latencia se lanza también el siguiente, y gana el primero que
+produzca texto. El perdedor se cancela (se corta su conexión). El primario se
+elige por la mediana de tiempo hasta el primer token de cada proveedor, y el
+presupuesto por defecto es su p95 (acotado a [HEDGE_MIN_MS, HEDGE_MAX_MS]).
+Las latencias se guardan en HEDGE_STATS_PATH para que el orden se adapte
+también entre ejecuciones de un solo uso.
+
+Uso:
+  python hedged_dispatch.py "<prompt>"      → JSON con answer, provider, ttft_ms...
+  python hedged_dispatch.py --stats         → p50/p95 por proveedor
+"""
+
+import os
+import sys
+import json
+import threading
+from collections import deque
+from time import perf_counter
+
+HEDGE_BUDGET_MS = os.getenv("HEDGE_BUDGET_MS")  # fijo; si no, p95 del primario
+HEDGE_MIN_MS = int(os.getenv("HEDGE_MIN_MS", 1500))
+HEDGE_MAX_MS = int(os.getenv("HEDGE_MAX_MS", 15000))
+HEDGE_TIMEOUT_S = float(os.getenv("HEDGE_TIMEOUT_S", 120))
+HEDGE_STATS_PATH = os.getenv(
+    "HEDGE_STATS_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sandra", "hedge_stats.json"),
+)
+# Muestras por proveedor para p50/p95
+STATS_WINDOW = 200
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Cancelled(Exception):
+    """El intento perdió la carrera o se agotó el tiempo"""
+
+
+class CancelToken:
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def on_cancel(self, fn):
+        """Registrar cómo abortar el intento; si ya está cancelado se llama al momento"""
+        with self.lock:
+            if not self.event.is_set():
+                self.callbacks.append(fn)
+                return
+        fn()
+
+    def cancel(self):
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class LatencyStats:
+    """Tiempos hasta el primer token y totales (ms) de las últimas STATS_WINDOW llamadas"""
+
+    def __init__(self, path=HEDGE_STATS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.ttft = {}
+        self.total = {}
+        self.failures = {}
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            for name, entry in data.items():
+                self.ttft[name] = deque(entry.get("ttft", []), maxlen=STATS_WINDOW)
+                self.total[name] = deque(entry.get("total", []), maxlen=STATS_WINDOW)
+                self.failures[name] = entry.get("failures", 0)
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    def record(self, name, ttft_ms=None, total_ms=None, failed=False):
+        with self.lock:
+            if ttft_ms is not None:
+                self.ttft.setdefault(name, deque(maxlen=STATS_WINDOW)).append(round(ttft_ms, 1))
+            if total_ms is not None:
+                self.total.setdefault(name, deque(maxlen=STATS_WINDOW)).append(round(total_ms, 1))
+            if failed:
+                self.failures[name] = self.failures.get(name, 0) + 1
+
+    def p(self, name, pct, kind="ttft"):
+        with self.lock:
+            return percentile(list((self.ttft if kind == "ttft" else self.total).get(name, ())), pct)
+
+    def summary(self):
+        names = set(self.ttft) | set(self.total) | set(self.failures)
+        return {
+            name: {
+                "ttft_p50_ms": self.p(name, 50),
+                "ttft_p95_ms": self.p(name, 95),
+                "total_p50_ms": self.p(name, 50, "total"),
+                "total_p95_ms": self.p(name, 95, "total"),
+                "samples": len(self.ttft.get(name, ())),
+                "failures": self.failures.get(name, 0),
+            }
+            for name in sorted(names)
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = {
+                name: {
+                    "ttft": list(self.ttft.get(name, ())),
+                    "total": list(self.total.get(name, ())),
+                    "failures": self.failures.get(name, 0),
+                }
+                for name in set(self.ttft) | set(self.total) | set(self.failures)
+            }
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+
+class Attempt:
+    def __init__(self, name):
+        self.name = name
+        self.token = CancelToken()
+        self.started = perf_counter()
+        self.first = None
+        self.done = False
+        self.answer = None
+        self.error = None
+
+
+class HedgedDispatcher:
+    """
+    `providers`: {nombre: fn(prompt, on_delta, token) -> texto}. Cada proveedor
+    llama a `on_delta` con cada fragmento y registra en `token.on_cancel()` cómo
+    cortar su petición; `on_delta` lanza `Cancelled` si el intento ya perdió.
+    """
+
+    def __init__(self, providers, budget_ms=HEDGE_BUDGET_MS, timeout=HEDGE_TIMEOUT_S, stats=None):
+        self.providers = providers
+        self.budget_ms = float(budget_ms) if budget_ms else None
+        self.timeout = timeout
+        self.stats = stats if stats is not None else LatencyStats()
+
+    def ranking(self):
+        """Proveedores por mediana de primer token; los que no tienen muestras van primero"""
+        def key(name):
+            p50 = self.stats.p(name, 50)
+            return (p50 is not None, p50 or 0)
+        return sorted(self.providers, key=key)
+
+    def budget_for(self, name):
+        if self.budget_ms is not None:
+            return self.budget_ms / 1000
+        p95 = self.stats.p(name, 95)
+        if p95 is None:
+            p95 = HEDGE_MAX_MS
+        return min(HEDGE_MAX_MS, max(HEDGE_MIN_MS, p95)) / 1000
+
+    def dispatch(self, prompt, on_delta=None):
+        order = self.ranking()
+        cond = threading.Condition()
+        attempts = []
+        winner = None
+
+        def run(attempt):
+            nonlocal winner
+
+            def delta(text):
+                nonlocal winner
+                with cond:
+                    if attempt.token.cancelled or (winner is not None and winner is not attempt):
+                        raise Cancelled()
+                    if attempt.first is None:
+                        attempt.first = perf_counter() - attempt.started
+                        if winner is None:
+                            winner = attempt
+                            for other in attempts:
+                                if other is not attempt:
+                                    other.token.cancel()
+                            cond.notify_all()
+                if on_delta:
+                    on_delta(text)
+
+            try:
+                answer = self.providers[attempt.name](prompt, delta, attempt.token)
+                with cond:
+                    attempt.answer = answer
+                    # Respuesta sin fragmentos intermedios (p. ej. desde caché): cuenta al terminar
+                    if winner is None and answer and not attempt.token.cancelled:
+                        attempt.first = perf_counter() - attempt.started
+                        winner = attempt
+                        for other in attempts:
+                            if other is not attempt:
+                                other.token.cancel()
+            except Exception as e:
+                attempt.error = e
+            finally:
+                with cond:
+                    attempt.done = True
+                    cond.notify_all()
+
+        def start(name):
+            attempt = Attempt(name)
+            attempts.append(attempt)
+            threading.Thread(target=run, args=(attempt,), daemon=True).start()
+            return attempt
+
+        started = perf_counter()
+        deadline = started + self.timeout
+        next_index = 1
+        with cond:
+            hedge_at = perf_counter() + self.budget_for(order[0])
+            start(order[0])
+            while True:
+                now = perf_counter()
+                if winner is not None and winner.done:
+                    break
+                if now >= deadline:
+                    break
+                if winner is None:
+                    running = [a for a in attempts if not a.done]
+                    if not running and next_index >= len(order):
+                        break
+                    if next_index < len(order) and (not running or now >= hedge_at):
+                        # Sin primer token a tiempo (o el anterior falló): entra el siguiente
+                        hedge_at = now + self.budget_for(order[next_index])
+                        start(order[next_index])
+                        next_index += 1
+                        continue
+                    wait = min(deadline, hedge_at if next_index < len(order) else deadline) - now
+                else:
+                    wait = deadline - now
+                cond.wait(max(0.005, wait))
+
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.token.cancel()
+            if winner is not None and not winner.done:
+                winner.token.cancel()
+            hedged = len(attempts) > 1
+            result_winner = winner
+
+        self.__record(attempts, result_winner, started)
+        total_ms = (perf_counter() - started) * 1000
+        if result_winner is None or result_winner.error is not None or not result_winner.done:
+            errors = {a.name: str(a.error) for a in attempts if a.error is not None and not isinstance(a.error, Cancelled)}
+            return {
+                "success": False,
+                "error": "timeout" if perf_counter() >= deadline else "all providers failed",
+                "errors": errors,
+                "hedged": hedged,
+                "total_ms": round(total_ms, 1),
+            }
+        return {
+            "success": True,
+            "answer": result_winner.answer,
+            "provider": result_winner.name,
+            "source": result_winner.name,
+            "hedged": hedged,
+            "ttft_ms": round(result_winner.first * 1000, 1),
+            "total_ms": round(total_ms, 1),
+        }
+
+    def __record(self, attempts, winner, started):
+        now = perf_counter()
+        for attempt in attempts:
+            if attempt is winner and attempt.error is None and attempt.done:
+                self.stats.record(attempt.name, attempt.first * 1000, (now - attempt.started) * 1000)
+            elif attempt.error is not None and not isinstance(attempt.error, Cancelled) and attempt.first is None:
+                # Falló sin dar texto: cuenta como el peor caso para que baje en el ranking
+                self.stats.record(attempt.name, HEDGE_MAX_MS, failed=True)
+            elif attempt.first is None:
+                # Perdió la carrera sin primer token: su espera es una cota inferior del ttft
+                self.stats.record(attempt.name, (now - attempt.started) * 1000)
+        self.stats.save()
+
+
+def claude_provider(load_client):
+    """Proveedor Claude: chat nuevo + stream_message; cancelar corta el socket y el
+    chat se borra al terminar, gane o pierda"""
+    state = {}
+    lock = threading.Lock()
+
+    def discard(client, chat_id, stream=None):
+        """Cortar el stream (si lo hay) y borrar el chat sin propagar errores"""
+        if stream is not None:
+            try:
+                stream.abort()
+                stream.close()
+            except Exception:
+                pass
+        try:
+            client.delete_chat(chat_id)
+        except Exception:
+            pass
+
+    def open_stream(client, chat_id, prompt, token):
+        """POST en otro hilo con la cancelación registrada antes de enviarlo: si el
+        intento pierde mientras espera las cabeceras se abandona al momento (None) y
+        ese hilo corta la respuesta y borra el chat cuando llegue"""
+        ready = threading.Event()
+        handoff = threading.Lock()
+        box = {}
+
+        def post():
+            try:
+                box["stream"] = client.stream_message(chat_id, prompt)
+            except Exception as e:
+                box["error"] = e
+            with handoff:
+                abandoned = box.get("abandoned", False)
+                ready.set()
+            if abandoned:
+                discard(client, chat_id, box.get("stream"))
+
+        token.on_cancel(ready.set)
+        threading.Thread(target=post, name="claude-post", daemon=True).start()
+        ready.wait()
+        with handoff:
+            if "stream" not in box and "error" not in box:
+                box["abandoned"] = True
+                return None
+        if "error" in box:
+            raise box["error"]
+        return box["stream"]
+
+    def run(prompt, on_delta, token):
+        with lock:
+            if "client" not in state:
+                state["client"] = load_client()
+        client = state["client"]
+        chat_id = client.create_chat()
+        try:
+            if token.cancelled:
+                raise Cancelled()
+            stream = open_stream(client, chat_id, prompt, token)
+            if stream is None:
+                # El hilo del POST se queda con el chat
+                chat_id = None
+                raise Cancelled()
+            parts = []
+            with stream:
+                token.on_cancel(stream.abort)
+                for delta in stream:
+                    parts.append(delta)
+                    on_delta(delta)
+            if token.cancelled:
+                raise Cancelled()
+            if stream.status_code != 200:
+                raise RuntimeError(f"Claude HTTP {stream.status_code}")
+            return "".join(parts).strip()
+        finally:
+            if chat_id is not None:
+                # Sin daemon: no retrasa la respuesta y aun así termina antes de salir
+                threading.Thread(target=discard, args=(client, chat_id), name="claude-delete").start()
+
+    return run
+
+
+def chatgpt_provider(send_to_chatgpt, abort_response):
+    """Proveedor ChatGPT sobre chatgpt_wrapper.send_to_chatgpt"""
+    def run(prompt, on_delta, token):
+        result = send_to_chatgpt(
+            prompt,
+            on_delta=on_delta,
+            on_open=lambda response: token.on_cancel(lambda: abort_response(response)),
+        )
+        if token.cancelled:
+            raise Cancelled()
+        if not result.get("success"):
+            raise RuntimeError(result.get("error") or "ChatGPT sin respuesta")
+        return result["answer"]
+
+    return run
+
+
+def default_providers():
+    """Claude (claude_local) y ChatGPT (chatgpt_local) con sus secrets habituales"""
+    for sub in ("claude_local", "chatgpt_local"):
+        path = os.path.join(TOOLS_DIR, sub)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import claude_wrapper
+    import chatgpt_wrapper
+    from claude_api.client import abort_response
+
+    return {
+        "claude": claude_provider(claude_wrapper.load_client),
+        "chatgpt": chatgpt_provider(chatgpt_wrapper.send_to_chatgpt, abort_response),
+    }
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(json.dumps({"error": 'Uso: python hedged_dispatch.py "<prompt>" | --stats'}))
+        return
+    if sys.argv[1] == "--stats":
+        print(json.dumps(LatencyStats().summary()))
+        return
+    try:
+        dispatcher = HedgedDispatcher(default_providers())
+        print(json.dumps(dispatcher.dispatch(sys.argv[1])))
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Caché de respuestas en disco compartida por claude_wrapper.py y chatgpt_wrapper.py
+
+La clave es un sha256 de (proveedor, modelo, prompt, digest de cada adjunto,
+contexto de la conversación), así que el mismo prompt con los mismos ficheros
+devuelve la respuesta guardada sin volver a llamar al modelo.
+
+- SQLite en modo WAL: varios procesos wrapper pueden leer y escribir a la vez.
+- Expulsión LRU por tamaño total (`RESPONSE_CACHE_MAX_MB`) y caducidad por TTL.
+- Se activa con RESPONSE_CACHE=1; cada llamada puede forzarlo o saltárselo con
+  el parámetro `cache` (true/false).
+- `stats()` devuelve aciertos, fallos, tasa de acierto y bytes ahorrados.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+CACHE_ENABLED = os.getenv("RESPONSE_CACHE", "0").lower() in ("1", "true", "yes", "on")
+CACHE_PATH = os.getenv(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "sandra", "response_cache.sqlite3"),
+)
+CACHE_MAX_BYTES = int(float(os.getenv("RESPONSE_CACHE_MAX_MB", 64)) * 1024 * 1024)
+CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 7 * 24 * 3600))
+
+# Trozo de lectura al calcular el digest de un adjunto
+DIGEST_CHUNK = 1024 * 1024
+
+
+def file_digest(path):
+    """sha256 de un fichero leyendo por trozos (memoria constante)"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DIGEST_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_key(provider, model, prompt, attachments=None, context=""):
+    """Clave de caché. `context` distingue la misma pregunta en conversaciones con historial."""
+    h = hashlib.sha256()
+    for part in (provider, model or "", context or "", prompt):
+        data = part.encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    for path in attachments or []:
+        h.update(file_digest(path).encode("ascii"))
+    return h.hexdigest()
+
+
+def use_cache(params):
+    """¿Usar la caché en esta llamada? `params["cache"]` manda sobre RESPONSE_CACHE."""
+    flag = params.get("cache")
+    if flag is None:
+        return CACHE_ENABLED
+    if isinstance(flag, str):
+        return flag.lower() in ("1", "true", "yes", "on")
+    return bool(flag)
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = self._conn()
+        with conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT NOT NULL,
+                    value BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    expires REAL NOT NULL,
+                    last_access REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+            conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _conn(self):
+        # Una conexión por hilo (sqlite3 no permite compartirlas entre hilos)
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self.local.conn = conn
+        return conn
+
+    def _bump(self, conn, **counters):
+        for name, value in counters.items():
+            conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value),
+            )
+
+    def get(self, key):
+        """Respuesta guardada (dict) o None si no está o ha caducado"""
+        conn = self._conn()
+        now = time.time()
+        with conn:
+            row = conn.execute("SELECT value, size, expires FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or row[2] <= now:
+                if row is not None:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._bump(conn, misses=1)
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._bump(conn, hits=1, bytes_saved=row[1])
+        return json.loads(row[0])
+
+    def put(self, key, provider, value, ttl=None):
+        data = json.dumps(value, ensure_ascii=False).encode("utf-8")
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, value, size, created, expires, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, provider, data, len(data), now, now + (ttl or self.ttl), now),
+            )
+            conn.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                # LRU: borrar por último acceso hasta volver por debajo del límite
+                excess = total - self.max_bytes
+                freed = 0
+                victims = []
+                for victim, size in conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+                    victims.append((victim,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                conn.executemany("DELETE FROM responses WHERE key = ?", victims)
+                self._bump(conn, evictions=len(victims))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def clear(self):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("DELETE FROM counters")
+
+    def stats(self):
+        conn = self._conn()
+        entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+        hits = counters.get("hits", 0)
+        misses = counters.get("misses", 0)
+        return {
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "bytes_saved": counters.get("bytes_saved", 0),
+            "evictions": counters.get("evictions", 0),
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Caché compartida del proceso (se abre en el primer uso)"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResponseCache()
+        return _cache